@@ -0,0 +1,321 @@
+import os
+import shutil
+import subprocess
+import time
+import tracemalloc
+
+import sympy as sp
+
+from wrapped_function import *
+from t1005_graph import *
+from t1005_option import CodegenConfig
+from sympy_function import SymPyFunction
+from scan_function import ScanFunction
+from sum_function import weighted_sum
+from variable_array import VariableArray
+from graph_serialization import dump_function, load_function, function_to_string, function_from_string
+
+_benchmark_project_root = os.path.dirname(os.path.abspath(__file__))
+UserLibrary.set_global_project_root(_benchmark_project_root)
+
+
+def _compile_seconds(library: UserLibrary):
+    """
+    Compile the generated .cpp into an object file, if g++ is available.
+    :param library:
+    :return: (compile seconds, object size in bytes), or None without g++.
+    """
+    if shutil.which("g++") is None:
+        return None
+    cpp_file = os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")
+    object_file = os.path.join(library.lib_abs_path(), library.lib_name() + ".o")
+    start = time.perf_counter()
+    subprocess.run(["g++", "-O2", "-std=c++11", "-include", "cmath", "-I", _benchmark_project_root,
+                    "-c", cpp_file, "-o", object_file], check=True)
+    return time.perf_counter() - start, os.path.getsize(object_file)
+
+
+def _report(name: str, library: UserLibrary, codegen_seconds: float):
+    cpp_file = os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")
+    with open(cpp_file) as f:
+        num_lines = len(f.readlines())
+    compiled = _compile_seconds(library)
+    compile_info = "g++ -O2 %.2fs, object %d bytes" % compiled if compiled is not None else "g++ not found"
+    print("%-10s codegen %.2fs, %d lines, %s" % (name, codegen_seconds, num_lines, compile_info))
+
+
+def bench_shared_nodes(num_steps=8):
+    """
+    A rollout applies the same dynamics node once per time step.
+    Compare printing every application in place against sharing them through inline helpers.
+
+    result:
+    generated/benchmark_rollout_<name>.h/.cpp
+    :param num_steps:
+    :return:
+    """
+    step = SymPyFunction(lambda p, v, u: (p + 0.1 * v * sp.cos(p), v + 0.1 * (u - sp.sin(p) * v)))
+    square = SymPyFunction(lambda a: a ** 2)
+
+    configs = {"in_place": CodegenConfig(),
+               "shared": CodegenConfig(share_repeated_nodes=True)}
+    for name, config in configs.items():
+        start = time.perf_counter()
+        g = Graph()
+        p, v = g.state_inputs(['p', 'v'], 'double')
+        controls = g.state_inputs(['u%d' % i for i in range(num_steps)], 'double')
+        cost = p * 0
+        for u in controls:
+            p, v = step(p, v, u)
+            cost = cost + square(p) + square(v)
+        cost.set_name("cost")
+
+        wrapped = wrap_graph(graph=g,
+                             input_variables=g.get_state_input_variables(),
+                             output_variables=[cost],
+                             function_name="Rollout",
+                             config=config)
+        library = UserLibrary("generated", "benchmark_rollout_" + name)
+        wrapped.dump_to_lib(library=library)
+        _report(name, library, time.perf_counter() - start)
+
+
+def bench_hessian_coloring(num_inputs=12):
+    """
+    A sum of squared terms, each of two neighbouring inputs, has a banded hessian.
+    Compare the 2nd order reverse pass per output against hessian vector products of colored columns.
+
+    result:
+    generated/benchmark_band_<name>.h/.cpp
+    :param num_inputs:
+    :return:
+    """
+    term = SymPyFunction(lambda a, b: sp.sin(a) * b + a * b * b)
+    square = SymPyFunction(lambda a: a ** 2)
+
+    configs = {"reverse": CodegenConfig(),
+               "coloring": CodegenConfig(hessian_coloring=True)}
+    for name, config in configs.items():
+        start = time.perf_counter()
+        g = Graph()
+        xs = g.state_inputs(['x%d' % i for i in range(num_inputs)], 'double')
+        cost = square(term(xs[0], xs[1]))
+        for i in range(1, num_inputs - 1):
+            cost = cost + square(term(xs[i], xs[i + 1]))
+        cost.set_name("cost")
+
+        wrapped = wrap_graph(graph=g,
+                             input_variables=list(xs),
+                             output_variables=[cost],
+                             function_name="Band",
+                             config=config)
+        library = UserLibrary("generated", "benchmark_band_" + name)
+        wrapped.dump_to_lib(library=library)
+        codegen_seconds = time.perf_counter() - start
+        d2_result = wrapped.call_results[wrapped.options.index(AllOptions.option_menu["d2"])]
+        print("%-10s d2: %d sweeps, %d multiplies" % (name, d2_result.sweep_count, d2_result.multiply_count))
+        _report(name, library, codegen_seconds)
+
+
+def bench_scan(num_steps=50):
+    """
+    A rollout applies the same dynamics node once per time step.
+    Compare unrolling the steps into the graph against a scan node printing them as a loop,
+    and the full hessian against its blocks within a step and between consecutive steps only.
+
+    result:
+    generated/benchmark_scan_<name>.h/.cpp
+    :param num_steps:
+    :return:
+    """
+    step = SymPyFunction(lambda p, v, c, u: (p + 0.1 * v * sp.cos(p), v + 0.1 * (u - sp.sin(p) * v),
+                                             c + p ** 2 + v ** 2 + u ** 2))
+    body_graph = Graph()
+    body_inputs = body_graph.state_inputs(['p', 'v', 'c', 'u'], 'double')
+    body = body_graph.create_graph_function(list(body_inputs), list(step(*body_inputs)))
+
+    # Stages of the rollout inputs: (p, v), then the control of each step.
+    stage_of_inputs = [0, 0] + list(range(1, num_steps + 1))
+    in_band_channels = [(0,)] + [(0, j) for j in range(num_steps + 2)] + \
+                       [(0, j, k) for j in range(num_steps + 2) for k in range(j, num_steps + 2)
+                        if stage_of_inputs[k] - stage_of_inputs[j] <= 1]
+
+    for name in ["unrolled", "scan", "scan_band"]:
+        start = time.perf_counter()
+        g = Graph()
+        p, v = g.state_inputs(['p', 'v'], 'double')
+        controls = g.state_inputs(['u%d' % i for i in range(num_steps)], 'double')
+        options = [AllOptions.channel_option(in_band_channels)] if name == "scan_band" else None
+        if name == "unrolled":
+            cost = p * 0
+            for u in controls:
+                p, v, cost = step(p, v, cost, u)
+        else:
+            p, v, cost = ScanFunction(body, num_steps, 3)(p, v, p * 0, *controls)
+        cost.set_name("cost")
+
+        wrapped = wrap_graph(graph=g,
+                             input_variables=g.get_state_input_variables(),
+                             output_variables=[cost],
+                             function_name="ScanRollout",
+                             options=options)
+        library = UserLibrary("generated", "benchmark_scan_" + name)
+        wrapped.dump_to_lib(library=library)
+        _report(name, library, time.perf_counter() - start)
+
+
+def bench_sum(num_terms=300):
+    """
+    A cost sums many terms, each of one input.
+    Compare a chain of + against a single sum node.
+
+    result:
+    generated/benchmark_sum_<name>.h/.cpp
+    :param num_terms:
+    :return:
+    """
+    term = SymPyFunction(lambda a: sp.cos(a) * a)
+
+    for name in ["chain", "sum"]:
+        start = time.perf_counter()
+        g = Graph()
+        xs = g.state_inputs(['x%d' % i for i in range(num_terms)], 'double')
+        terms = [term(x) for x in xs]
+        if name == "chain":
+            cost = terms[0]
+            for t in terms[1:]:
+                cost = cost + t
+        else:
+            cost = weighted_sum(terms)
+        cost.set_name("cost")
+
+        wrapped = wrap_graph(graph=g,
+                             input_variables=list(xs),
+                             output_variables=[cost],
+                             function_name="SumCost")
+        library = UserLibrary("generated", "benchmark_sum_" + name)
+        wrapped.dump_to_lib(library=library)
+        _report(name, library, time.perf_counter() - start)
+
+
+def bench_graph_building(size=2000):
+    """
+    Build the graph of sum_i (x_i - y_i) ** 2 * 0.5, one operator call per element vs on VariableArray.
+    Only the operations are measured, not the inputs nor code generation.
+
+    result: time and peak memory of building, printed.
+    :param size:
+    :return:
+    """
+    for name in ["element", "array"]:
+        g = Graph()
+        xs = VariableArray.state_inputs(g, 'x', size)
+        ys = VariableArray.state_inputs(g, 'y', size)
+        tracemalloc.start()
+        start = time.perf_counter()
+        if name == "element":
+            terms = [(x - y) ** 2 * 0.5 for x, y in zip(xs, ys)]
+            cost = weighted_sum(terms)
+        else:
+            cost = ((xs - ys) ** 2 * 0.5).sum()
+        cost.set_name("cost")
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("%-10s build %.3fs, peak %.1f MB" % (name, seconds, peak / 1e6))
+
+
+def bench_graph_memory(size=100000):
+    """
+    Peak memory of holding a graph of sum_i (x_i - y_i) ** 2 * 0.5, inputs included.
+
+    result: peak memory per variable of the graph, printed.
+    :param size:
+    :return:
+    """
+    tracemalloc.start()
+    g = Graph()
+    xs = VariableArray.state_inputs(g, 'x', size)
+    ys = VariableArray.state_inputs(g, 'y', size)
+    cost = ((xs - ys) ** 2 * 0.5).sum()
+    cost.set_name("cost")
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Inputs, 3 operations per element, the sum and the 2 shared constants.
+    num_variables = 5 * size + 3
+    print("%-10s %d variables, peak %.1f MB, %d bytes per variable" % (
+        "memory", num_variables, peak / 1e6, peak // num_variables))
+
+
+def bench_graph_loading(size=2000):
+    """
+    A chain of size terms, each its own sympy function.
+    Compare running the model code against loading the graph function saved.
+
+    result:
+    generated/benchmark_loading.json
+    :param size:
+    :return:
+    """
+    def build():
+        g = Graph()
+        xs = g.state_inputs(['x%d' % i for i in range(size)], 'double')
+        terms = []
+        for i in range(size - 1):
+            term = SymPyFunction(lambda a, b: sp.cos(a) * b + sp.exp(a - b))
+            terms.append(term(xs[i], xs[i + 1]) * 0.5)
+        cost = weighted_sum(terms)
+        cost.set_name("cost")
+        return GraphFunction(g, xs, [cost])
+
+    file_path = os.path.join(_benchmark_project_root, "generated", "benchmark_loading.json")
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    start = time.perf_counter()
+    graph_function = build()
+    print("%-10s %.2fs" % ("build", time.perf_counter() - start))
+    start = time.perf_counter()
+    dump_function(graph_function, file_path)
+    print("%-10s %.2fs, %d bytes" % ("save", time.perf_counter() - start, os.path.getsize(file_path)))
+    start = time.perf_counter()
+    load_function(file_path)
+    print("%-10s %.2fs" % ("load", time.perf_counter() - start))
+
+
+def bench_lazy_wrapping(size=40):
+    """
+    Wrap a graph of size sympy terms, save and load the wrapped function, then dump the loaded one.
+
+    result:
+    generated/benchmark_lazy.h/.cpp
+    :param size:
+    :return:
+    """
+    g = Graph()
+    xs = g.state_inputs(['x%d' % i for i in range(size)], 'double')
+    terms = [SymPyFunction(lambda a, b: sp.atan(a * b) * sp.exp(a - b))(xs[i], xs[i + 1]) for i in range(size - 1)]
+    cost = weighted_sum(terms)
+    cost.set_name("cost")
+
+    start = time.perf_counter()
+    wrapped = wrap_graph(graph=g, input_variables=list(xs), output_variables=[cost], function_name="LazyCost")
+    print("%-10s %.2fs" % ("wrap", time.perf_counter() - start))
+
+    saved = function_to_string(wrapped)
+    start = time.perf_counter()
+    loaded = function_from_string(saved)
+    print("%-10s %.2fs" % ("load", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    loaded.dump_to_lib(library=UserLibrary("generated", "benchmark_lazy"))
+    print("%-10s %.2fs" % ("dump", time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    bench_shared_nodes()
+    bench_hessian_coloring()
+    bench_scan()
+    bench_sum()
+    bench_graph_building()
+    bench_graph_memory()
+    bench_graph_loading()
+    bench_lazy_wrapping()
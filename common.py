@@ -17,6 +17,23 @@ class Const1005:
     graph_constant_prefix = "G_CONSTANT_"
     graph_unused_prefix = "G_UNUSED_"
     input_channel_short = "input"
+    batch_function_suffix = "Batch"
+    batch_size_name = "batch_size"
+    batch_index_name = "batch_index"
+    buffer_function_suffix = "Buffer"
+    gradient_buffer_name = "grad"
+    hessian_buffer_name = "hess"
+    graph_buffer_prefix = "G_BUFFER_"
+    sparse_function_suffix = "Sparse"
+    jacobian_values_name = "jac_values"
+    hessian_values_name = "hess_values"
+    banded_function_suffix = "Banded"
+    hessian_diagonal_blocks_name = "hess_diag"
+    hessian_off_diagonal_blocks_name = "hess_off"
+    direction_prefix = "V_"
+    hessian_vector_prefix = "HV_"
+    jacobian_vector_prefix = "JV_"
+    graph_tangent_prefix = "GRAPH_V_"
     cpp_source_file_extension = ".cpp"
     cpp_header_file_extension = ".h"
     built_in_name_sub_strings = [graph_output_pointer_prefix, sympy_var_prefix, unnamed_graph_var_prefix,
@@ -33,6 +50,10 @@ class VarType1005:
     var_types_not_need_const_reference = ['double', 'int']
     default_var_type = 'double'
 
+    # Element-wise arrays, from type to where it is declared.
+    eigen_array_var_types = {'ArrayXd': 'Eigen::ArrayXd'}
+    eigen_include = "<Eigen/Core>"
+
     @classmethod
     def infer_combined_var_type(cls, var_type_list: List[str]):
 
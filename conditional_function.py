@@ -1,5 +1,93 @@
 from t1005_graph import *
 
 
+class ConditionalFunction(FunctionBase):
+    """
+    One of two branches, picked by the sign of a condition:
+    (condition, x_0, x_1, ...) -> true_branch(x_0, x_1, ...) if condition > 0 else false_branch(x_0, x_1, ...)
 
+    Printed as a c++ if block, only the branch taken computes its values and derivatives.
+    Derivatives on the condition are 0, as the branch taken is piecewise constant in it.
+    """
 
+    comparisons = {">", ">=", "<", "<="}
+
+    def __init__(self, true_branch: FunctionBase, false_branch: FunctionBase, comparison: str = ">"):
+        """
+        :param true_branch: for e.g. a GraphFunction.
+        :param false_branch: the same input and output spec as true_branch.
+        :param comparison: the true branch is taken if: condition {comparison} 0
+        """
+        assert true_branch.input_spec == false_branch.input_spec, "Branches take the same inputs."
+        assert true_branch.output_spec == false_branch.output_spec, "Branches give the same outputs."
+        assert comparison in self.comparisons, "Comparison must be one of %s." % sorted(self.comparisons)
+
+        self.branches = [true_branch, false_branch]
+        self.comparison = comparison
+
+        plain_options = {AllOptions.option_menu[name] for name in ["d0", "d1", "d2"]}
+        super(ConditionalFunction, self).__init__(['double'] + true_branch.input_spec,
+                                                  true_branch.output_spec,
+                                                  true_branch.dependencies.union(false_branch.dependencies),
+                                                  plain_options.intersection(true_branch.supported_options,
+                                                                             false_branch.supported_options))
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        return {"branches": [function_id(branch) for branch in self.branches], "comparison": self.comparison}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "ConditionalFunction":
+        return cls(functions[data["branches"][0]], functions[data["branches"][1]], data["comparison"])
+
+    def is_true(self, condition: float) -> bool:
+        return {">": condition > 0, ">=": condition >= 0, "<": condition < 0, "<=": condition <= 0}[self.comparison]
+
+    def evaluate(self, *args) -> Tuple:
+        return self.branches[0 if self.is_true(args[0]) else 1].evaluate(*args[1:])
+
+    def print_call(self, full_context: FullContext) -> CallResult:
+        res, dbg = self.is_compatible(full_context.context)
+        assert res, dbg
+        option = full_context.option
+        assert not option.takes_direction() and not option.enable_gauss_newton_hessian(), \
+            "Conditional provides plain derivatives only."
+
+        # The branches see the inputs but the condition, under the same channel names.
+        branch_context = Context(full_context.context.input_variables[1:], full_context.context.output_variables)
+        wanted_channels = set()
+        for channel in full_context.required_output_channels():
+            if 0 not in channel[1:]:
+                wanted_channels.add((channel[0],) + tuple([in_idx - 1 for in_idx in channel[1:]]))
+        branch_full_context = FullContext(branch_context, option, wanted_channels, full_context.config,
+                                          full_context.input_channel_ids[1:])
+        branch_results = [branch.print_call(branch_full_context) for branch in self.branches]
+
+        result = CallResult()
+        for branch_result in branch_results:
+            result.definitions.merge(branch_result.definitions)
+            result.sweep_count += branch_result.sweep_count
+            result.multiply_count += branch_result.multiply_count
+
+        for channel in full_context.required_output_channels():
+            if 0 in channel[1:]:
+                result.constant_output_channels[channel] = 0.0
+        # Constant only if so in both branches, with the same value.
+        constant_values = [branch_result.constant_output_channels for branch_result in branch_results]
+        for channel, value in constant_values[0].items():
+            if constant_values[1].get(channel) == value:
+                result.constant_output_channels[(channel[0],) + tuple([in_idx + 1 for in_idx in channel[1:]])] = value
+
+        condition = full_context.context.input_variables[0].as_cpp_operand()
+        result.lines.append("if (%s %s 0.0) {" % (condition, self.comparison))
+        for i in range(len(self.branches)):
+            if i == 1:
+                result.lines.append("} else {")
+            for ln in branch_results[i].lines:
+                result.lines.append(Const1005.indent + ln)
+            # Constant in this branch only.
+            for channel, value in constant_values[i].items():
+                if constant_values[1 - i].get(channel) != value:
+                    result.lines.append(Const1005.indent + "%s = %s;" % (
+                        branch_full_context.output_channel_name(channel), repr(float(value))))
+        result.lines.append("}")
+        return result
@@ -20,6 +20,8 @@ class CppFunction(FunctionBase):
         assert is_valid_namespace(namespace)
 
         self.calling_prefix = namespace + "::"
+        self.namespace = namespace
+        self.user_library = user_library
         self.header = header
 
         super(CppFunction, self).__init__(self.header.input_spec.copy(),
@@ -30,6 +32,24 @@ class CppFunction(FunctionBase):
     def optional_header(self) -> "Header":
         return self.header
 
+    def is_compatible(self, context: Context) -> Tuple[bool, str]:
+        res, dbg = super(CppFunction, self).is_compatible(context)
+
+        if not res:
+            return res, dbg
+
+        return Header.check_parameter_inputs(self.header.input_names, self.header.parameter_names,
+                                             context.input_variables)
+
     def print_call(self, full_context: FullContext) -> CallResult:
         return self.header.print_call(full_context, prefix=self.calling_prefix)
 
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        return {"header": self.header.to_dict(),
+                "library": [self.user_library.relative_path(), self.user_library.lib_name()],
+                "namespace": self.namespace}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "CppFunction":
+        return cls(Header.from_dict(data["header"]), UserLibrary(*data["library"]), data["namespace"])
+
@@ -88,3 +88,6 @@ class UserLibrary(CppLibrary):
 
     def lib_name(self):
         return self._lib_name
+
+    def relative_path(self):
+        return self._relative_path
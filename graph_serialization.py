@@ -0,0 +1,73 @@
+from t1005_graph import *
+from sympy_function import SymPyFunction
+from cpp_functions import CppFunction
+from wrapped_function import WrappedFunction
+from sum_function import SumFunction
+from scan_function import ScanFunction
+from conditional_function import ConditionalFunction
+import json
+
+# Functions that can be saved, by the name they are saved under. See FunctionBase.to_dict.
+serializable_function_types = {function_type.__name__: function_type for function_type in
+                               [SymPyFunction, CppFunction, GraphFunction, WrappedFunction,
+                                SumFunction, ScanFunction, ConditionalFunction]}
+
+serialization_format_version = 1
+
+
+def function_to_string(function: FunctionBase) -> str:
+    """
+    The compact json form of function, and of the functions it relies on, to build it again without
+    running the code that built it, see function_from_string.
+    A graph is saved as its GraphFunction, or as the WrappedFunction of it.
+
+    Each function is saved once, after those it relies on: graph operations refer to their functions
+    and variables by index.
+    :param function: of the serializable_function_types, and so are the functions it relies on.
+    """
+    records = []
+    function_ids: Dict[int, int] = {}
+
+    def function_id(f: FunctionBase) -> int:
+        # Functions are alive during the saving, their id() are unique.
+        if id(f) not in function_ids:
+            kind = type(f).__name__
+            assert serializable_function_types.get(kind) is type(f), "%s can't be serialized." % kind
+            data = f.to_dict(function_id)
+            function_ids[id(f)] = len(records)
+            records.append([kind, data])
+        return function_ids[id(f)]
+
+    function_id(function)
+    return json.dumps({"version": serialization_format_version, "functions": records}, separators=(",", ":"))
+
+
+def function_from_string(string: str) -> FunctionBase:
+    """
+    :param string: from function_to_string.
+    :return: the function saved.
+    """
+    loaded = json.loads(string)
+    assert loaded["version"] == serialization_format_version, \
+        "Unsupported serialization format: %s" % loaded["version"]
+
+    functions: List[FunctionBase] = []
+    for kind, data in loaded["functions"]:
+        functions.append(serializable_function_types[kind].from_dict(data, functions))
+    return functions[-1]
+
+
+def dump_function(function: FunctionBase, file_path: str):
+    """
+    Save function into a file, see function_to_string.
+    """
+    with open(file_path, "w") as f:
+        f.write(function_to_string(function))
+
+
+def load_function(file_path: str) -> FunctionBase:
+    """
+    :return: the function saved by dump_function.
+    """
+    with open(file_path) as f:
+        return function_from_string(f.read())
@@ -1,6 +1,8 @@
 from t1005_graph import *
 from cpp_library import UserLibrary, CppLibrary
+import hashlib
 import os
+import re
 
 
 class Header:
@@ -19,6 +21,8 @@ class Header:
 
     _option_head = "// Option:"
     _constant_output_format = "%.6f"
+    _scalar_template_head = "template <typename Scalar>"
+    _scalar_template_name = "Scalar"
 
     def __init__(self, function_name: str,
                  supported_options: List[Option],
@@ -27,13 +31,19 @@ class Header:
                  input_names: List[str],
                  output_names: List[str],
                  constant_derivative_channels: Dict[Tuple, float],
-                 safe_check=True):
+                 safe_check=True,
+                 parameter_names: List[str] = None):
+        """
+        :param parameter_names: numerical inputs that are not differentiated.
+        Their derivative channels are constant zero, and they take no direction.
+        """
         self.function_name = function_name
         self.supported_options = supported_options
         self.input_spec = input_spec
         self.output_spec = output_spec
         self.input_names = input_names
         self.output_names = output_names
+        self.parameter_names = [] if parameter_names is None else parameter_names
 
         if safe_check:
             self.safe_check()
@@ -129,7 +139,8 @@ class Header:
                       inputs: str,
                       outputs: str,
                       derivatives: str,
-                      supported_options: List[str]) -> "Header":
+                      supported_options: List[str],
+                      parameters: str = "") -> "Header":
         """
         WARNING: This function couples with print_python_code_to_create_header.
         Need to change both for any update.
@@ -138,6 +149,7 @@ class Header:
         :param outputs: example: z
         :param derivatives: example: D_z_D_x, D2_z_D_x_D_x
         :param supported_options: example: ["d0","d1","d2"]
+        :param parameters: numerical inputs that are not differentiated, example: a, b
         :return:
         """
         inputs = purify(inputs)
@@ -202,7 +214,8 @@ class Header:
                       output_spec=output_spec,
                       input_names=input_names,
                       output_names=output_names,
-                      constant_derivative_channels=constant_output_channels)
+                      constant_derivative_channels=constant_output_channels,
+                      parameter_names=split_skip_empty(purify(parameters).replace(" ", ""), ","))
 
     # This is the header -> python interface
     def print_python_code_to_create_header(self, left_value_name: str) -> List[str]:
@@ -298,23 +311,64 @@ class Header:
         option_names = AllOptions.build_names_from_options_list(self.supported_options)
         append_field_and_multi_line_values("supported_options", [str(option_names)])
 
+        # parameters
+        if self.parameter_names:
+            append_field_and_multi_line_values("parameters", ["\"%s\"" % ", ".join(self.parameter_names)])
+
         # final ket.
         lines[-1] = lines[-1][:-1] + ")"
 
         return lines
 
+    def to_dict(self) -> Dict:
+        """
+        The json friendly form of the header, see from_dict.
+        """
+        return {"function_name": self.function_name,
+                "supported_options": AllOptions.build_names_from_options_list(self.supported_options),
+                "input_spec": self.input_spec,
+                "output_spec": self.output_spec,
+                "input_names": self.input_names,
+                "output_names": self.output_names,
+                "constant_derivative_channels": [[list(channel), value] for channel, value in
+                                                 self.constant_derivative_channels.items()],
+                "parameter_names": self.parameter_names}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Header":
+        return cls(data["function_name"],
+                   AllOptions.build_option_list_from_names(data["supported_options"]),
+                   data["input_spec"],
+                   data["output_spec"],
+                   data["input_names"],
+                   data["output_names"],
+                   {tuple(channel): value for channel, value in data["constant_derivative_channels"]},
+                   parameter_names=data["parameter_names"])
+
     # This is the header -> .h file interface
     def dump_to_h_file(self, user_library: UserLibrary,
                        force_update=True,
                        namespace: List[str] = None,
                        dependencies: Set[CppLibrary] = None,
-                       author_script: str = "None"):
+                       author_script: str = "None",
+                       batch=False,
+                       scalar_template=False,
+                       buffers=False,
+                       sparse=False,
+                       sparsity_metadata=False,
+                       stages: List[int] = None):
         """
         :param user_library: cpp header file destination
         :param force_update:  Will override existing file if true
         :param namespace: ["math","util"] -> math::util
         :param dependencies: other library objects
         :param author_script: /my/folder/some_script.py
+        :param batch: also declare the batch variants
+        :param scalar_template: declare template <typename Scalar> functions
+        :param buffers: also declare the contiguous grad/hess variants
+        :param sparse: also declare the sparse variants and their patterns
+        :param sparsity_metadata: declare constexpr sparsity patterns, constants and counts of each option
+        :param stages: if given, also declare the block banded variants, see print_banded_head.
         :return:
         """
         path = user_library.lib_abs_path()
@@ -350,13 +404,17 @@ class Header:
             # includes
             builtin_includes = []
             includes = []
+            eigen_types = sorted({var_type for var_type in self.input_spec + self.output_spec
+                                  if var_type in VarType1005.eigen_array_var_types})
+            if eigen_types:
+                builtin_includes.append("#include " + VarType1005.eigen_include)
             for dep in dependencies:
                 include_name = dep.include_name()
                 if include_name[0] == "<":
                     builtin_includes.append("#include " + include_name)
                 else:
                     includes.append("#include " + include_name)
-            builtin_includes.sort()
+            builtin_includes = sorted(set(builtin_includes))
             includes.sort()
 
             if builtin_includes:
@@ -377,8 +435,16 @@ class Header:
 
             empty_line()
 
+            # Element-wise array types are used unqualified.
+            if eigen_types:
+                write_lines(["using %s;" % VarType1005.eigen_array_var_types[var_type] for var_type in eigen_types],
+                            indent=1 if namespace_string != "" else 0)
+                empty_line()
+
             # header core part
-            write_lines(self.print_header_core(), indent=1 if namespace_string != "" else 0)
+            write_lines(self.print_header_core(batch, scalar_template, buffers, sparse,
+                                                     sparsity_metadata, stages),
+                        indent=1 if namespace_string != "" else 0)
 
             # namespace
             if namespace_string != "":
@@ -398,6 +464,7 @@ class Header:
         self.output_spec
         self.input_names
         self.output_names
+        self.parameter_names
         :return:
         """
         assert is_valid_cpp_name(self.function_name), "Need valid function name."
@@ -410,6 +477,21 @@ class Header:
         all_name_set = set(self.input_names)
         all_name_set.update(set(self.output_names))
         assert len(all_name_set) == len(self.input_names) + len(self.output_names), "Need no repeated names."
+        assert all([name in self.input_names for name in self.parameter_names]), "Parameters must be inputs."
+
+    @staticmethod
+    def check_parameter_inputs(input_names: List[str], parameter_names: List[str],
+                               input_variables: List[Variable]) -> Tuple[bool, str]:
+        """
+        Parameters have no derivative channel: a differentiable variable passed as parameter
+        would lose its derivatives. Only config inputs and constants are taken.
+        :return: result, debug_string
+        """
+        for i in range(len(input_names)):
+            if input_names[i] in parameter_names and input_variables[i].is_differentiable():
+                return False, "The %d' th input %s is a parameter, it takes no differentiable variable." % \
+                       (i, input_names[i])
+        return True, ""
 
     def output_channels(self, option):
         """
@@ -423,8 +505,11 @@ class Header:
         full_channels = full_output_channels_with_derivatives(in_dim, out_dim,
                                                               option.enable_1st_order_derivative(),
                                                               option.enable_2nd_order_derivative())
+        requested_channels = option.requested_channels()
         channels = []
         for channel in full_channels:
+            if requested_channels is not None and channel not in requested_channels:
+                continue
             if channel not in self.constant_derivative_channels:
                 channels.append(channel)
 
@@ -510,7 +595,8 @@ class Header:
                 i1, i2 = i2, i1
             return output_index_from_name(output_name), i1, i2
 
-    def print_header_core(self):
+    def print_header_core(self, batch=False, scalar_template=False, buffers=False, sparse=False,
+                          sparsity_metadata=False, stages: List[int] = None):
         """
         to .h
         one line, one input/output
@@ -520,6 +606,14 @@ class Header:
         option must be headed.
         use raw option to fetch input spec. output specs.
         for constant derivative io, I bet you can make them inline in header.
+        :param batch: also declare the batch variants, see print_batch_head.
+        :param scalar_template: declare template <typename Scalar> functions, see to_scalar_template.
+        :param buffers: also declare the contiguous grad/hess variants, see print_buffer_head.
+        :param sparse: also declare the sparse variants, see print_sparse_head.
+        They come with the sparsity metadata.
+        :param sparsity_metadata: declare constexpr sparsity metadata, see print_sparsity_metadata.
+        :param stages: if given, also declare the block banded variants of the options supporting them,
+        see print_banded_head.
         :return:
         """
         result = []
@@ -538,11 +632,14 @@ class Header:
             in_dim = len(self.input_spec)
             for i in range(in_dim):
                 fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+            fields += self.direction_fields(option)
             # outputs
             for channel in self.output_channels(option):
                 field_type = self.output_channel_type(channel)
                 field_name = self.output_channel_name(channel)
                 fields.append(field_type + "* " + field_name)
+            fields += self.jacobian_vector_fields(option)
+            fields += self.hessian_vector_fields(option)
             # constant outputs
             for channel, value in self.constant_derivative_channels.items():
                 if value == 0:
@@ -550,45 +647,585 @@ class Header:
                 field_name = self.output_channel_name(channel)
                 field_value = self._constant_output_format % value
                 fields.append("/*%s = %s*/" % (field_name, field_value))
-            result += self._function_with_fields_to_lines(final_function_name, fields)
+            declarations = [self._function_with_fields_to_lines(final_function_name, fields)]
+
+            # Batch variant
+            if batch:
+                declarations.append(self.print_batch_head(option))
+
+            # Buffer variant
+            if buffers:
+                declarations.append(self.print_buffer_head(option))
+
+            # Sparse variant
+            if sparse:
+                declarations.append(self.print_sparse_head(option))
+
+            # Block banded variant
+            if stages is not None and self.supports_banded(option):
+                declarations.append(self.print_banded_head(option, stages))
+
+            for declaration in declarations:
+                if scalar_template:
+                    declaration = self.to_scalar_template(declaration, self.scalar_type())
+                result += declaration
+
+            if sparse or sparsity_metadata:
+                result += self.print_sparsity_metadata(option)
 
             # Empty line
             result.append("")
 
         return result
 
-    def print_implementation_head(self, option: Option):
-        final_function_name = option.decorate(self.function_name)
+    def hessian_vector_channels(self, option: Option) -> List[Tuple[int, int]]:
+        """
+        (out, in) of HV_{out}_D_{in} provided by option, for each numerical input.
+        """
+        if not option.enable_hessian_vector_product():
+            return []
+        return [(i, j) for i in range(len(self.output_spec)) for j in self.direction_input_ids(option)]
+
+    def direction_input_ids(self, option: Option) -> List[int]:
+        """
+        The numerical inputs taking a direction V_{in} under option.
+        """
+        if not option.takes_direction():
+            return []
+        return [j for j in range(len(self.input_spec)) if VarType1005.is_numerical_var_type(self.input_spec[j])
+                and self.input_names[j] not in self.parameter_names]
+
+    def jacobian_vector_channels(self, option: Option) -> List[Tuple[int]]:
+        """
+        (out,) of JV_{out} provided by option.
+        """
+        if not option.enable_jacobian_vector_product() or not self.direction_input_ids(option):
+            return []
+        return [(i,) for i in range(len(self.output_spec))]
+
+    def jacobian_vector_channel_name(self, channel: Tuple[int]):
+        return Const1005.jacobian_vector_prefix + self.output_names[channel[0]]
+
+    def direction_name(self, in_idx: int):
+        return Const1005.direction_prefix + self.input_names[in_idx]
+
+    def hessian_vector_channel_name(self, channel: Tuple[int, int]):
+        return Const1005.hessian_vector_prefix + "%s_D_%s" % (self.output_names[channel[0]],
+                                                              self.input_names[channel[1]])
+
+    def direction_fields(self, option: Option) -> List[str]:
+        """
+        Under options taking a direction, the direction V_{in} of each numerical input.
+        """
+        return [VarType1005.const_reference(self.input_spec[i]) + ' ' + self.direction_name(i)
+                for i in self.direction_input_ids(option)]
+
+    def jacobian_vector_fields(self, option: Option) -> List[str]:
+        """
+        Under jacobian vector product option, JV_{out} = sum of D_{out}_D_{k} * V_{k} over inputs k.
+        """
+        return [self.output_channel_type(channel) + "* " + self.jacobian_vector_channel_name(channel)
+                for channel in self.jacobian_vector_channels(option)]
+
+    def hessian_vector_fields(self, option: Option) -> List[str]:
+        """
+        Under hessian vector product option, HV_{out}_D_{in} = sum of D2_{out}_D_{in}_D_{k} * V_{k} over inputs k.
+        """
+        return [self.output_channel_type(channel) + "* " + self.hessian_vector_channel_name(channel)
+                for channel in self.hessian_vector_channels(option)]
+
+    def batch_function_name(self, option: Option):
+        return option.decorate(self.function_name) + Const1005.batch_function_suffix
+
+    def print_batch_head(self, option: Option):
+        """
+        Head of the batch variant, evaluating batch_size points in structure-of-arrays layout.
+        Numerical inputs and all outputs become arrays of batch_size, other inputs are shared by the batch.
+        Constant derivative outputs are skipped, same as the single point function.
+        :param option:
+        :return: declaration lines, end with ";"
+        """
+        assert not option.takes_direction(), "batch: options taking a direction not supported."
+        all_names = self.input_names + [self.output_channel_name(channel) for channel in self.output_channels(option)]
+        assert Const1005.batch_size_name not in all_names, "batch: <%s> is reserved." % Const1005.batch_size_name
+        assert Const1005.batch_index_name not in all_names, "batch: <%s> is reserved." % Const1005.batch_index_name
+
+        fields = []
+        # inputs
+        for i in range(len(self.input_spec)):
+            if VarType1005.is_numerical_var_type(self.input_spec[i]):
+                fields.append("const " + self.input_spec[i] + "* " + self.input_names[i])
+            else:
+                fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+        # outputs
+        for channel in self.output_channels(option):
+            fields.append(self.output_channel_type(channel) + "* " + self.output_channel_name(channel))
+        fields.append("int " + Const1005.batch_size_name)
+        return self._function_with_fields_to_lines(self.batch_function_name(option), fields)
+
+    def print_batch_implementation(self, option: Option, parallel=False):
+        """
+        The batch variant loops over the single point function.
+        Defined in the same .cpp, the single point function can be inlined and the loop vectorized.
+        :param option:
+        :param parallel: if true, distribute the loop with OpenMP.
+        :return:
+        """
+        result = self.print_batch_head(option)
+        result[-1] = result[-1][:-1] + " {"
+
+        index = Const1005.batch_index_name
+        arguments = []
+        for i in range(len(self.input_spec)):
+            if VarType1005.is_numerical_var_type(self.input_spec[i]):
+                arguments.append("%s[%s]" % (self.input_names[i], index))
+            else:
+                arguments.append(self.input_names[i])
+        for channel in self.output_channels(option):
+            arguments.append("&%s[%s]" % (self.output_channel_name(channel), index))
+
+        if parallel:
+            result.append("#pragma omp parallel for")
+        result.append(Const1005.indent + "for (int %s = 0; %s < %s; ++%s) {" % (
+            index, index, Const1005.batch_size_name, index))
+        result.append(Const1005.indent * 2 + "%s(%s);" % (option.decorate(self.function_name), ", ".join(arguments)))
+        result.append(Const1005.indent + "}")
+        result.append("}")
+        return result
+
+    def buffer_function_name(self, option: Option):
+        return option.decorate(self.function_name) + Const1005.buffer_function_suffix
+
+    def buffer_offset(self, channel: Tuple) -> int:
+        """
+        Where a derivative channel is in the grad/hess buffer, with n inputs:
+        grad[i * n + j] = D_{output i}_D_{input j}
+        hess[i * n * (n + 1) / 2 + j * n - j * (j - 1) / 2 + (k - j)] = D2_{output i}_D_{input j}_D_{input k}, j <= k
+        That is, the upper triangle of each output's hessian, row by row.
+        """
+        assert len(channel) in {2, 3}
+        n = len(self.input_spec)
+        if len(channel) == 2:
+            i, j = channel
+            return i * n + j
+        i, j, k = channel
+        assert j <= k
+        return i * n * (n + 1) // 2 + j * n - j * (j - 1) // 2 + (k - j)
+
+    def buffer_size(self, order: int) -> int:
+        """
+        :param order: 1 for grad, 2 for hess
+        """
+        n = len(self.input_spec)
+        return len(self.output_spec) * (n if order == 1 else n * (n + 1) // 2)
+
+    def buffer_channel_fields(self, option: Option, grad: str = Const1005.gradient_buffer_name,
+                              hess: str = Const1005.hessian_buffer_name) -> Dict[Tuple, str]:
+        """
+        :return: from every channel of option, including constant ones, to where the buffer variant writes it.
+        """
+        fields = {}
+        for channel in full_output_channels_with_derivatives(len(self.input_spec), len(self.output_spec),
+                                                             option.enable_1st_order_derivative(),
+                                                             option.enable_2nd_order_derivative()):
+            if len(channel) == 1:
+                fields[channel] = "*" + self.output_names[channel[0]]
+            else:
+                fields[channel] = "%s[%d]" % (grad if len(channel) == 2 else hess, self.buffer_offset(channel))
+        return fields
+
+    def print_buffer_head(self, option: Option):
+        """
+        Head of the buffer variant, which writes all derivatives, constant ones included,
+        into the contiguous grad and hess buffers, see buffer_offset.
+        Outputs are still written through one pointer each.
+        :param option:
+        :return: declaration lines, end with ";"
+        """
+        assert not option.takes_direction(), "buffers: options taking a direction not supported."
+        assert option.requested_channels() is None, "buffers: options with requested channels not supported."
+        buffer_type = self.scalar_type()
+        assert buffer_type not in VarType1005.eigen_array_var_types, "buffers: array outputs not supported."
+        assert Const1005.gradient_buffer_name not in self.input_names + self.output_names, \
+            "buffers: <%s> is reserved." % Const1005.gradient_buffer_name
+        assert Const1005.hessian_buffer_name not in self.input_names + self.output_names, \
+            "buffers: <%s> is reserved." % Const1005.hessian_buffer_name
+
+        fields = []
+        # inputs
+        for i in range(len(self.input_spec)):
+            fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+        # outputs
+        for i in range(len(self.output_spec)):
+            fields.append(self.output_spec[i] + "* " + self.output_names[i])
+        if option.enable_1st_order_derivative() or option.enable_2nd_order_derivative():
+            fields.append(buffer_type + "* " + Const1005.gradient_buffer_name)
+        if option.enable_2nd_order_derivative():
+            fields.append(buffer_type + "* " + Const1005.hessian_buffer_name)
+        return self._function_with_fields_to_lines(self.buffer_function_name(option), fields)
+
+    def sparse_function_name(self, option: Option):
+        return option.decorate(self.function_name) + Const1005.sparse_function_suffix
+
+    def sparse_channels(self, option: Option, order: int) -> List[Tuple]:
+        """
+        Structurally nonzero derivative channels, that is, all but the zero constant ones.
+        :param order: 1 for jacobian, ordered by (input, output), column major.
+        2 for hessian upper triangles, ordered by (output, input_2, input_1), column major per output.
+        """
+        channels = [channel for channel in
+                    full_output_channels_with_derivatives(len(self.input_spec), len(self.output_spec),
+                                                          option.enable_1st_order_derivative(),
+                                                          option.enable_2nd_order_derivative())
+                    if len(channel) == order + 1 and self.constant_derivative_channels.get(channel) != 0]
+        if order == 1:
+            channels.sort(key=lambda channel: (channel[1], channel[0]))
+        else:
+            channels.sort(key=lambda channel: (channel[0], channel[2], channel[1]))
+        return channels
+
+    def sparse_channel_fields(self, option: Option) -> Dict[Tuple, str]:
+        """
+        :return: from every structurally nonzero channel of option, to where the sparse variant writes it.
+        """
+        fields = {}
+        for i in range(len(self.output_spec)):
+            fields[(i,)] = "*" + self.output_names[i]
+        for order, values in [(1, Const1005.jacobian_values_name), (2, Const1005.hessian_values_name)]:
+            channels = self.sparse_channels(option, order)
+            for index in range(len(channels)):
+                fields[channels[index]] = "%s[%d]" % (values, index)
+        return fields
+
+    def print_sparse_head(self, option: Option):
+        """
+        Head of the sparse variant, which writes only structurally nonzero derivatives, see sparse_channels.
+        Their (row, col) are given by print_sparsity_metadata.
+        :param option:
+        :return: declaration lines, end with ";"
+        """
+        assert not option.takes_direction(), "sparse: options taking a direction not supported."
+        assert option.requested_channels() is None, "sparse: options with requested channels not supported."
+        values_type = self.scalar_type()
+        assert values_type not in VarType1005.eigen_array_var_types, "sparse: array outputs not supported."
+        assert Const1005.jacobian_values_name not in self.input_names + self.output_names, \
+            "sparse: <%s> is reserved." % Const1005.jacobian_values_name
+        assert Const1005.hessian_values_name not in self.input_names + self.output_names, \
+            "sparse: <%s> is reserved." % Const1005.hessian_values_name
+
+        fields = []
+        # inputs
+        for i in range(len(self.input_spec)):
+            fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+        # outputs
+        for i in range(len(self.output_spec)):
+            fields.append(self.output_spec[i] + "* " + self.output_names[i])
+        if option.enable_1st_order_derivative() or option.enable_2nd_order_derivative():
+            fields.append(values_type + "* " + Const1005.jacobian_values_name)
+        if option.enable_2nd_order_derivative():
+            fields.append(values_type + "* " + Const1005.hessian_values_name)
+        return self._function_with_fields_to_lines(self.sparse_function_name(option), fields)
+
+    def banded_function_name(self, option: Option):
+        return option.decorate(self.function_name) + Const1005.banded_function_suffix
+
+    @staticmethod
+    def supports_banded(option: Option):
+        """
+        Whether option has a block banded variant: plain 2nd order derivatives.
+        """
+        return option.enable_2nd_order_derivative() and not option.enable_gauss_newton_hessian() and \
+               option.requested_channels() is None
+
+    @staticmethod
+    def stage_of_inputs(stages: List[int]) -> List[int]:
+        """
+        :param stages: number of inputs of each stage, the inputs of stage 0 first, example: [2, 3]
+        :return: the stage of each input, example: [0, 0, 1, 1, 1]
+        """
+        result = []
+        for stage in range(len(stages)):
+            result += [stage] * stages[stage]
+        return result
+
+    def banded_offset(self, channel: Tuple, stages: List[int]) -> Tuple[str, int]:
+        """
+        Where a 2nd order channel D2_{output i}_D_{input j}_D_{input k}, j <= k, is in the banded buffers.
+        Inputs j, k are of stage s, t, taking n_s, n_t inputs from input o_s, o_t on.
+        Each output has the diagonal blocks of all stages, then the blocks above them:
+        hess_diag[i * sum_s(n_s * n_s) + sum_{r < s}(n_r * n_r) + (j - o_s) * n_s + (k - o_s)], if s == t
+        hess_off[i * sum_s(n_s * n_{s + 1}) + sum_{r < s}(n_r * n_{r + 1}) + (j - o_s) * n_t + (k - o_t)], if t == s + 1
+        Blocks are row major. Diagonal blocks are full, both (j, k) and (k, j) hold the channel.
+        :return: (buffer name, index), or None for channels out of band.
+        """
+        assert len(channel) == 3
+        i, j, k = channel
+        assert j <= k
+        stage_of_inputs = self.stage_of_inputs(stages)
+        s, t = stage_of_inputs[j], stage_of_inputs[k]
+        o_s, o_t = sum(stages[:s]), sum(stages[:t])
+        if s == t:
+            return Const1005.hessian_diagonal_blocks_name, \
+                   i * self.banded_size(stages, True) + sum([n * n for n in stages[:s]]) + \
+                   (j - o_s) * stages[s] + (k - o_s)
+        if t == s + 1:
+            return Const1005.hessian_off_diagonal_blocks_name, \
+                   i * self.banded_size(stages, False) + sum([stages[r] * stages[r + 1] for r in range(s)]) + \
+                   (j - o_s) * stages[t] + (k - o_t)
+        return None
+
+    def banded_size(self, stages: List[int], diagonal: bool) -> int:
+        """
+        :return: size of the banded buffer of one output, diagonal or off diagonal blocks.
+        """
+        if diagonal:
+            return sum([n * n for n in stages])
+        return sum([stages[s] * stages[s + 1] for s in range(len(stages) - 1)])
+
+    def banded_channel_fields(self, option: Option, stages: List[int]) -> Dict[Tuple, str]:
+        """
+        :return: from every channel of option in band, including constant ones, to where the banded variant writes it.
+        The lower triangles of the diagonal blocks are not included.
+        """
+        fields = {}
+        for channel in full_output_channels_with_derivatives(len(self.input_spec), len(self.output_spec),
+                                                             option.enable_1st_order_derivative(),
+                                                             option.enable_2nd_order_derivative()):
+            if len(channel) == 1:
+                fields[channel] = "*" + self.output_names[channel[0]]
+            elif len(channel) == 2:
+                fields[channel] = "%s[%d]" % (Const1005.gradient_buffer_name, self.buffer_offset(channel))
+            elif self.banded_offset(channel, stages) is not None:
+                fields[channel] = "%s[%d]" % self.banded_offset(channel, stages)
+        return fields
+
+    def print_banded_head(self, option: Option, stages: List[int]):
+        """
+        Head of the block banded variant, for inputs partitioned into consecutive stages,
+        where each stage interacts only with the one before and the one after.
+        It writes the gradients into grad, see buffer_offset,
+        the diagonal and off diagonal hessian blocks into hess_diag and hess_off, see banded_offset.
+        Out of band channels are not computed: they must all be structurally zero.
+        :param option:
+        :param stages: number of inputs of each stage, see stage_of_inputs.
+        :return: declaration lines, end with ";"
+        """
+        assert self.supports_banded(option), "banded: option not supported."
+        assert all([n > 0 for n in stages]) and sum(stages) == len(self.input_spec), \
+            "banded: stages must partition the inputs."
+        scalar_type = self.scalar_type()
+        assert scalar_type not in VarType1005.eigen_array_var_types, "banded: array outputs not supported."
+        for name in [Const1005.gradient_buffer_name, Const1005.hessian_diagonal_blocks_name,
+                     Const1005.hessian_off_diagonal_blocks_name]:
+            assert name not in self.input_names + self.output_names, "banded: <%s> is reserved." % name
+        for channel in full_output_channels_with_derivatives(len(self.input_spec), len(self.output_spec),
+                                                             False, True):
+            if len(channel) == 3 and self.banded_offset(channel, stages) is None:
+                assert self.constant_derivative_channels.get(channel) == 0, \
+                    "banded: %s is out of band, yet not structurally zero." % self.output_channel_name(channel)
+
+        fields = []
+        # inputs
+        for i in range(len(self.input_spec)):
+            fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+        # outputs
+        for i in range(len(self.output_spec)):
+            fields.append(self.output_spec[i] + "* " + self.output_names[i])
+        fields.append(scalar_type + "* " + Const1005.gradient_buffer_name)
+        fields.append(scalar_type + "* " + Const1005.hessian_diagonal_blocks_name)
+        fields.append(scalar_type + "* " + Const1005.hessian_off_diagonal_blocks_name)
+        return self._function_with_fields_to_lines(self.banded_function_name(option), fields)
+
+    def print_sparsity_metadata(self, option: Option) -> List[str]:
+        """
+        Compile time description of the derivatives of option, example:
+        constexpr int kFooWithFirstOrderDerivativesJacobianNnz = 2;
+        constexpr int kFooWithFirstOrderDerivativesJacobianRows[] = {0, 0};
+        constexpr int kFooWithFirstOrderDerivativesJacobianCols[] = {0, 1};
+        constexpr int kFooWithFirstOrderDerivativesJacobianNumConstants = 1;
+        constexpr int kFooWithFirstOrderDerivativesJacobianConstantRows[] = {0};
+        constexpr int kFooWithFirstOrderDerivativesJacobianConstantCols[] = {1};
+        constexpr double kFooWithFirstOrderDerivativesJacobianConstantValues[] = {2.0};
+        Rows are outputs, cols are inputs.
+        The nonzero pattern, in the order of sparse_channels, includes the nonzero constants.
+        Hessian entries also come with the output they belong to, in ...HessianOutputs.
+        Arrays are skipped when empty.
+        """
+        prefix = "k" + option.decorate(self.function_name)
+        result = ["constexpr int %sNumInputs = %d;" % (prefix, len(self.input_spec)),
+                  "constexpr int %sNumOutputs = %d;" % (prefix, len(self.output_spec))]
+
+        def append_array(element_type: str, name: str, values: List[str]):
+            if values:
+                result.append("constexpr %s %s%s[] = {%s};" % (element_type, prefix, name, ", ".join(values)))
+
+        orders = []
+        if option.enable_1st_order_derivative() or option.enable_2nd_order_derivative():
+            orders.append((1, "Jacobian"))
+        if option.enable_2nd_order_derivative():
+            orders.append((2, "Hessian"))
+        for order, matrix in orders:
+            channels = self.sparse_channels(option, order)
+            constant_channels = [channel for channel in channels if channel in self.constant_derivative_channels]
+            for name, pattern in [("", channels), ("Constant", constant_channels)]:
+                if name == "":
+                    result.append("constexpr int %s%sNnz = %d;" % (prefix, matrix, len(pattern)))
+                else:
+                    result.append("constexpr int %s%sNumConstants = %d;" % (prefix, matrix, len(pattern)))
+                if order == 2:
+                    append_array("int", matrix + name + "Outputs", [str(channel[0]) for channel in pattern])
+                append_array("int", matrix + name + "Rows", [str(channel[-2]) for channel in pattern])
+                append_array("int", matrix + name + "Cols", [str(channel[-1]) for channel in pattern])
+            append_array("double", matrix + "ConstantValues",
+                         [repr(float(self.constant_derivative_channels[channel])) for channel in constant_channels])
+        return result
+
+    def _print_buffer_call(self, full_context: FullContext, prefix="") -> CallResult:
+        """
+        Call the buffer variant, then pick required derivatives from the buffers.
+        """
+        option = full_context.option
+        buffer_type = self.scalar_type()
+        grad = Const1005.graph_buffer_prefix + Const1005.gradient_buffer_name
+        hess = Const1005.graph_buffer_prefix + Const1005.hessian_buffer_name
+        fields = self.buffer_channel_fields(option, grad, hess)
+        required_channels = full_context.required_output_channels()
+
+        result = CallResult()
+        result.lines.append("{")
+        arguments = [variable.as_cpp_operand() for variable in full_context.context.input_variables]
+        unused_variables: Dict[str, str] = {}
+        for i in range(len(self.output_spec)):
+            if (i,) in required_channels:
+                arguments.append("&" + full_context.output_channel_name((i,)))
+            else:
+                var_type = self.output_spec[i]
+                if var_type not in unused_variables:
+                    unused_variables[var_type] = Const1005.graph_unused_prefix + var_type
+                arguments.append("&" + unused_variables[var_type])
+        for var_type, var_name in unused_variables.items():
+            result.lines.append(Const1005.indent + var_type + " " + var_name + ";")
+        if option.enable_1st_order_derivative() or option.enable_2nd_order_derivative():
+            result.lines.append(Const1005.indent + "%s %s[%d];" % (buffer_type, grad, self.buffer_size(1)))
+            arguments.append(grad)
+        if option.enable_2nd_order_derivative():
+            result.lines.append(Const1005.indent + "%s %s[%d];" % (buffer_type, hess, self.buffer_size(2)))
+            arguments.append(hess)
+        result.lines.append(Const1005.indent + prefix + self.buffer_function_name(option) +
+                            "(" + ",".join(arguments) + ");")
+
+        for channel in required_channels:
+            if len(channel) == 1:
+                continue
+            if channel in self.constant_derivative_channels:
+                result.constant_output_channels[channel] = self.constant_derivative_channels[channel]
+            else:
+                result.lines.append(Const1005.indent + full_context.output_channel_name(channel) + " = " +
+                                    fields[channel] + ";")
+        result.lines.append("}")
+        return result
+
+    def scalar_type(self):
+        """
+        The most complex numerical type of the interface, see VarType1005.numerical_var_type_complexity.
+        It becomes Scalar in the templated functions.
+        """
+        scalar_type = VarType1005.infer_combined_var_type(self.input_spec + self.output_spec)
+        assert scalar_type is not None, "scalar template: need numerical inputs or outputs."
+        return scalar_type
+
+    @classmethod
+    def to_scalar_template(cls, lines: List[str], scalar_type: str, template_function_names: List[str] = ()):
+        """
+        Rewrite a function declaration or definition to template <typename Scalar>.
+        :param lines: the function, starts with its head.
+        :param scalar_type: example: double, replaced by Scalar everywhere.
+        :param template_function_names: functions called in the body that are templated as well,
+        they are called with explicit <Scalar>.
+        :return:
+        """
+        scalar_pattern = re.compile(r"\b%s\b" % scalar_type)
+        call_patterns = [(re.compile(r"\b%s\(" % name), name + "<%s>(" % cls._scalar_template_name)
+                         for name in template_function_names]
+        result = [cls._scalar_template_head]
+        for i in range(len(lines)):
+            line = scalar_pattern.sub(cls._scalar_template_name, lines[i])
+            # The first line is the head, where the function name is declared.
+            if i > 0:
+                for pattern, replacement in call_patterns:
+                    line = pattern.sub(replacement, line)
+            result.append(line)
+        return result
+
+    @classmethod
+    def scalar_instantiation(cls, head: List[str], scalar_type: str):
+        """
+        :param head: templated head or declaration, from to_scalar_template.
+        :param scalar_type: example: float
+        :return: explicit instantiation of the function with Scalar = scalar_type.
+        """
+        assert head[0] == cls._scalar_template_head
+        scalar_pattern = re.compile(r"\b%s\b" % cls._scalar_template_name)
+        result = ["template " + scalar_pattern.sub(scalar_type, head[1])]
+        result += [scalar_pattern.sub(scalar_type, line) for line in head[2:]]
+        if result[-1][-2:] == " {":
+            result[-1] = result[-1][:-2] + ";"
+        return result
+
+    def reduced_function_name(self, option: Option, channels: List[Tuple]):
+        """
+        Name of the variant that only provides channels, a subset of self.output_channels(option).
+        The same channels always lead to the same name.
+        """
+        digest = hashlib.md5(str(sorted(channels)).encode()).hexdigest()[:8]
+        return option.decorate(self.function_name) + "Reduced" + digest
+
+    def print_implementation_head(self, option: Option, channels: List[Tuple] = None, qualifier: str = ""):
+        """
+        :param option:
+        :param channels: if given, head of the reduced variant providing only these channels.
+        :param qualifier: example: "static "
+        :return:
+        """
+        if channels is None:
+            final_function_name = option.decorate(self.function_name)
+            channels = self.output_channels(option)
+        else:
+            final_function_name = self.reduced_function_name(option, channels)
         fields = []
         # inputs
         in_dim = len(self.input_spec)
         for i in range(in_dim):
             fields.append(VarType1005.const_reference(self.input_spec[i]) + ' ' + self.input_names[i])
+        fields += self.direction_fields(option)
         # outputs
-        for channel in self.output_channels(option):
+        for channel in channels:
             field_type = self.output_channel_type(channel)
             field_name = self.output_channel_name(channel)
             fields.append(field_type + "* " + field_name)
-        result = self._function_with_fields_to_lines(final_function_name, fields)
+        fields += self.jacobian_vector_fields(option)
+        fields += self.hessian_vector_fields(option)
+        result = self._function_with_fields_to_lines(final_function_name, fields, qualifier)
 
         if result[-1][-1] == ";":
             result[-1] = result[-1][:-1] + " {"
         return result
 
     @staticmethod
-    def _function_with_fields_to_lines(function_final_name: str, fields: List[str]):
+    def _function_with_fields_to_lines(function_final_name: str, fields: List[str], qualifier: str = ""):
         """
         :param function_final_name: The final name of the function
         :param fields: each element shown in separate line, comma free, can be /*???*/.
         each field MUST avoid extra space in the front.
+        :param qualifier: put before the return type, example: "static "
         :return:
         """
         result = []
 
         if not fields:
-            return ['void ' + function_final_name + "();"]
+            return [qualifier + 'void ' + function_final_name + "();"]
         elif len(fields) == 1:
-            return ['void %s(%s);' % (function_final_name, fields[0])]
+            return [qualifier + 'void %s(%s);' % (function_final_name, fields[0])]
 
         def is_comment_field(field: str):
             return field[:2] == "/*"
@@ -609,7 +1246,7 @@ class Header:
                 return field + ","
 
         # at least two fields
-        head = 'void ' + function_final_name + "("
+        head = qualifier + 'void ' + function_final_name + "("
         result.append(head + may_add_comma(0))
         var_spaces = " " * len(head)
 
@@ -620,18 +1257,33 @@ class Header:
 
         return result
 
-    def print_call(self, full_context: FullContext, prefix="") -> CallResult:
+    def print_call(self, full_context: FullContext, prefix="", channels: List[Tuple] = None) -> CallResult:
         """
         GongJuRen
         :param prefix: The calling prefix, for e.g.
         SomeNameSpace::Foo(...)
         :param full_context:
+        :param channels: if given, call the reduced variant providing only these channels.
+        see reduced_function_name.
         :return:
         """
+        assert not full_context.option.takes_direction(), \
+            "Functions are called with node options, see Option.node_option."
+        res, dbg = self.check_parameter_inputs(self.input_names, self.parameter_names,
+                                               full_context.context.input_variables)
+        assert res, dbg
+        if channels is None and full_context.config.buffer_interface:
+            return self._print_buffer_call(full_context, prefix)
+
         result = CallResult()
 
         # determine the interface
-        interface_output_channels = self.output_channels(full_context.option)
+        if channels is None:
+            interface_output_channels = self.output_channels(full_context.option)
+            final_function_name = full_context.option.decorate(self.function_name)
+        else:
+            interface_output_channels = channels
+            final_function_name = self.reduced_function_name(full_context.option, channels)
         output_channels_required_by_graph = set(full_context.required_output_channels())
         output_field_names = []
         # type to name
@@ -650,14 +1302,14 @@ class Header:
         for var_type, var_name in unused_variables.items():
             result.lines.append(Const1005.indent + var_type + " " + var_name + ";")
 
-        calling = Const1005.indent + prefix + full_context.option.decorate(self.function_name)
+        calling = Const1005.indent + prefix + final_function_name
 
         calling += "("
 
         # TODO(huaiyuan):split into multiple lines if possible
         # fill input graph vars.
         for i in range(len(full_context.context.input_variables)):
-            calling += full_context.context.input_variables[i].nick_name + ","
+            calling += full_context.context.input_variables[i].as_cpp_operand() + ","
 
         for out_name in output_field_names:
             calling += "&" + out_name + ","
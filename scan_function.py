@@ -0,0 +1,302 @@
+from t1005_graph import *
+
+
+class ScanFunction(FunctionBase):
+    """
+    Apply a step function a number of times, as a loop in c++.
+
+    The step function maps (carried_0, ..., carried_{n-1}, step_input_0, ..., step_input_{m-1})
+    to the next (carried_0, ..., carried_{n-1}).
+    The scan takes the initial carried values, then the step inputs of each step, step after step:
+    (carried_0, ..., carried_{n-1}, step 0 inputs, step 1 inputs, ...),
+    and gives the carried values after the last step.
+
+    The step function is printed once into a helper function, whatever the number of steps.
+    Derivatives are propagated through the steps by loops over the step derivatives.
+    """
+
+    def __init__(self, body: FunctionBase, num_steps: int, num_carried: int):
+        """
+        :param body: the step function, for e.g. a GraphFunction.
+        :param num_steps: how many times body is applied.
+        :param num_carried: number of the leading body inputs carried, the same as the number of body outputs.
+        """
+        assert num_steps > 0, "Scan takes at least one step."
+        assert len(body.output_spec) == num_carried, "Body outputs are the carried values."
+        assert len(body.input_spec) >= num_carried, "Body inputs start with the carried values."
+        assert all([var_type == 'double' for var_type in body.input_spec + body.output_spec]), \
+            "Scan supports double inputs and outputs only."
+
+        self.body = body
+        self.num_steps = num_steps
+        self.num_carried = num_carried
+        self.num_step_inputs = len(body.input_spec) - num_carried
+
+        input_spec = ['double'] * (num_carried + num_steps * self.num_step_inputs)
+        output_spec = ['double'] * num_carried
+        plain_options = {AllOptions.option_menu[name] for name in ["d0", "d1", "d2"]}
+        super(ScanFunction, self).__init__(input_spec, output_spec, body.dependencies,
+                                           plain_options.intersection(body.supported_options))
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        return {"body": function_id(self.body), "num_steps": self.num_steps, "num_carried": self.num_carried}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "ScanFunction":
+        return cls(functions[data["body"]], data["num_steps"], data["num_carried"])
+
+    def step_input_id(self, step: int, step_input: int):
+        """
+        :return: index of the step_input'th input of the step among the scan inputs.
+        """
+        return self.num_carried + step * self.num_step_inputs + step_input
+
+    def stages(self) -> List[int]:
+        """
+        :return: number of scan inputs of each stage: the initial carried values, then the inputs of each step.
+        Hessian blocks within a stage and between a stage and the next one are accumulated block by block,
+        see print_call.
+        """
+        return [self.num_carried] + [self.num_step_inputs] * (self.num_steps if self.num_step_inputs > 0 else 0)
+
+    def stage_of_input(self, in_idx: int) -> int:
+        """
+        :return: stage of the in_idx'th scan input, see stages.
+        """
+        if in_idx < self.num_carried:
+            return 0
+        return 1 + (in_idx - self.num_carried) // self.num_step_inputs
+
+    def stage_input_id(self, stage: int) -> int:
+        """
+        :return: index of the first input of stage among the scan inputs.
+        """
+        return 0 if stage == 0 else self.step_input_id(stage - 1, 0)
+
+    def _print_body(self, option: Option, config: CodegenConfig) -> Tuple[FullContext, CallResult]:
+        """
+        Print the body into a helper function, with all channels of option.
+        The helper takes the body inputs, then its non-constant output channels by reference.
+        :return: full context of the canonical variables, the call result of the helper on them,
+        see Graph._move_into_helper.
+        """
+        graph = Graph(name="scan_body")
+        arguments = [graph.state_inputs(["input_%d" % i, ], var_type)
+                     for i, var_type in zip(range(len(self.body.input_spec)), self.body.input_spec)]
+        output_variables = []
+        for i in range(self.num_carried):
+            output_variable = graph.create_new_variable("result_%d" % i)
+            output_variable.defined_as_expr(self.body, arguments, i, self.body.output_spec[i])
+            output_variables.append(output_variable)
+
+        body_full_context = FullContext(Context(arguments, output_variables), option, None, config)
+        body_call_result = self.body.print_call(body_full_context)
+        return body_full_context, Graph._move_into_helper(body_full_context, body_call_result, "ScanStep", "inline ")
+
+    def print_call(self, full_context: FullContext) -> CallResult:
+        res, dbg = self.is_compatible(full_context.context)
+        assert res, dbg
+        option = full_context.option
+        assert not option.takes_direction() and not option.enable_gauss_newton_hessian(), \
+            "Scan provides plain derivatives only."
+        body_option = Option(option.enable_1st_order_derivative(), option.enable_2nd_order_derivative())
+
+        num_steps = self.num_steps
+        num_carried = self.num_carried
+        num_step_inputs = self.num_step_inputs
+        num_body_inputs = num_carried + num_step_inputs
+        in_dim = len(full_context.context.input_variables)
+        # Arrays of no step input are not valid c++.
+        step_input_size = max(num_step_inputs, 1)
+
+        body_full_context, body_result = self._print_body(body_option, full_context.config)
+        helper_name = body_result.lines[0].split("(")[0]
+
+        result = CallResult()
+        result.definitions.merge(body_result.definitions)
+        result.sweep_count = body_result.sweep_count
+        result.multiply_count = body_result.multiply_count
+        lines = result.lines
+
+        def append_line(line: str, indent_num: int):
+            lines.append(Const1005.indent * indent_num + line)
+
+        def array_of_channel(channel: Tuple, step: str):
+            if len(channel) == 1:
+                return "SCAN_S[%s + 1][%d]" % (step, channel[0])
+            elif len(channel) == 2:
+                return "SCAN_J[%s][%d][%d]" % (step, channel[0], channel[1])
+            else:
+                return "SCAN_H[%s][%d][%d][%d]" % (step, channel[0], channel[1], channel[2])
+
+        input_variables = full_context.context.input_variables
+        append_line("{", 0)
+        append_line("// Scan of %d steps." % num_steps, 1)
+        append_line("double SCAN_S[%d][%d];" % (num_steps + 1, num_carried), 1)
+        if num_step_inputs > 0:
+            append_line("const double SCAN_X[%d][%d] = {" % (num_steps, step_input_size), 1)
+            for t in range(num_steps):
+                operands = [input_variables[self.step_input_id(t, j)].as_cpp_operand() for j in range(num_step_inputs)]
+                append_line("{" + ", ".join(operands) + "}" + ("," if t < num_steps - 1 else ""), 2)
+            append_line("};", 1)
+        if option.enable_1st_order_derivative():
+            append_line("double SCAN_J[%d][%d][%d];" % (num_steps, num_carried, num_body_inputs), 1)
+        if option.enable_2nd_order_derivative():
+            append_line("double SCAN_H[%d][%d][%d][%d];" % (num_steps, num_carried, num_body_inputs, num_body_inputs),
+                        1)
+        for c in range(num_carried):
+            append_line("SCAN_S[0][%d] = %s;" % (c, input_variables[c].as_cpp_operand()), 1)
+
+        # Forward, the values and the derivatives of each step.
+        append_line("for (int t = 0; t < %d; ++t) {" % num_steps, 1)
+        arguments = ["SCAN_S[t][%d]" % c for c in range(num_carried)] + \
+                    ["SCAN_X[t][%d]" % j for j in range(num_step_inputs)]
+        for channel in body_full_context.required_output_channels():
+            if channel not in body_result.constant_output_channels:
+                arguments.append(array_of_channel(channel, "t"))
+        append_line(helper_name + "(" + ", ".join(arguments) + ");", 2)
+        for channel in body_full_context.required_output_channels():
+            if channel in body_result.constant_output_channels:
+                append_line("%s = %s;" % (array_of_channel(channel, "t"),
+                                          repr(float(body_result.constant_output_channels[channel]))), 2)
+        for out_idx, in_idx_1, in_idx_2 in body_full_context.second_order_channels:
+            if in_idx_1 != in_idx_2:
+                append_line("%s = %s;" % (array_of_channel((out_idx, in_idx_2, in_idx_1), "t"),
+                                          array_of_channel((out_idx, in_idx_1, in_idx_2), "t")), 2)
+        append_line("}", 1)
+
+        for channel in full_context.zero_order_channels:
+            append_line("%s = SCAN_S[%d][%d];" % (full_context.output_channel_name(channel), num_steps, channel[0]), 1)
+
+        def in_channel_of(in_idx: int):
+            # in_idx among the scan inputs, as (array, step, index among step inputs).
+            if in_idx < num_carried:
+                return "SCAN_L[0][%d]" % in_idx
+            step, j = divmod(in_idx - num_carried, num_step_inputs)
+            return "SCAN_DX[%d][%d]" % (step, j)
+
+        for out_idx in range(num_carried):
+            first_order_channels = [channel for channel in full_context.first_order_channels
+                                    if channel[0] == out_idx]
+            second_order_channels = [channel for channel in full_context.second_order_channels
+                                     if channel[0] == out_idx]
+            if not first_order_channels and not second_order_channels:
+                continue
+            result.sweep_count += 1
+            append_line("{", 1)
+            # Reverse, the derivatives of the output on the carried values and the step inputs of each step.
+            append_line("double SCAN_L[%d][%d];" % (num_steps + 1, num_carried), 2)
+            append_line("double SCAN_DX[%d][%d];" % (num_steps, step_input_size), 2)
+            for c in range(num_carried):
+                append_line("SCAN_L[%d][%d] = %s;" % (num_steps, c, "1.0" if c == out_idx else "0.0"), 2)
+            append_line("for (int t = %d; t >= 0; --t) {" % (num_steps - 1), 2)
+            append_line("for (int i = 0; i < %d; ++i) {" % num_body_inputs, 3)
+            append_line("double value = 0.0;", 4)
+            append_line("for (int c = 0; c < %d; ++c) {" % num_carried, 4)
+            append_line("value += SCAN_L[t + 1][c] * SCAN_J[t][c][i];", 5)
+            append_line("}", 4)
+            append_line("if (i < %d) {" % num_carried, 4)
+            append_line("SCAN_L[t][i] = value;", 5)
+            append_line("} else {", 4)
+            append_line("SCAN_DX[t][i - %d] = value;" % num_carried, 5)
+            append_line("}", 4)
+            append_line("}", 3)
+            append_line("}", 2)
+            for channel in first_order_channels:
+                append_line("%s = %s;" % (full_context.output_channel_name(channel), in_channel_of(channel[1])), 2)
+
+            if second_order_channels:
+                result.sweep_count += 1
+                # Channels within a stage or between a stage and the next one only need the blocks in band,
+                # linear in the number of steps.
+                in_band = num_step_inputs > 0 and \
+                    all([self.stage_of_input(channel[2]) - self.stage_of_input(channel[1]) <= 1
+                         for channel in second_order_channels])
+                num_stages = len(self.stages())
+                block_size = max(num_carried, num_step_inputs)
+                # Forward, the derivatives W of the step inputs on the scan inputs,
+                # the hessian of the output gets W^T * (sum_c SCAN_L[t + 1][c] * SCAN_H[t][c]) * W of each step.
+                if in_band:
+                    append_line("double SCAN_HD[%d][%d][%d] = {};" % (num_stages, block_size, block_size), 2)
+                    append_line("double SCAN_HO[%d][%d][%d] = {};" % (num_stages - 1, block_size, num_step_inputs),
+                                2)
+                else:
+                    append_line("double SCAN_HZ[%d][%d] = {};" % (in_dim, in_dim), 2)
+                append_line("double SCAN_G[%d][%d] = {};" % (num_carried, in_dim), 2)
+                for c in range(num_carried):
+                    append_line("SCAN_G[%d][%d] = 1.0;" % (c, c), 2)
+                append_line("for (int t = 0; t < %d; ++t) {" % num_steps, 2)
+                append_line("// Scan inputs before the end of step t.", 3)
+                append_line("const int cols = %d + (t + 1) * %d;" % (num_carried, num_step_inputs), 3)
+                append_line("double SCAN_W[%d][%d] = {};" % (num_body_inputs, in_dim), 3)
+                append_line("for (int p = 0; p < %d; ++p) {" % num_carried, 3)
+                append_line("for (int a = 0; a < cols; ++a) {", 4)
+                append_line("SCAN_W[p][a] = SCAN_G[p][a];", 5)
+                append_line("}", 4)
+                append_line("}", 3)
+                append_line("for (int j = 0; j < %d; ++j) {" % num_step_inputs, 3)
+                append_line("SCAN_W[%d + j][%d + t * %d + j] = 1.0;" % (num_carried, num_carried, num_step_inputs), 4)
+                append_line("}", 3)
+                append_line("double SCAN_KW[%d][%d] = {};" % (num_body_inputs, in_dim), 3)
+                append_line("for (int p = 0; p < %d; ++p) {" % num_body_inputs, 3)
+                append_line("for (int q = 0; q < %d; ++q) {" % num_body_inputs, 4)
+                append_line("double k = 0.0;", 5)
+                append_line("for (int c = 0; c < %d; ++c) {" % num_carried, 5)
+                append_line("k += SCAN_L[t + 1][c] * SCAN_H[t][c][p][q];", 6)
+                append_line("}", 5)
+                append_line("for (int b = 0; b < cols; ++b) {", 5)
+                append_line("SCAN_KW[p][b] += k * SCAN_W[q][b];", 6)
+                append_line("}", 5)
+                append_line("}", 4)
+                append_line("}", 3)
+                if in_band:
+                    append_line("// The blocks of the stages before the end of step t, see stages.", 3)
+                    append_line("for (int s = 0; s < t + 2; ++s) {", 3)
+                    append_line("const int o = s == 0 ? 0 : %d + (s - 1) * %d;" % (num_carried, num_step_inputs), 4)
+                    append_line("const int n = s == 0 ? %d : %d;" % (num_carried, num_step_inputs), 4)
+                    append_line("for (int a = 0; a < n; ++a) {", 4)
+                    append_line("for (int b = a; b < n; ++b) {", 5)
+                    append_line("for (int p = 0; p < %d; ++p) {" % num_body_inputs, 6)
+                    append_line("SCAN_HD[s][a][b] += SCAN_W[p][o + a] * SCAN_KW[p][o + b];", 7)
+                    append_line("}", 6)
+                    append_line("}", 5)
+                    append_line("if (s < t + 1) {", 5)
+                    append_line("for (int b = 0; b < %d; ++b) {" % num_step_inputs, 6)
+                    append_line("for (int p = 0; p < %d; ++p) {" % num_body_inputs, 7)
+                    append_line("SCAN_HO[s][a][b] += SCAN_W[p][o + a] * SCAN_KW[p][o + n + b];", 8)
+                    append_line("}", 7)
+                    append_line("}", 6)
+                    append_line("}", 5)
+                    append_line("}", 4)
+                    append_line("}", 3)
+                else:
+                    append_line("for (int a = 0; a < cols; ++a) {", 3)
+                    append_line("for (int b = a; b < cols; ++b) {", 4)
+                    append_line("for (int p = 0; p < %d; ++p) {" % num_body_inputs, 5)
+                    append_line("SCAN_HZ[a][b] += SCAN_W[p][a] * SCAN_KW[p][b];", 6)
+                    append_line("}", 5)
+                    append_line("}", 4)
+                    append_line("}", 3)
+                append_line("for (int c = 0; c < %d; ++c) {" % num_carried, 3)
+                append_line("for (int a = 0; a < cols; ++a) {", 4)
+                append_line("double g = 0.0;", 5)
+                append_line("for (int p = 0; p < %d; ++p) {" % num_body_inputs, 5)
+                append_line("g += SCAN_J[t][c][p] * SCAN_W[p][a];", 6)
+                append_line("}", 5)
+                append_line("SCAN_G[c][a] = g;", 5)
+                append_line("}", 4)
+                append_line("}", 3)
+                append_line("}", 2)
+                for channel in second_order_channels:
+                    _, in_idx_1, in_idx_2 = channel
+                    if not in_band:
+                        value = "SCAN_HZ[%d][%d]" % (in_idx_1, in_idx_2)
+                    else:
+                        stage_1, stage_2 = self.stage_of_input(in_idx_1), self.stage_of_input(in_idx_2)
+                        value = "%s[%d][%d][%d]" % ("SCAN_HD" if stage_1 == stage_2 else "SCAN_HO", stage_1,
+                                                    in_idx_1 - self.stage_input_id(stage_1),
+                                                    in_idx_2 - self.stage_input_id(stage_2))
+                    append_line("%s = %s;" % (full_context.output_channel_name(channel), value), 2)
+            append_line("}", 1)
+        append_line("}", 0)
+        return result
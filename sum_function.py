@@ -0,0 +1,84 @@
+from t1005_graph import *
+
+
+class SumFunction(FunctionBase):
+    """
+    The weighted sum of its inputs: w_0 * x_0 + w_1 * x_1 + ...
+    All derivatives are constant: D_{out}_D_{x_i} = w_i, and 0 for the 2nd order ones.
+    Graphs fold them at code generation time, so summing n terms prints a single statement.
+    Graphs don't even list the 2nd order ones, see zero_second_order_derivatives.
+    """
+
+    # Terms per line of the printed sum.
+    terms_per_line = 8
+
+    def __init__(self, num_terms: int, weights: List[float] = None):
+        """
+        :param num_terms:
+        :param weights: 1 for each term if not given.
+        """
+        assert num_terms > 0, "Sum takes at least one term."
+        assert weights is None or len(weights) == num_terms, "One weight for each term."
+        self.weights = [1.0] * num_terms if weights is None else [float(weight) for weight in weights]
+
+        super(SumFunction, self).__init__([''] * num_terms, [''])
+
+    def is_compatible(self, context: Context) -> Tuple[bool, str]:
+        res, dbg = super(SumFunction, self).is_compatible(context)
+
+        if not res:
+            return res, dbg
+
+        if not all([VarType1005.is_numerical_var_type(input_var.var_type) for input_var in context.input_variables]):
+            return False, "SumFunction input variables must be numerical."
+
+        return True, ""
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        return {"weights": self.weights}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "SumFunction":
+        return cls(len(data["weights"]), data["weights"])
+
+    def zero_second_order_derivatives(self) -> bool:
+        return True
+
+    def evaluate(self, *args) -> Tuple:
+        return sum([weight * value for weight, value in zip(self.weights, args)]),
+
+    def print_call(self, full_context: FullContext) -> CallResult:
+        res, dbg = self.is_compatible(full_context.context)
+        assert res, dbg
+
+        result = CallResult()
+        for channel in full_context.first_order_channels:
+            result.constant_output_channels[channel] = self.weights[channel[1]]
+        for channel in full_context.second_order_channels:
+            result.constant_output_channels[channel] = 0.0
+
+        terms = []
+        for weight, input_variable in zip(self.weights, full_context.context.input_variables):
+            if weight == 0:
+                continue
+            operand = input_variable.as_cpp_operand()
+            terms.append(operand if weight == 1 else "(%s) * %s" % (repr(weight), operand))
+        if not terms:
+            terms.append("0.0")
+
+        for channel in full_context.zero_order_channels:
+            name = full_context.output_channel_name(channel)
+            for i in range(0, len(terms), self.terms_per_line):
+                front = name + " = " if i == 0 else Const1005.indent * 2
+                back = ";" if i + self.terms_per_line >= len(terms) else " +"
+                result.lines.append(front + " + ".join(terms[i:i + self.terms_per_line]) + back)
+        return result
+
+
+def weighted_sum(terms: List[Variable], weights: List[float] = None) -> Variable:
+    """
+    :param terms: variables of the same graph, or numbers.
+    :param weights: 1 for each term if not given.
+    :return: the variable of the weighted sum of terms, see SumFunction.
+    """
+    return SumFunction(len(terms), weights)(*terms)
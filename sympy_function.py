@@ -15,6 +15,64 @@ class OptimizedCXX11Printer(CXX11CodePrinter):
     pass
 
 
+class EigenArrayPrinter(OptimizedCXX11Printer):
+    """
+    Prints element-wise expressions on Eigen arrays.
+    Sub expressions free of array symbols stay scalar, printed as usual.
+    """
+
+    # From sympy function to Eigen array function.
+    _array_functions = {"Abs": "abs", "sign": "sign", "exp": "exp", "log": "log",
+                        "sin": "sin", "cos": "cos", "tan": "tan", "asin": "asin", "acos": "acos", "atan": "atan",
+                        "sinh": "sinh", "cosh": "cosh", "tanh": "tanh",
+                        "asinh": "asinh", "acosh": "acosh", "atanh": "atanh",
+                        "floor": "floor", "ceiling": "ceil", "erf": "erf", "erfc": "erfc",
+                        "loggamma": "lgamma", "gamma": "tgamma"}
+
+    def __init__(self, array_symbols: Set[sp.Symbol]):
+        super(EigenArrayPrinter, self).__init__()
+        self.array_symbols = set(array_symbols)
+
+    def is_array(self, expr) -> bool:
+        return len(sp.sympify(expr).free_symbols & self.array_symbols) > 0
+
+    def _print(self, expr, **kwargs) -> str:
+        if not isinstance(expr, sp.Basic) or not self.is_array(expr):
+            return super(EigenArrayPrinter, self)._print(expr, **kwargs)
+
+        if isinstance(expr, (sp.Max, sp.Min)):
+            # Coefficient-wise max/min are member functions of the array operand.
+            array_args = [arg for arg in expr.args if self.is_array(arg)]
+            other_args = [arg for arg in expr.args if not self.is_array(arg)]
+            member = "max" if isinstance(expr, sp.Max) else "min"
+            result = "(%s)" % self._print(array_args[0])
+            for arg in array_args[1:] + other_args:
+                result = "%s.%s(%s)" % (result, member, self._print(arg))
+            return result
+
+        if isinstance(expr, sp.Function):
+            name = type(expr).__name__
+            assert name in self._array_functions, "%s is not supported on Eigen arrays." % name
+            return "Eigen::%s(%s)" % (self._array_functions[name], ", ".join([self._print(arg) for arg in expr.args]))
+
+        return super(EigenArrayPrinter, self)._print(expr, **kwargs)
+
+    def _print_Pow(self, expr):
+        if not self.is_array(expr):
+            return super(EigenArrayPrinter, self)._print_Pow(expr)
+        if expr.exp == 2:
+            return "(%s).square()" % self._print(expr.base)
+        if expr.exp == 3:
+            return "(%s).cube()" % self._print(expr.base)
+        if expr.exp == -1:
+            return "(%s).inverse()" % self._print(expr.base)
+        if expr.exp == sp.S.Half:
+            return "Eigen::sqrt(%s)" % self._print(expr.base)
+        if expr.exp.is_Number:
+            return "Eigen::pow(%s, %s)" % (self._print(expr.base), self._print(sp.Float(expr.exp)))
+        return "Eigen::pow(%s, %s)" % (self._print(expr.base), self._print(expr.exp))
+
+
 class SymPyFunction(FunctionBase):
     def __init__(self, sympy_function, output_dim_override=None, input_dim_override=None):
         # infer the number of sympy function inputs.
@@ -47,6 +105,36 @@ class SymPyFunction(FunctionBase):
         super(SymPyFunction, self).__init__(input_spec, output_spec)
         self.sympy_function = sympy_function
 
+    # Symbols the inputs are serialized as, see to_dict.
+    _serialized_input_prefix = Const1005.sympy_var_prefix + "_input_"
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        """
+        The output expressions in srepr form, on symbols standing for the inputs.
+        """
+        input_symbols = [sp.Symbol(self._serialized_input_prefix + "%d" % i) for i in range(len(self.input_spec))]
+        outputs = self.sympy_function(*input_symbols)
+        if type(outputs) is not tuple and type(outputs) is not list:
+            outputs = (outputs,)
+        return {"input_dim": len(self.input_spec), "exprs": [sp.srepr(sp.sympify(output)) for output in outputs]}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "SymPyFunction":
+        """
+        Expressions are parsed on first use, loading a graph doesn't pay for functions never printed nor evaluated.
+        """
+        input_symbols = [sp.Symbol(cls._serialized_input_prefix + "%d" % i) for i in range(data["input_dim"])]
+        exprs = []
+
+        def sympy_function(*args):
+            if not exprs:
+                exprs.extend([sp.sympify(expr) for expr in data["exprs"]])
+            values = dict(zip(input_symbols, [sp.sympify(arg) for arg in args]))
+            outputs = [expr.xreplace(values) for expr in exprs]
+            return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+        return cls(sympy_function, output_dim_override=len(data["exprs"]), input_dim_override=data["input_dim"])
+
     def is_compatible(self, context: Context) -> Tuple[bool, str]:
         res, dbg = super(SymPyFunction, self).is_compatible(context)
 
@@ -61,6 +149,19 @@ class SymPyFunction(FunctionBase):
 
         return True, ""
 
+    def evaluate(self, *args) -> Tuple:
+        outputs = self.sympy_function(*args)
+        if type(outputs) is not tuple and type(outputs) is not list:
+            outputs = (outputs,)
+
+        values = []
+        for output in outputs:
+            output = sp.sympify(output)
+            if not output.is_Number:
+                return None
+            values.append(float(output))
+        return tuple(values)
+
     def print_call(self, full_context: FullContext) -> CallResult:
         res, dbg = self.is_compatible(full_context.context)
         assert res, dbg
@@ -101,6 +202,10 @@ class SymPyFunction(FunctionBase):
             elif len(channel) == 2:
                 expr = zero_order_output_exprs[channel[0]].diff(input_symbols[channel[1]])
                 is_constant_derivative_output = expr.is_Number
+            elif len(channel) == 3 and full_context.option.enable_gauss_newton_hessian():
+                expr = zero_order_output_exprs[channel[0]].diff(input_symbols[channel[1]]) * \
+                       zero_order_output_exprs[channel[0]].diff(input_symbols[channel[2]])
+                is_constant_derivative_output = expr.is_Number
             elif len(channel) == 3:
                 expr = (zero_order_output_exprs[channel[0]].diff(input_symbols[channel[1]])).diff(
                     input_symbols[channel[2]])
@@ -135,18 +240,61 @@ class SymPyFunction(FunctionBase):
 
         # calculation steps
         result.lines.append("{")
-        for replacement in replacements:
-            this_line = printer.doprint(replacement[1], sympy_local_var_type + ' ' + str(replacement[0])).replace('\n',
-                                                                                                                  '')
-            result.lines.append(Const1005.indent + this_line)
-        # assign outputs
-        for i in range(len(reduced_exprs)):
-            this_line = printer.doprint(reduced_exprs[i], result_names[i])
-            result.lines.append(Const1005.indent + this_line)
+        if sympy_local_var_type in VarType1005.eigen_array_var_types:
+            result.lines += self._print_array_steps(full_context, sympy_local_var_type, input_symbols,
+                                                    replacements, reduced_exprs, result_names, result_types)
+        else:
+            for replacement in replacements:
+                this_line = printer.doprint(replacement[1],
+                                            sympy_local_var_type + ' ' + str(replacement[0])).replace('\n', '')
+                result.lines.append(Const1005.indent + this_line)
+            # assign outputs
+            for i in range(len(reduced_exprs)):
+                this_line = printer.doprint(reduced_exprs[i], result_names[i])
+                result.lines.append(Const1005.indent + this_line)
         result.lines.append("}")
 
         return result
 
+    @staticmethod
+    def _print_array_steps(full_context: FullContext,
+                           array_type: str,
+                           input_symbols: List,
+                           replacements: List[Tuple],
+                           reduced_exprs: List,
+                           result_names: List[str],
+                           result_types: List[str]) -> List[str]:
+        """
+        Calculation steps as element-wise Eigen array expressions.
+        Steps not depending on any array input are scalar. They are broadcast when assigned to an array.
+        """
+        array_symbols = set()
+        size_reference = None
+        for input_variable, input_symbol in zip(full_context.context.input_variables, input_symbols):
+            if input_variable.var_type == array_type and isinstance(input_symbol, sp.Symbol):
+                array_symbols.add(input_symbol)
+                if size_reference is None:
+                    size_reference = input_variable.nick_name
+        printer = EigenArrayPrinter(array_symbols)
+
+        lines = []
+        for symbol, expr in replacements:
+            if printer.is_array(expr):
+                local_var_type = array_type
+                printer.array_symbols.add(symbol)
+            else:
+                local_var_type = VarType1005.default_var_type
+            lines.append(Const1005.indent + local_var_type + ' ' + str(symbol) + ' = ' +
+                         printer.doprint(expr).replace('\n', '') + ';')
+
+        for expr, name, var_type in zip(reduced_exprs, result_names, result_types):
+            value = printer.doprint(expr).replace('\n', '')
+            if var_type == array_type and not printer.is_array(expr):
+                assert size_reference is not None, "Can't infer the size of array output: " + name
+                value = "%s::Constant(%s.size(), %s)" % (array_type, size_reference, value)
+            lines.append(Const1005.indent + name + ' = ' + value + ';')
+        return lines
+
 
 class _SymPyOperatorFunctions:
     sympy_add = SymPyFunction(lambda a, b: a + b)
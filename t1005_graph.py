@@ -1,10 +1,11 @@
-from typing import List, Tuple, Dict, Set, Any
+from typing import List, Tuple, Dict, Set, Any, Callable
 import sympy as sp
 from cpp_library import UserLibrary, CppLibrary
 from sympy.printing.cxx import CXX11CodePrinter
 from common import *
+import hashlib
 
-from t1005_option import Option, AllOptions
+from t1005_option import Option, AllOptions, CodegenConfig
 
 
 class Variable:
@@ -31,6 +32,10 @@ class Variable:
     TYPE_CONFIG_EXPR = 4
     TYPE_CONSTANT_EXPR = 5
 
+    # Graphs may hold millions of variables, no per-instance __dict__.
+    # value of constants, function, inputs and output_channel of expressions are set on definition.
+    __slots__ = ('name', 'nick_name', 'graph', 'var_type', 'type', 'value', 'function', 'inputs', 'output_channel')
+
     def __init__(self, name: str, nick_name: str, graph: "Graph"):
         self.name = name
         self.nick_name = nick_name
@@ -42,6 +47,14 @@ class Variable:
     def is_differentiable(self):
         return self.type in [self.TYPE_STATE_EXPR, self.TYPE_STATE_INPUT]
 
+    def as_cpp_operand(self):
+        """
+        How the variable appears in c++: constants by value, others by name.
+        """
+        if self.type is self.TYPE_CONSTANT:
+            return repr(float(self.value))
+        return self.nick_name
+
     def set_name(self, name: str):
         res, dbg = self.graph.re_name(self.nick_name, name)
         assert res, dbg
@@ -81,7 +94,7 @@ class Variable:
                         var_type: str = 'double'):
         """
         :param function:
-        :param inputs:
+        :param inputs: kept as is, shared by the outputs and the context of the same call, not to be modified.
         :param output_channel:
         :param var_type:
         :return:
@@ -99,7 +112,7 @@ class Variable:
             output_type = Variable.TYPE_CONSTANT_EXPR
 
         self.function = function
-        self.inputs = inputs.copy()
+        self.inputs = inputs
         self.output_channel = output_channel
         self.type = output_type
         self.var_type = var_type
@@ -144,16 +157,43 @@ class Context:
     For how to call the function, it depends on the class.
     """
 
+    __slots__ = ('input_variables', 'output_variables')
+
     def __init__(self, inputs: List[Variable], outputs: List[Variable]):
         self.input_variables = inputs
         self.output_variables = outputs
 
 
 class FullContext:
+    __slots__ = ('context', 'option', 'wanted_channels', 'config', 'input_channel_ids',
+                 'zero_order_channels', 'first_order_channels', 'second_order_channels',
+                 'non_required_channels', 'unwanted_channels',
+                 'direction_input_ids', 'hessian_vector_channels', 'jacobian_vector_channels')
+
     def __init__(self, context: Context,
-                 option: Option):
+                 option: Option,
+                 wanted_channels: Set[Tuple] = None,
+                 config: CodegenConfig = None,
+                 input_channel_ids: List[int] = None):
+        """
+        :param context:
+        :param option:
+        :param wanted_channels: if given, only these channels (of those the option provides)
+        are required. The others are simply not asked for, they are NOT taken as zero.
+        :param config: how to print, passed on to the nodes of a graph.
+        :param input_channel_ids: ids of the inputs in channel names, when the context
+        stands for part of the inputs of another one.
+        """
         self.context = context
         self.option = option
+        requested_channels = option.requested_channels()
+        if requested_channels is not None:
+            wanted_channels = requested_channels if wanted_channels is None else \
+                wanted_channels.intersection(requested_channels)
+        self.wanted_channels = wanted_channels
+        self.config = CodegenConfig() if config is None else config
+        self.input_channel_ids = list(range(len(context.input_variables))) \
+            if input_channel_ids is None else input_channel_ids
         # and other options maybe
 
         self.zero_order_channels: List[Tuple[int]] = []
@@ -161,8 +201,24 @@ class FullContext:
         self.second_order_channels: List[Tuple[int, int, int]] = []
 
         self.non_required_channels: List[Tuple] = []
+        self.unwanted_channels: List[Tuple] = []
         self._init_output_channels()
 
+        # Inputs taking a direction, and channels along it:
+        # (out, in) of HV_{out}_D_{in}, (out,) of JV_{out}.
+        self.direction_input_ids: List[int] = []
+        self.hessian_vector_channels: List[Tuple[int, int]] = []
+        self.jacobian_vector_channels: List[Tuple[int]] = []
+        if self.option.takes_direction():
+            self.direction_input_ids = [j for j in range(len(context.input_variables))
+                                        if context.input_variables[j].is_differentiable()]
+        for i in range(len(context.output_variables)):
+            for j in self.direction_input_ids:
+                if self.option.enable_hessian_vector_product():
+                    self.hessian_vector_channels.append((i, j))
+            if self.direction_input_ids and self.option.enable_jacobian_vector_product():
+                self.jacobian_vector_channels.append((i,))
+
     def _init_output_channels(self):
         """
         keep only the differentiable output channels
@@ -193,6 +249,8 @@ class FullContext:
 
             if should_avoid_channel:
                 self.non_required_channels.append(channel)
+            elif self.wanted_channels is not None and channel not in self.wanted_channels:
+                self.unwanted_channels.append(channel)
             else:
                 if len(channel) == 1:
                     self.zero_order_channels.append(channel)
@@ -216,7 +274,7 @@ class FullContext:
         assert len(channel) in {1, 2, 3}
         if len(channel) > 1:
             ch_names = [self.context.output_variables[channel[0]].nick_name] + \
-                       ["%s%d" % (Const1005.input_channel_short, i) for i in channel[1:]]
+                       ["%s%d" % (Const1005.input_channel_short, self.input_channel_ids[i]) for i in channel[1:]]
             return Const1005.node_derivative_prefix + get_channel_name(tuple(ch_names))
         else:
             return self.context.output_variables[channel[0]].nick_name
@@ -225,17 +283,54 @@ class FullContext:
         assert len(channel) > 0
         return self.context.output_variables[channel[0]].var_type
 
+    def direction_operand(self, in_idx: int):
+        """
+        The direction of the input, under hessian vector product option.
+        """
+        return Const1005.direction_prefix + self.context.input_variables[in_idx].nick_name
+
+    def hessian_vector_channel_name(self, channel: Tuple[int, int]):
+        out_name = self.context.output_variables[channel[0]].nick_name
+        in_name = "%s%d" % (Const1005.input_channel_short, self.input_channel_ids[channel[1]])
+        return Const1005.node_derivative_prefix + Const1005.hessian_vector_prefix + "%s_D_%s" % (out_name, in_name)
 
-class CallResult:
-    def __init__(self):
-        self.lines: List[str] = []
-        self.constant_output_channels: Dict[Tuple, float] = {}
+    def jacobian_vector_channel_name(self, channel: Tuple[int]):
+        return Const1005.node_derivative_prefix + Const1005.jacobian_vector_prefix + \
+               self.context.output_variables[channel[0]].nick_name
 
 
 class DefinitionResult:
     def __init__(self):
         self.function_names_to_lines: Dict[str, List[str]] = {}
 
+    def merge(self, other: "DefinitionResult"):
+        """
+        Definitions are identified by function name, the first one is kept.
+        """
+        for name, lines in other.function_names_to_lines.items():
+            if name not in self.function_names_to_lines:
+                self.function_names_to_lines[name] = lines
+
+
+class CallResult:
+    __slots__ = ('lines', 'constant_output_channels', 'constant_hessian_vector_channels',
+                 'constant_jacobian_vector_channels', 'definitions', 'outlined_line_count',
+                 'sweep_count', 'multiply_count')
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.constant_output_channels: Dict[Tuple, float] = {}
+        # Of full_context.hessian_vector_channels and full_context.jacobian_vector_channels.
+        self.constant_hessian_vector_channels: Dict[Tuple, float] = {}
+        self.constant_jacobian_vector_channels: Dict[Tuple, float] = {}
+        # Helper functions the lines rely on, to be defined before the caller.
+        self.definitions = DefinitionResult()
+        # Number of lines moved into helper functions by outlining.
+        self.outlined_line_count = 0
+        # Number of derivative propagation passes over the graph, and multiplies printed by them.
+        self.sweep_count = 0
+        self.multiply_count = 0
+
 
 class FunctionBase:
     """
@@ -291,27 +386,43 @@ class FunctionBase:
                 unnamed_variable.defined_as_constant(element, var_type)
                 input_variables.append(unnamed_variable)
 
-        # Create output variables
-        output_variables: List[Variable] = []
+        output_var_types = []
         for i in range(len(self.output_spec)):
             var_type = inferred_var_type if self.output_spec[i] == '' else self.output_spec[i]
             assert var_type is not None, "Function with no numerical input can't have unspecified output type."
+            output_var_types.append(var_type)
+
+        output_variables = self.append_call(graph, input_variables, output_var_types)
+
+        if len(output_variables) > 1:
+            return tuple(output_variables)
+        else:
+            return output_variables[0]
+
+    def append_call(self, graph: "Graph", input_variables: List[Variable], output_var_types: List[str],
+                    check_compatibility=True) -> List[Variable]:
+        """
+        Create the output variables of the function applied on input_variables, and inform graph the operation.
+        :param check_compatibility: False if the caller knows the call is compatible,
+        for e.g. from a call on variables of the same types, see VariableArray.
+        :return: output variables
+        """
+        # Create output variables
+        output_variables: List[Variable] = []
+        for i in range(len(output_var_types)):
             output_variable = graph.create_un_named_variable()
-            output_variable.defined_as_expr(self, input_variables, i, var_type)
+            output_variable.defined_as_expr(self, input_variables, i, output_var_types[i])
             output_variables.append(output_variable)
 
         # check the context compatibility
         context = Context(input_variables, output_variables)
-        res, dbg = self.is_compatible(context)
-        assert res, dbg
+        if check_compatibility:
+            res, dbg = self.is_compatible(context)
+            assert res, dbg
 
         # Inform graph the operation.
-        graph.append_operation(self, context)
-
-        if len(output_variables) > 1:
-            return tuple(output_variables)
-        else:
-            return output_variables[0]
+        graph.append_operation(self, context, compatibility_checked=True)
+        return output_variables
 
     def is_compatible(self, context: Context) -> Tuple[bool, str]:
         """
@@ -394,6 +505,42 @@ class FunctionBase:
         """
         return None
 
+    def header_function_name(self) -> str:
+        """
+        The function name of optional_header, None without header.
+        """
+        header = self.optional_header()
+        return None if header is None else header.function_name
+
+    def evaluate(self, *args) -> Tuple:
+        """
+        Evaluate the function on numbers at code generation time.
+        :param args: numbers
+        :return: tuple of numbers, one for each output. None if not possible.
+        """
+        return None
+
+    def inline_body(self) -> "GraphFunction":
+        """
+        return the graph function computing the same, if the function can be inlined as a graph.
+        """
+        return None
+
+    def zero_second_order_derivatives(self) -> bool:
+        """
+        Whether all 2nd order derivatives are structurally zero, for e.g. sums.
+        Graphs then call the function without them, see Graph._plan_operations.
+        """
+        return False
+
+    def to_dict(self, function_id: Callable[["FunctionBase"], int]) -> Dict:
+        """
+        The json friendly form of the function, for the class method from_dict to build it again.
+        See graph_serialization.
+        :param function_id: function -> int, how other functions the function relies on are referred to.
+        """
+        assert False, "%s can't be serialized." % type(self).__name__
+
 
 # the class that is ready to be
 
@@ -455,7 +602,8 @@ class GraphFieldManager:
     def __init__(self):
         self.existing_fields: Set[str] = set()
         self.constant_fields: Dict[str] = {}
-        pass
+        # Number of multiplies printed.
+        self.multiply_count = 0
 
     def claim_field_as_normal(self, name: str):
         self.existing_fields.add(name)
@@ -521,18 +669,19 @@ class GraphFieldManager:
                 # output_lines.append('all_indents + // %s += %f;'%(target_field, constant_factor))
             elif target_field in self.existing_fields:
                 # add to variable
-                output_lines.append(all_indents + '%s += %f;' % (target_field, constant_factor))
+                output_lines.append(all_indents + '%s += %s;' % (target_field, repr(float(constant_factor))))
             else:
                 # create variable
                 self.constant_fields[target_field] = constant_factor
                 # output_lines.append('all_indents + // %s = %f;'%(target_field, constant_factor))
         else:
             # adding expression
-            expr = "(%f) * %s" % (constant_factor, items) if constant_factor != 1 else items
+            expr = "(%s) * %s" % (repr(float(constant_factor)), items) if constant_factor != 1 else items
+            self.multiply_count += expr.count('*')
             if target_field in self.constant_fields:
                 # no longer constant, become existing normal
                 value = self.constant_fields[target_field]
-                full_expr = '%f + %s' % (value, items) if value != 0 else items
+                full_expr = '%s + %s' % (repr(float(value)), expr) if value != 0 else expr
                 output_lines.append(all_indents + '%s %s=%s;' % (target_field_type, target_field, full_expr))
 
                 del self.constant_fields[target_field]
@@ -591,23 +740,76 @@ class Graph:
         else:
             return results
 
-    def append_operation(self, function: FunctionBase, context: Context):
+    def append_operation(self, function: FunctionBase, context: Context, compatibility_checked=False):
         # one graph won't allow two functions with same name.
-        header = function.optional_header()
-        if header is not None:
-            if header.function_name in self._all_functions_with_headers:
-                existing_one = self._all_functions_with_headers[header.function_name]
+        function_name = function.header_function_name()
+        if function_name is not None:
+            if function_name in self._all_functions_with_headers:
+                existing_one = self._all_functions_with_headers[function_name]
                 assert existing_one is function, \
                     "Function object" + str(function) + " and " + str(existing_one) \
-                    + "(existing in graph) has the same name:" + header.function_name
+                    + "(existing in graph) has the same name:" + function_name
             else:
-                self._all_functions_with_headers[header.function_name] = function
+                self._all_functions_with_headers[function_name] = function
 
-        res, dbg = function.is_compatible(context)
-        assert res, dbg
+        if not compatibility_checked:
+            res, dbg = function.is_compatible(context)
+            assert res, dbg
         # TODO(): check function references are good with variable names.
         self._operations.append((function, context))
 
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        """
+        The json friendly form of the graph, see from_dict.
+        Variables are listed in order, operations refer to them by their index.
+        :param function_id: function -> int, how operations refer to their functions.
+        """
+        variable_ids: Dict[str, int] = {}
+        variables = []
+        for nick_name, variable in self._all_variables.items():
+            variable_ids[nick_name] = len(variables)
+            record = [variable.name, nick_name, variable.type, variable.var_type]
+            if variable.type is Variable.TYPE_CONSTANT:
+                record.append(variable.value)
+            variables.append(record)
+
+        operations = []
+        for function, context in self._operations:
+            operations.append([function_id(function),
+                               [variable_ids[variable.nick_name] for variable in context.input_variables],
+                               [variable_ids[variable.nick_name] for variable in context.output_variables]])
+        return {"name": self.name, "un_named_count": self._un_named_count,
+                "variables": variables, "operations": operations}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "Graph":
+        """
+        Build the graph again from to_dict, with no name nor compatibility checking: they were done on building.
+        :param functions: operations' functions, by their id.
+        """
+        graph = cls(data["name"])
+        graph._un_named_count = data["un_named_count"]
+        variables: List[Variable] = []
+        for record in data["variables"]:
+            variable = Variable(record[0], record[1], graph)
+            if record[2] == Variable.TYPE_STATE_INPUT:
+                variable.defined_as_state_input(record[3])
+            elif record[2] == Variable.TYPE_CONFIG_INPUT:
+                variable.defined_as_config_input(record[3])
+            elif record[2] == Variable.TYPE_CONSTANT:
+                variable.defined_as_constant(record[4], record[3])
+            graph._all_variables[record[1]] = variable
+            variables.append(variable)
+
+        for function_id, input_ids, output_ids in data["operations"]:
+            function = functions[function_id]
+            input_variables = [variables[i] for i in input_ids]
+            output_variables = [variables[i] for i in output_ids]
+            for i in range(len(output_ids)):
+                output_variables[i].defined_as_expr(function, input_variables, i, data["variables"][output_ids[i]][3])
+            graph.append_operation(function, Context(input_variables, output_variables), compatibility_checked=True)
+        return graph
+
     def evaluate_all_dependencies(self) -> Set[CppLibrary]:
         all_deps: Set[CppLibrary] = set()
         for func, _ in self._operations:
@@ -615,10 +817,11 @@ class Graph:
         return all_deps
 
     def evaluate_all_supported_options(self) -> Set[Option]:
-        all_ops = AllOptions.full_option_set.copy()
-        for func, _ in self._operations:
-            all_ops.intersection_update(func.supported_options)
-        return all_ops
+        return {option for option in AllOptions.full_option_set if self.supports(option)}
+
+    def supports(self, option: Option):
+        # Nodes are asked with node_option.
+        return all([option.node_option() in func.supported_options for func, _ in self._operations])
 
     #
     def get_state_input_variables(self):
@@ -713,10 +916,7 @@ class Graph:
         all_definitions = DefinitionResult()
 
         for function, context in self._operations:
-            result = function.get_definition(option)
-            for name, lines in result.function_names_to_lines.items():
-                if name not in all_definitions.function_names_to_lines:
-                    all_definitions.function_names_to_lines[name] = lines
+            all_definitions.merge(function.get_definition(option.node_option()))
 
         return all_definitions
 
@@ -726,8 +926,7 @@ class Graph:
                    self_input_variables: List[Variable],
                    self_output_variables: List[Variable]) -> CallResult:
         option = outer_full_context.option
-        supported_options = self.evaluate_all_supported_options()
-        assert option in supported_options, "option is not supported <%s>" % option.to_string()
+        assert self.supports(option), "option is not supported <%s>" % option.to_string()
 
         in_dim = len(self_input_variables)
         out_dim = len(self_output_variables)
@@ -749,6 +948,12 @@ class Graph:
         assert names_of_inputs == {variable.nick_name for variable in self_input_variables}, \
             "please make sure input_variables exactly contains: " + str(names_of_inputs)
 
+        if outer_full_context.config.inline_cost_threshold > 0:
+            inlined = self._inline_operations(self_input_variables, self_output_variables, outer_full_context.config)
+            if inlined is not None:
+                graph, input_variables, output_variables = inlined
+                return graph.print_call(outer_full_context, input_variables, output_variables)
+
         result = CallResult()
 
         def append_line(line, indent_num=0):
@@ -764,14 +969,14 @@ class Graph:
         # link inputs to make sure graph input vars are ready.
         inputs_need_link = []
         for i in range(in_dim):
-            rhs = outer_full_context.context.input_variables[i].nick_name
+            rhs = outer_full_context.context.input_variables[i].as_cpp_operand()
             lhs = self_input_variables[i].nick_name
             if rhs != lhs:
                 inputs_need_link.append(i)
 
         append_line("// Link inputs to conveyor variables", indent_num=1)
         for i in inputs_need_link:
-            rhs = outer_full_context.context.input_variables[i].nick_name
+            rhs = outer_full_context.context.input_variables[i].as_cpp_operand()
             mid = Const1005.graph_input_conveyor_prefix + "%d" % i
             var_type = self_input_variables[i].var_type
             append_line(VarType1005.const_reference(var_type) + " " + mid + " = " + rhs + ";", indent_num=1)
@@ -785,22 +990,72 @@ class Graph:
         append_line("", indent_num=1)
         append_line("// Graph operations", indent_num=1)
 
-        # when asked 2nd order derivative, 1st order must be also ready.
-        sub_function_option = Option(
-            enable_1st_order_derivative=option.enable_2nd_order_derivative() or option.enable_1st_order_derivative(),
-            enable_2nd_order_derivative=option.enable_2nd_order_derivative())
+        required_channels = outer_full_context.required_output_channels()
+        # Gauss-Newton terms are products of 1st order derivatives.
+        gauss_newton = option.enable_gauss_newton_hessian()
+        # 2nd order derivatives recovered from compressed hessian vector products.
+        hessian_coloring = outer_full_context.config.hessian_coloring and \
+            option.enable_2nd_order_derivative() and not gauss_newton
+        planned_channels = required_channels
+        if gauss_newton:
+            planned_channels = set()
+            for channel in required_channels:
+                if len(channel) == 3:
+                    planned_channels.update({channel[:2], (channel[0], channel[2])})
+                else:
+                    planned_channels.add(channel)
+            planned_channels = sorted(planned_channels)
+        # Hessian vector products need node 2nd order derivatives on the way to their inputs.
+        hessian_vector_channels = outer_full_context.hessian_vector_channels
+        if hessian_vector_channels:
+            planned_channels = sorted(set(planned_channels).union(
+                {(out_idx, in_idx, in_idx) for out_idx, in_idx in hessian_vector_channels}))
+        # Jacobian vector products need node 1st order derivatives on the way to their outputs.
+        jacobian_vector_channels = outer_full_context.jacobian_vector_channels
+        if jacobian_vector_channels:
+            planned_channels = sorted(set(planned_channels).union(
+                {(channel[0], in_idx) for channel in jacobian_vector_channels
+                 for in_idx in outer_full_context.direction_input_ids}))
+        # Pairs of inputs the 2nd order channels link, None for all of them, see _plan_operations.
+        second_order_pairs = None
+        if option.enable_2nd_order_derivative() and not gauss_newton and not hessian_coloring and \
+                not hessian_vector_channels:
+            second_order_pairs = {tuple(sorted(channel[1:])) for channel in required_channels if len(channel) == 3}
+            second_order_inputs = {in_idx for pair in second_order_pairs for in_idx in pair}
+            if len(second_order_pairs) == len(second_order_inputs) * (len(second_order_inputs) + 1) // 2:
+                second_order_pairs = None
+        sub_function_option, plan = self._plan_operations(self_input_variables,
+                                                          self_output_variables,
+                                                          planned_channels,
+                                                          outer_full_context.config,
+                                                          second_order_pairs)
         assert sub_function_option in AllOptions.full_option_set, "sub option Must be one of _all_options"
 
         manager = GraphFieldManager()
 
-        self_output_variables_unreached = {self_output_variables[i].nick_name for i in range(out_dim)}
-        for function, context in self._operations:
-            full_context = FullContext(context,
-                                       sub_function_option)
-
-            call_result = \
-                function.print_call(full_context)
+        # Nodes applied more than once in the same way are shared.
+        structure_counts: Dict[Tuple, int] = {}
+        if outer_full_context.config.share_repeated_nodes:
+            for function, full_context in plan:
+                structure = self._node_structure(function, full_context)
+                structure_counts[structure] = structure_counts.get(structure, 0) + 1
+        canonical_calls: Dict[Tuple, Tuple[FullContext, CallResult]] = {}
+
+        for function, full_context in plan:
+            structure = self._node_structure(function, full_context) if structure_counts else None
+            if structure_counts.get(structure, 0) > 1 and structure not in canonical_calls:
+                canonical_calls[structure] = self._print_canonical_call(function, full_context)
+            # Single statement nodes are cheaper than calling a helper.
+            if structure in canonical_calls and len(canonical_calls[structure][1].lines) > 3:
+                canonical_full_context, canonical_call_result = canonical_calls[structure]
+                call_result = self._move_into_helper(canonical_full_context, canonical_call_result,
+                                                     "SharedNode", "inline ", full_context)
+            else:
+                call_result = \
+                    function.print_call(full_context)
             # TODO(): clear unused variables making use of AC automaton.
+            if 0 < outer_full_context.config.max_node_lines < len(call_result.lines):
+                call_result = self._outline(full_context, call_result)
 
             for channel in full_context.required_output_channels():
                 result_name = full_context.output_channel_name(channel)
@@ -813,12 +1068,27 @@ class Graph:
 
             for ln in call_result.lines:
                 append_line(ln, indent_num=1)
-
-            for output_variable in full_context.context.output_variables:
-                self_output_variables_unreached.discard(output_variable.nick_name)
-            if not self_output_variables_unreached:
-                # early stop since all variables collected
-                break
+            result.definitions.merge(call_result.definitions)
+            result.outlined_line_count += call_result.outlined_line_count
+            result.sweep_count += call_result.sweep_count
+            result.multiply_count += call_result.multiply_count
+
+        # outputs of which derivatives are required.
+        first_order_active_variables = []
+        second_order_active_variables = []
+        for i in range(out_dim):
+            if any([len(channel) > 1 and channel[0] == i for channel in required_channels]) or \
+                    any([channel[0] == i for channel in hessian_vector_channels]):
+                first_order_active_variables.append(self_output_variables[i])
+            if not gauss_newton and any([len(channel) > 2 and channel[0] == i for channel in required_channels]):
+                second_order_active_variables.append(self_output_variables[i])
+
+        def last_step_of(active_variable: Variable):
+            # skip steps after getting the active variable
+            step = len(plan) - 1
+            while step >= 0 and active_variable not in plan[step][1].context.output_variables:
+                step -= 1
+            return step
 
         def get_graph_derivative_name(out_name: str, in_names: List[str]):
             in_names_copy = in_names.copy()
@@ -836,26 +1106,19 @@ class Graph:
 
         if option.enable_1st_order_derivative() or option.enable_2nd_order_derivative():
             # Compute first order derivatives
-            for active_variable in self_output_variables:
-                if not active_variable.is_differentiable():
-                    continue
+            for active_variable in first_order_active_variables:
+                result.sweep_count += 1
                 # determine derivative types
                 active_var_type = active_variable.var_type
 
-                # skip steps after getting the active variable
-                step = len(self._operations) - 1
-                while step >= 0 and active_variable not in self._operations[step][1].output_variables:
-                    step -= 1
-
                 # starts from the fact da_da = 1.
                 manager.claim_field_as_constant(
                     get_graph_derivative_name(active_variable.nick_name, [active_variable.nick_name, ]), 1)
 
                 # bp the entire graph
-                for i in range(step, -1, -1):
-                    _, context = self._operations[i]
-                    full_context = FullContext(context,
-                                               sub_function_option)
+                for i in range(last_step_of(active_variable), -1, -1):
+                    _, full_context = plan[i]
+                    context = full_context.context
 
                     # Update graph derivative from Node derivatives
                     for out_idx, in_idx in full_context.first_order_channels:
@@ -872,7 +1135,7 @@ class Graph:
                                                                       [d_active_d_node_out, node_der_name],
                                                                       indent_num=1)
 
-        if option.enable_2nd_order_derivative():
+        if option.enable_2nd_order_derivative() and not gauss_newton and not hessian_coloring:
             # A table of co-relation.
             # ensures x not in table[x]
             def co_relate(name_1, name_2, table: Dict[str, Set[str]]):
@@ -886,40 +1149,50 @@ class Graph:
                 table[name_1].add(name_2)
                 table[name_2].add(name_1)
 
-            for active_variable in self_output_variables:
-                if not active_variable.is_differentiable():
-                    continue
-
+            for active_variable in second_order_active_variables:
+                result.sweep_count += 1
                 # The cross items of a certain variable
                 existing_cross_items_of_variable: Dict[str, Set[str]] = {}
 
                 # determine derivative types
                 active_var_type = active_variable.var_type
 
-                # skip steps after getting the active variable
-                step = len(self._operations) - 1
-                while step >= 0 and active_variable not in self._operations[step][1].output_variables:
-                    step -= 1
-
                 # bp the entire graph
-                for i in range(step, -1, -1):
-                    _, context = self._operations[i]
-                    full_context = FullContext(context,
-                                               sub_function_option)
+                for i in range(last_step_of(active_variable), -1, -1):
+                    _, full_context = plan[i]
+
+                    second_order_channels = full_context.second_order_channels
+                    if not full_context.option.enable_2nd_order_derivative():
+                        # Node 2nd order derivatives are zero, see _plan_operations.
+                        # Only pairs of its 1st order ones matter, on outputs with nonzero 2nd order derivatives.
+                        second_order_channels = []
+                        for out_idx in range(len(full_context.context.output_variables)):
+                            out_name = full_context.context.output_variables[out_idx].nick_name
+                            if manager.is_zero(get_graph_derivative_name(active_variable.nick_name,
+                                                                         [out_name, out_name])):
+                                continue
+                            in_ids = [in_idx for channel_out_idx, in_idx in full_context.first_order_channels
+                                      if channel_out_idx == out_idx]
+                            second_order_channels += [(out_idx, in_ids[j], in_ids[k])
+                                                      for j in range(len(in_ids)) for k in range(j, len(in_ids))]
 
                     # Update graph derivative from Node derivatives
-                    for out_idx, in_idx_1, in_idx_2 in full_context.second_order_channels:
+                    for out_idx, in_idx_1, in_idx_2 in second_order_channels:
+                        out_name = full_context.context.output_variables[out_idx].nick_name
+                        d2_active_d_node_out_d_node_out = \
+                            get_graph_derivative_name(active_variable.nick_name, [out_name, out_name])
+                        node_d2_out_d_in_1_d_in_2 = full_context.output_channel_name((out_idx, in_idx_1, in_idx_2))
+                        # Nothing to add, for e.g. on the many zero channels of a sum node.
+                        if manager.is_zero(node_d2_out_d_in_1_d_in_2) and \
+                                manager.is_zero(d2_active_d_node_out_d_node_out):
+                            continue
+
                         in_1_name = full_context.context.input_variables[in_idx_1].nick_name
                         in_2_name = full_context.context.input_variables[in_idx_2].nick_name
-                        out_name = full_context.context.output_variables[out_idx].nick_name
 
                         d2_active_d_node_in_1_d_node_in_2 = \
                             get_graph_derivative_name(active_variable.nick_name, [in_1_name, in_2_name])
                         d_active_d_node_out = get_graph_derivative_name(active_variable.nick_name, [out_name, ])
-                        d2_active_d_node_out_d_node_out = \
-                            get_graph_derivative_name(active_variable.nick_name, [out_name, out_name])
-
-                        node_d2_out_d_in_1_d_in_2 = full_context.output_channel_name((out_idx, in_idx_1, in_idx_2))
                         node_d_out_d_in_1 = full_context.output_channel_name((out_idx, in_idx_1))
                         node_d_out_d_in_2 = full_context.output_channel_name((out_idx, in_idx_2))
 
@@ -974,6 +1247,126 @@ class Graph:
                                     not manager.is_zero(d2_active_d_node_in_d_co_related):
                                 co_relate(in_name, co_related, existing_cross_items_of_variable)
 
+        if gauss_newton:
+            for channel in required_channels:
+                if len(channel) < 3:
+                    continue
+                active_variable = self_output_variables[channel[0]]
+                in_names = [self_input_variables[in_idx].nick_name for in_idx in channel[1:]]
+                manager.add_product_of_fields_to_target_field(
+                    result.lines,
+                    get_graph_derivative_name(active_variable.nick_name, in_names),
+                    active_variable.var_type,
+                    [get_graph_derivative_name(active_variable.nick_name, [in_name, ]) for in_name in in_names],
+                    indent_num=1)
+
+        def get_graph_hessian_vector_name(out_name: str, in_name: str, sweep_tag: str = ""):
+            return Const1005.graph_derivative_prefix + Const1005.hessian_vector_prefix + sweep_tag + \
+                   "%s_D_%s" % (out_name, in_name)
+
+        def get_graph_tangent_name(name: str, sweep_tag: str = ""):
+            return Const1005.graph_tangent_prefix + sweep_tag + name
+
+        def print_forward_tangent_sweep(sweep_tag: str = ""):
+            # Forward, the tangent of each variable along the direction seeded at the inputs.
+            result.sweep_count += 1
+            for _, full_context in plan:
+                context = full_context.context
+                for out_idx, in_idx in full_context.first_order_channels:
+                    out_variable = context.output_variables[out_idx]
+                    manager.add_product_of_fields_to_target_field(
+                        result.lines,
+                        get_graph_tangent_name(out_variable.nick_name, sweep_tag),
+                        out_variable.var_type,
+                        [get_graph_tangent_name(context.input_variables[in_idx].nick_name, sweep_tag),
+                         full_context.output_channel_name((out_idx, in_idx))],
+                        indent_num=1)
+
+        def print_reverse_tangent_sweep(active_variable: Variable, sweep_tag: str = ""):
+            # Forward over reverse:
+            # the tangent of each 1st order derivative of active_variable, in reverse.
+            # That is, the hessian of active_variable times the direction.
+            result.sweep_count += 1
+            active_var_type = active_variable.var_type
+
+            # bp the entire graph, the tangent of da_da = 1 is 0.
+            for i in range(last_step_of(active_variable), -1, -1):
+                _, full_context = plan[i]
+                context = full_context.context
+
+                for out_idx, in_idx in full_context.first_order_channels:
+                    out_name = context.output_variables[out_idx].nick_name
+                    in_name = context.input_variables[in_idx].nick_name
+                    manager.add_product_of_fields_to_target_field(
+                        result.lines,
+                        get_graph_hessian_vector_name(active_variable.nick_name, in_name, sweep_tag),
+                        active_var_type,
+                        [get_graph_hessian_vector_name(active_variable.nick_name, out_name, sweep_tag),
+                         full_context.output_channel_name((out_idx, in_idx))],
+                        indent_num=1)
+
+                for out_idx, in_idx_1, in_idx_2 in full_context.second_order_channels:
+                    out_name = context.output_variables[out_idx].nick_name
+                    in_names = [context.input_variables[in_idx].nick_name for in_idx in [in_idx_1, in_idx_2]]
+                    node_d2_out_d_in_1_d_in_2 = full_context.output_channel_name((out_idx, in_idx_1, in_idx_2))
+                    # The hessian is symmetric, the lower triangle is the upper one.
+                    pairs = [(in_names[0], in_names[1]), (in_names[1], in_names[0])] \
+                        if in_idx_1 != in_idx_2 else [(in_names[0], in_names[1])]
+                    for in_name, tangent_in_name in pairs:
+                        manager.add_product_of_fields_to_target_field(
+                            result.lines,
+                            get_graph_hessian_vector_name(active_variable.nick_name, in_name, sweep_tag),
+                            active_var_type,
+                            [get_graph_derivative_name(active_variable.nick_name, [out_name, ]),
+                             node_d2_out_d_in_1_d_in_2,
+                             get_graph_tangent_name(tangent_in_name, sweep_tag)],
+                            indent_num=1)
+
+        if outer_full_context.direction_input_ids:
+            for in_idx in outer_full_context.direction_input_ids:
+                input_variable = self_input_variables[in_idx]
+                tangent_name = get_graph_tangent_name(input_variable.nick_name)
+                append_line(VarType1005.const_reference(input_variable.var_type) + " " + tangent_name + " = " +
+                            outer_full_context.direction_operand(in_idx) + ";", indent_num=1)
+                manager.claim_field_as_normal(tangent_name)
+            print_forward_tangent_sweep()
+
+        if hessian_vector_channels:
+            for active_variable in first_order_active_variables:
+                if any([self_output_variables[out_idx] is active_variable for out_idx, _ in hessian_vector_channels]):
+                    print_reverse_tangent_sweep(active_variable)
+
+        if hessian_coloring:
+            # Compressed hessian:
+            # one hessian vector product per color, each entry is recovered from the product of its color.
+            pattern = self._hessian_sparsity_pattern(self_input_variables, self_output_variables, plan, manager)
+            for i in range(out_dim):
+                if self_output_variables[i] not in second_order_active_variables:
+                    pattern[i] = set()
+            colors = self._color_hessian_columns(pattern, in_dim)
+            for color in sorted(set(colors.values())):
+                sweep_tag = "C%d_" % color
+                for in_idx in colors:
+                    if colors[in_idx] == color:
+                        manager.claim_field_as_constant(
+                            get_graph_tangent_name(self_input_variables[in_idx].nick_name, sweep_tag), 1)
+                print_forward_tangent_sweep(sweep_tag)
+                for active_variable in second_order_active_variables:
+                    print_reverse_tangent_sweep(active_variable, sweep_tag)
+
+                for channel in required_channels:
+                    if len(channel) < 3 or colors.get(channel[2]) != color or \
+                            channel[1:] not in pattern[channel[0]]:
+                        continue
+                    active_variable = self_output_variables[channel[0]]
+                    in_names = [self_input_variables[in_idx].nick_name for in_idx in channel[1:]]
+                    manager.add_product_of_fields_to_target_field(
+                        result.lines,
+                        get_graph_derivative_name(active_variable.nick_name, in_names),
+                        active_variable.var_type,
+                        [get_graph_hessian_vector_name(active_variable.nick_name, in_names[0], sweep_tag)],
+                        indent_num=1)
+
         # Figure out which derivative output channel has been silenced (constant handled)
         # 2 ways of silenced: it is not differentiable, it is zeroed.
         def graph_name_of_output_channel(out_channel: Tuple):
@@ -985,8 +1378,6 @@ class Graph:
                     self_output_variables[out_channel[0]].nick_name,
                     [self_input_variables[in_idx].nick_name for in_idx in out_channel[1:]])
 
-        required_channels = outer_full_context.required_output_channels()
-
         lines_to_be_inserted_to_bracket_begin = [Const1005.indent + "// Link outputs by pointer."]
         for channel in required_channels:
             fully_differentiable = \
@@ -1008,11 +1399,424 @@ class Graph:
                         " = &" + field_name + ";")
                     append_line("*" + Const1005.graph_output_pointer_prefix + field_name + " = " + graph_var_name + ";",
                                 indent_num=1)
+        for channel in hessian_vector_channels:
+            out_name = self_output_variables[channel[0]].nick_name
+            graph_var_name = get_graph_hessian_vector_name(out_name, self_input_variables[channel[1]].nick_name)
+            if not self_output_variables[channel[0]].is_differentiable():
+                result.constant_hessian_vector_channels[channel] = 0
+            elif manager.is_constant(graph_var_name):
+                result.constant_hessian_vector_channels[channel] = manager.get_constant_value(graph_var_name)
+            else:
+                field_name = outer_full_context.hessian_vector_channel_name(channel)
+                field_type = outer_full_context.output_channel_type(channel)
+                lines_to_be_inserted_to_bracket_begin.append(
+                    Const1005.indent + field_type + "* " + Const1005.graph_output_pointer_prefix + field_name +
+                    " = &" + field_name + ";")
+                append_line("*" + Const1005.graph_output_pointer_prefix + field_name + " = " + graph_var_name + ";",
+                            indent_num=1)
+        for channel in jacobian_vector_channels:
+            graph_var_name = Const1005.graph_tangent_prefix + self_output_variables[channel[0]].nick_name
+            if not self_output_variables[channel[0]].is_differentiable():
+                result.constant_jacobian_vector_channels[channel] = 0
+            elif manager.is_constant(graph_var_name):
+                result.constant_jacobian_vector_channels[channel] = manager.get_constant_value(graph_var_name)
+            else:
+                field_name = outer_full_context.jacobian_vector_channel_name(channel)
+                field_type = outer_full_context.output_channel_type(channel)
+                lines_to_be_inserted_to_bracket_begin.append(
+                    Const1005.indent + field_type + "* " + Const1005.graph_output_pointer_prefix + field_name +
+                    " = &" + field_name + ";")
+                append_line("*" + Const1005.graph_output_pointer_prefix + field_name + " = " + graph_var_name + ";",
+                            indent_num=1)
         append_line("}")
         insert_lines_to_bracket_begin(lines_to_be_inserted_to_bracket_begin)
+        result.multiply_count += manager.multiply_count
+
+        return result
+
+    def _plan_operations(self,
+                         self_input_variables: List[Variable],
+                         self_output_variables: List[Variable],
+                         required_channels: List[Tuple],
+                         config: CodegenConfig,
+                         second_order_pairs: Set[Tuple] = None) \
+            -> Tuple[Option, List[Tuple[FunctionBase, FullContext]]]:
+        """
+        Figure out what is needed to answer required_channels:
+        1, operations not leading to a required output are skipped.
+        2, node derivatives not linking a required output to a required input are not asked for.
+        3, node 2nd order derivatives not linking a pair of second_order_pairs are not asked for.
+        :param second_order_pairs: (in_idx_1, in_idx_2), in_idx_1 <= in_idx_2, of the required 2nd order channels.
+        None if they take all pairs of their inputs.
+        :return: the option to call nodes with, [(function, full_context)] in graph order.
+        """
+        first_order_outputs = set()
+        second_order_outputs = set()
+        # names of graph variables depending on inputs of interest.
+        depends_on_1st_order_inputs = set()
+        depends_on_2nd_order_inputs = set()
+        for channel in required_channels:
+            in_names = [self_input_variables[in_idx].nick_name for in_idx in channel[1:]]
+            if len(channel) > 1:
+                first_order_outputs.add(self_output_variables[channel[0]].nick_name)
+                depends_on_1st_order_inputs.update(in_names)
+            if len(channel) > 2:
+                second_order_outputs.add(self_output_variables[channel[0]].nick_name)
+                depends_on_2nd_order_inputs.update(in_names)
+
+        sub_function_option = Option(enable_1st_order_derivative=len(first_order_outputs) > 0,
+                                     enable_2nd_order_derivative=len(second_order_outputs) > 0)
+
+        for _, context in self._operations:
+            input_names = [variable.nick_name for variable in context.input_variables]
+            output_names = [variable.nick_name for variable in context.output_variables]
+            if any([name in depends_on_1st_order_inputs for name in input_names]):
+                depends_on_1st_order_inputs.update(output_names)
+            if any([name in depends_on_2nd_order_inputs for name in input_names]):
+                depends_on_2nd_order_inputs.update(output_names)
+
+        # names of graph variables to the ids of the inputs of interest they depend on.
+        input_ids_of: Dict[str, Set[int]] = {}
+        if second_order_pairs is not None:
+            for pair in second_order_pairs:
+                for in_idx in pair:
+                    input_ids_of.setdefault(self_input_variables[in_idx].nick_name, set()).add(in_idx)
+            for _, context in self._operations:
+                input_ids = set().union(*[input_ids_of.get(variable.nick_name, set())
+                                          for variable in context.input_variables])
+                for variable in context.output_variables:
+                    input_ids_of[variable.nick_name] = input_ids
+
+        # names of graph variables leading to outputs of interest.
+        needed = {self_output_variables[channel[0]].nick_name for channel in required_channels}
+        leads_to_1st_order_outputs = first_order_outputs
+        leads_to_2nd_order_outputs = second_order_outputs
+
+        plan = []
+        for function, context in reversed(self._operations):
+            input_names = [variable.nick_name for variable in context.input_variables]
+            output_names = [variable.nick_name for variable in context.output_variables]
+            if not any([name in needed for name in output_names]):
+                continue
 
+            node_option = sub_function_option
+            if sub_function_option.enable_2nd_order_derivative() and function.zero_second_order_derivatives():
+                # Its 2nd order channels are zero, not even listed. See the 2nd order sweep of print_call.
+                node_option = AllOptions.option_menu["d1"]
+
+            wanted_channels = set()
+            for channel in full_output_channels_with_derivatives(len(input_names), len(output_names),
+                                                                 node_option.enable_1st_order_derivative(),
+                                                                 node_option.enable_2nd_order_derivative()):
+                out_name = output_names[channel[0]]
+                in_names = [input_names[in_idx] for in_idx in channel[1:]]
+                if len(channel) == 1:
+                    is_wanted = out_name in needed
+                elif len(channel) == 2:
+                    is_wanted = out_name in leads_to_1st_order_outputs and \
+                                in_names[0] in depends_on_1st_order_inputs
+                else:
+                    is_wanted = out_name in leads_to_2nd_order_outputs and \
+                                all([name in depends_on_2nd_order_inputs for name in in_names])
+                    if is_wanted and second_order_pairs is not None:
+                        is_wanted = any([(min(in_idx_1, in_idx_2), max(in_idx_1, in_idx_2)) in second_order_pairs
+                                         for in_idx_1 in input_ids_of.get(in_names[0], set())
+                                         for in_idx_2 in input_ids_of.get(in_names[1], set())])
+                if is_wanted:
+                    wanted_channels.add(channel)
+
+            plan.append((function, FullContext(context, node_option, wanted_channels, config)))
+
+            needed.update(input_names)
+            if any([name in leads_to_1st_order_outputs for name in output_names]):
+                leads_to_1st_order_outputs.update(input_names)
+            if any([name in leads_to_2nd_order_outputs for name in output_names]):
+                leads_to_2nd_order_outputs.update(input_names)
+
+        plan.reverse()
+        return sub_function_option, plan
+
+    def replay_operations(self,
+                          input_variables: List[Variable],
+                          output_variables: List[Variable],
+                          arguments: List[Any],
+                          should_inline=None,
+                          keep_names=False) -> List[Any]:
+        """
+        Call the operations of this graph again, on arguments of another graph.
+        Operations with only numbers as inputs are folded at code generation time.
+        :param input_variables: variables in this graph to be replaced by arguments
+        :param output_variables: variables in this graph of interest
+        :param arguments: variables of another graph, or numbers
+        :param should_inline: function -> bool, whether to replay the inline body of a function instead of calling it.
+        :param keep_names: give operation outputs the names they have in this graph.
+        :return: what output_variables become: variables of the other graph, or numbers.
+        None if some operation can't be folded.
+        """
+        values: Dict[str, Any] = {}
+        for variable, argument in zip(input_variables, arguments):
+            values[variable.nick_name] = argument
+
+        for function, context in self._operations:
+            args = []
+            for variable in context.input_variables:
+                if variable.type is Variable.TYPE_CONSTANT:
+                    args.append(variable.value)
+                else:
+                    assert variable.nick_name in values, "<%s> is not given." % variable.nick_name
+                    args.append(values[variable.nick_name])
+
+            if should_inline is not None and should_inline(function):
+                body = function.inline_body()
+                outputs = body.graph.replay_operations(body.graph_input_variables,
+                                                       body.graph_output_variables,
+                                                       args,
+                                                       should_inline)
+                if outputs is None:
+                    return None
+            elif any([type(arg) is Variable for arg in args]):
+                outputs = function(*args)
+                if len(context.output_variables) == 1:
+                    outputs = (outputs,)
+            else:
+                outputs = function.evaluate(*args)
+                if outputs is None:
+                    return None
+
+            for variable, output in zip(context.output_variables, outputs):
+                values[variable.nick_name] = output
+                if keep_names and type(output) is Variable and \
+                        not variable.nick_name.startswith(Const1005.unnamed_graph_var_prefix) and \
+                        output.nick_name.startswith(Const1005.unnamed_graph_var_prefix):
+                    output.set_name(variable.nick_name)
+
+        return [values[variable.nick_name] for variable in output_variables]
+
+    @staticmethod
+    def _move_into_helper(full_context: FullContext,
+                          call_result: CallResult,
+                          helper_prefix: str,
+                          qualifier: str,
+                          call_full_context: FullContext = None) -> CallResult:
+        """
+        Move the lines of a node into a helper function, and call it instead.
+        The node lines only refer to the node inputs and the non-constant output channels,
+        which become parameters of the helper, by reference for outputs.
+        :param full_context: what call_result is printed with
+        :param call_result:
+        :param helper_prefix: the helper is named by it and a hash of the helper.
+        :param qualifier: example: "static "
+        :param call_full_context: what the helper is called with, having the same structure as full_context.
+        Default: full_context
+        :return:
+        """
+        if call_full_context is None:
+            call_full_context = full_context
+
+        parameters = []
+        arguments = []
+        input_variables = full_context.context.input_variables
+        for i in range(len(input_variables)):
+            variable = input_variables[i]
+            if variable.type is Variable.TYPE_CONSTANT or input_variables.index(variable) < i:
+                continue
+            parameters.append(VarType1005.const_reference(variable.var_type) + " " + variable.nick_name)
+            arguments.append(call_full_context.context.input_variables[i].nick_name)
+        for channel in full_context.required_output_channels():
+            if channel in call_result.constant_output_channels:
+                continue
+            parameters.append(full_context.output_channel_type(channel) + "& " +
+                              full_context.output_channel_name(channel))
+            arguments.append(call_full_context.output_channel_name(channel))
+
+        body = [Const1005.indent + ln for ln in call_result.lines]
+        helper_name = helper_prefix + hashlib.md5("\n".join(parameters + body).encode()).hexdigest()[:8]
+        head = qualifier + "void " + helper_name + "("
+        lines = [head + ") {"] if not parameters else []
+        for i in range(len(parameters)):
+            front = head if i == 0 else " " * len(head)
+            back = ") {" if i == len(parameters) - 1 else ","
+            lines.append(front + parameters[i] + back)
+        lines += body + ["}"]
+
+        result = CallResult()
+        result.constant_output_channels = call_result.constant_output_channels
+        result.definitions.merge(call_result.definitions)
+        result.sweep_count = call_result.sweep_count
+        result.multiply_count = call_result.multiply_count
+        result.definitions.function_names_to_lines[helper_name] = lines
+        result.lines.append(helper_name + "(" + ", ".join(arguments) + ");")
         return result
 
+    @staticmethod
+    def _hessian_sparsity_pattern(self_input_variables: List[Variable],
+                                  self_output_variables: List[Variable],
+                                  plan: List[Tuple[FunctionBase, FullContext]],
+                                  manager: GraphFieldManager) -> Dict[int, Set[Tuple[int, int]]]:
+        """
+        Entries of the hessians that are not structurally zero, found from the node channels printed.
+        :return: {out_idx: {(in_idx_1, in_idx_2), ...}} with in_idx_1 <= in_idx_2.
+        """
+        # graph inputs each variable depends on.
+        dependencies: Dict[str, Set[int]] = {}
+        for in_idx in range(len(self_input_variables)):
+            dependencies.setdefault(self_input_variables[in_idx].nick_name, set()).add(in_idx)
+        for _, full_context in plan:
+            context = full_context.context
+            for out_idx, in_idx in full_context.first_order_channels:
+                if not manager.is_zero(full_context.output_channel_name((out_idx, in_idx))):
+                    dependencies.setdefault(context.output_variables[out_idx].nick_name, set()).update(
+                        dependencies.get(context.input_variables[in_idx].nick_name, set()))
+
+        pattern: Dict[int, Set[Tuple[int, int]]] = {}
+        for i in range(len(self_output_variables)):
+            pattern[i] = set()
+            # variables the output depends on.
+            reached = {self_output_variables[i].nick_name}
+            for step in range(len(plan) - 1, -1, -1):
+                _, full_context = plan[step]
+                context = full_context.context
+                for out_idx, in_idx in full_context.first_order_channels:
+                    if context.output_variables[out_idx].nick_name in reached and \
+                            not manager.is_zero(full_context.output_channel_name((out_idx, in_idx))):
+                        reached.add(context.input_variables[in_idx].nick_name)
+                for out_idx, in_idx_1, in_idx_2 in full_context.second_order_channels:
+                    if context.output_variables[out_idx].nick_name not in reached or \
+                            manager.is_zero(full_context.output_channel_name((out_idx, in_idx_1, in_idx_2))):
+                        continue
+                    for j in dependencies.get(context.input_variables[in_idx_1].nick_name, set()):
+                        for k in dependencies.get(context.input_variables[in_idx_2].nick_name, set()):
+                            pattern[i].add((min(j, k), max(j, k)))
+        return pattern
+
+    @staticmethod
+    def _color_hessian_columns(pattern: Dict[int, Set[Tuple[int, int]]], in_dim: int) -> Dict[int, int]:
+        """
+        Greedily color the hessian columns, such that columns of the same color share no row in any hessian.
+        The hessian times the sum of the columns of a color then holds each entry of them as is.
+        :return: {in_idx: color} of the columns having entries.
+        """
+        rows: List[Set[int]] = [set() for _ in range(in_dim)]
+        for entries in pattern.values():
+            for j, k in entries:
+                rows[j].add(k)
+                rows[k].add(j)
+
+        colors: Dict[int, int] = {}
+        for k in range(in_dim):
+            if not rows[k]:
+                continue
+            # columns sharing a row with k.
+            taken = {colors[other] for row in rows[k] for other in rows[row] if other in colors}
+            color = 0
+            while color in taken:
+                color += 1
+            colors[k] = color
+        return colors
+
+    @staticmethod
+    def _outline(full_context: FullContext, call_result: CallResult) -> CallResult:
+        """
+        Move the lines of an oversized node into a static helper function.
+        """
+        result = Graph._move_into_helper(full_context, call_result, "OutlinedNode", "static ")
+        result.lines.insert(0, "// %d lines outlined." % len(call_result.lines))
+        result.outlined_line_count = call_result.outlined_line_count + len(call_result.lines) - len(result.lines)
+        return result
+
+    @staticmethod
+    def _node_structure(function: FunctionBase, full_context: FullContext) -> Tuple:
+        """
+        Nodes with the same structure print the same lines, up to variable names.
+        """
+        inputs = []
+        input_variables = full_context.context.input_variables
+        for variable in input_variables:
+            if variable.type is Variable.TYPE_CONSTANT:
+                kind = (Variable.TYPE_CONSTANT, variable.value)
+            else:
+                kind = (variable.is_differentiable(),)
+            inputs.append((variable.var_type, input_variables.index(variable)) + kind)
+        outputs = [variable.var_type for variable in full_context.context.output_variables]
+        return (id(function), full_context.option.to_string(), tuple(inputs), tuple(outputs),
+                tuple(full_context.required_output_channels()))
+
+    @staticmethod
+    def _print_canonical_call(function: FunctionBase, full_context: FullContext) -> Tuple[FullContext, CallResult]:
+        """
+        Print the node on variables with names depending only on the node structure.
+        :return: full context of the canonical variables, the call result on them.
+        """
+        graph = Graph(name="canonical")
+        input_variables = full_context.context.input_variables
+        arguments = []
+        for i in range(len(input_variables)):
+            variable = input_variables[i]
+            first = input_variables.index(variable)
+            if first < i:
+                arguments.append(arguments[first])
+            elif variable.type is Variable.TYPE_CONSTANT:
+                constant = graph.create_un_named_variable()
+                constant.defined_as_constant(variable.value, variable.var_type)
+                arguments.append(constant)
+            elif variable.is_differentiable():
+                arguments.append(graph.state_inputs(["input_%d" % i, ], variable.var_type))
+            else:
+                arguments.append(graph.config_inputs(["input_%d" % i, ], variable.var_type))
+
+        output_variables = []
+        for i in range(len(full_context.context.output_variables)):
+            variable = full_context.context.output_variables[i]
+            output_variable = graph.create_new_variable("result_%d" % i)
+            output_variable.defined_as_expr(function, arguments, i, variable.var_type)
+            output_variables.append(output_variable)
+
+        canonical_full_context = FullContext(Context(arguments, output_variables),
+                                             full_context.option,
+                                             set(full_context.required_output_channels()),
+                                             full_context.config)
+        return canonical_full_context, function.print_call(canonical_full_context)
+
+    @staticmethod
+    def inline_cost(function: FunctionBase) -> int:
+        """
+        Number of operations the function turns into once inlined, recursively.
+        """
+        body = function.inline_body()
+        if body is None:
+            return 1
+        return sum([Graph.inline_cost(sub_function) for sub_function, _ in body.graph._operations])
+
+    def _inline_operations(self,
+                           self_input_variables: List[Variable],
+                           self_output_variables: List[Variable],
+                           config: CodegenConfig):
+        """
+        Build a graph where calls of cheap enough functions are replaced by their inline body.
+        :return: graph, input variables, output variables. None if nothing to inline.
+        """
+
+        def should_inline(function: FunctionBase):
+            return function.inline_body() is not None and \
+                   Graph.inline_cost(function) <= config.inline_cost_threshold
+
+        if not any([should_inline(function) for function, _ in self._operations]):
+            return None
+
+        graph = Graph(name=self.name)
+        input_variables = []
+        for variable in self_input_variables:
+            if variable.type is Variable.TYPE_STATE_INPUT:
+                input_variables.append(graph.state_inputs([variable.nick_name, ], variable.var_type))
+            else:
+                input_variables.append(graph.config_inputs([variable.nick_name, ], variable.var_type))
+
+        output_variables = self.replay_operations(self_input_variables, self_output_variables, input_variables,
+                                                  should_inline, keep_names=True)
+        if output_variables is None or not all([type(variable) is Variable for variable in output_variables]):
+            return None
+        return graph, input_variables, output_variables
+
     def create_graph_function(self,
                               input_variables: List[Variable],
                               output_variables: List[Variable]):
@@ -1054,16 +1858,32 @@ class GraphFunction(FunctionBase):
         self.options = list(self.supported_options)
         self.options.sort(key=lambda option: option.to_string())
 
-        self._definitions_per_option = []
-        for option in self.options:
-            self._definitions_per_option.append(self.graph.get_definition(option))
+        # Definitions by option, collected on first use.
+        self._definitions_per_option: Dict[Option, DefinitionResult] = {}
 
     def get_definition(self, option: Option) -> DefinitionResult:
         """
         :return:
         """
         assert option in self.supported_options
-        return self._definitions_per_option[self.options.index(option)]
+        if option not in self._definitions_per_option:
+            self._definitions_per_option[option] = self.graph.get_definition(option)
+        return self._definitions_per_option[option]
 
     def print_call(self, full_context: FullContext) -> CallResult:
         return self.graph.print_call(full_context, self.graph_input_variables, self.graph_output_variables)
+
+    def inline_body(self) -> "GraphFunction":
+        return self
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        return {"graph": self.graph.to_dict(function_id),
+                "inputs": [variable.nick_name for variable in self.graph_input_variables],
+                "outputs": [variable.nick_name for variable in self.graph_output_variables]}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "GraphFunction":
+        graph = Graph.from_dict(data["graph"], functions)
+        return cls(graph,
+                   [graph._all_variables[nick_name] for nick_name in data["inputs"]],
+                   [graph._all_variables[nick_name] for nick_name in data["outputs"]])
@@ -1,16 +1,55 @@
 from typing import Dict,Any,Set
 from common import *
+import ast
+import hashlib
 import json
 
 
 class Option:
     def __init__(self,
                  enable_1st_order_derivative: bool = False,
-                 enable_2nd_order_derivative: bool = False):
+                 enable_2nd_order_derivative: bool = False,
+                 enable_gauss_newton_hessian: bool = False,
+                 enable_hessian_vector_product: bool = False,
+                 enable_jacobian_vector_product: bool = False,
+                 requested_channels: List[Tuple] = None):
+        """
+        :param enable_gauss_newton_hessian: the 2nd order channels D2_{out}_D_{in_1}_D_{in_2} hold
+        Gauss-Newton terms D_{out}_D_{in_1} * D_{out}_D_{in_2} instead, no 2nd order derivative is computed.
+        :param enable_hessian_vector_product: take a direction V_{in} for each differentiable input,
+        and provide HV_{out}_D_{in}, the hessian of each output times the direction.
+        No 2nd order channel is provided.
+        :param enable_jacobian_vector_product: take a direction V_{in} for each differentiable input,
+        and provide JV_{out}, the 1st order derivatives of each output along the direction.
+        No derivative channel is provided.
+        :param requested_channels: if given, only these of the channels enabled are provided,
+        see full_output_channels_with_derivatives. Others are neither computed nor asked from the nodes.
+        """
         self.attr: Dict[str, Any] = {}
 
         self.attr["enable_1st_order_derivative"] = enable_1st_order_derivative
         self.attr["enable_2nd_order_derivative"] = enable_2nd_order_derivative
+        self.attr["enable_gauss_newton_hessian"] = enable_gauss_newton_hessian
+        assert not enable_gauss_newton_hessian or (enable_1st_order_derivative and enable_2nd_order_derivative), \
+            "Gauss-Newton hessian comes with 1st and 2nd order channels."
+        self.attr["enable_hessian_vector_product"] = enable_hessian_vector_product
+        assert not enable_hessian_vector_product or \
+               (enable_1st_order_derivative and not enable_2nd_order_derivative), \
+            "Hessian vector product comes with 1st order channels only."
+        self.attr["enable_jacobian_vector_product"] = enable_jacobian_vector_product
+        assert not enable_jacobian_vector_product or \
+               not (enable_1st_order_derivative or enable_2nd_order_derivative or enable_hessian_vector_product), \
+            "Jacobian vector product comes with 0 order channels only."
+        self.attr["requested_channels"] = None
+        if requested_channels is not None:
+            assert not (enable_gauss_newton_hessian or enable_hessian_vector_product or
+                        enable_jacobian_vector_product), "Requested channels come with plain derivatives only."
+            assert all([len(channel) == 1 or
+                        (len(channel) == 2 and enable_1st_order_derivative) or
+                        (len(channel) == 3 and enable_2nd_order_derivative and channel[1] <= channel[2])
+                        for channel in requested_channels]), "Requested channels must be enabled."
+            # json friendly
+            self.attr["requested_channels"] = sorted([list(channel) for channel in set(requested_channels)])
 
     def enable_1st_order_derivative(self):
         return self.attr["enable_1st_order_derivative"]
@@ -18,6 +57,44 @@ class Option:
     def enable_2nd_order_derivative(self):
         return self.attr["enable_2nd_order_derivative"]
 
+    def enable_gauss_newton_hessian(self):
+        return self.attr["enable_gauss_newton_hessian"]
+
+    def enable_hessian_vector_product(self):
+        return self.attr["enable_hessian_vector_product"]
+
+    def enable_jacobian_vector_product(self):
+        return self.attr["enable_jacobian_vector_product"]
+
+    def requested_channels(self) -> Set[Tuple]:
+        """
+        :return: None if all channels enabled are provided.
+        """
+        if self.attr["requested_channels"] is None:
+            return None
+        return {tuple(channel) for channel in self.attr["requested_channels"]}
+
+    def takes_direction(self):
+        """
+        Whether functions of this option take a direction V_{in} for each differentiable input.
+        """
+        return self.enable_hessian_vector_product() or self.enable_jacobian_vector_product()
+
+    def node_option(self) -> "Option":
+        """
+        :return: the option a graph calls its nodes with, to answer this option.
+        """
+        if self.enable_gauss_newton_hessian():
+            return Option(True, False)
+        if self.enable_hessian_vector_product():
+            return Option(True, True)
+        if self.enable_jacobian_vector_product():
+            return Option(True, False)
+        if self.requested_channels() is not None:
+            # Nodes are asked for what the requested channels need only.
+            return Option(self.enable_1st_order_derivative(), self.enable_2nd_order_derivative())
+        return self
+
     def __eq__(self, other: "Option"):
         return self.attr == other.attr
 
@@ -55,12 +132,20 @@ class Option:
         titles = ['First', 'Second']
 
         result = function_name
+        if self.enable_gauss_newton_hessian():
+            return result + 'WithFirstOrderDerivativesGaussNewton'
+        if self.enable_hessian_vector_product():
+            return result + 'WithFirstOrderDerivativesHessianVectorProduct'
+        if self.enable_jacobian_vector_product():
+            return result + 'WithJacobianVectorProduct'
         if any(mask):
             result += 'With'
             for i in range(len(mask)):
                 if mask[i]:
                     result += titles[i]
             result += 'OrderDerivatives'
+        if self.requested_channels() is not None:
+            result += 'Channels' + hashlib.md5(str(self.attr["requested_channels"]).encode()).hexdigest()[:8]
 
         return result
 
@@ -75,6 +160,9 @@ class AllOptions:
         "d0": Option(False, False),
         "d1": Option(True, False),
         "d2": Option(True, True),
+        "dgn": Option(True, True, True),
+        "dhv": Option(True, False, enable_hessian_vector_product=True),
+        "djv": Option(enable_jacobian_vector_product=True),
     }
 
     option_menu_inv: Dict[Option, str] = {}
@@ -84,17 +172,86 @@ class AllOptions:
     full_option_names = set(option_menu.keys())
     full_option_set = set(option_menu.values())
 
+    # What is generated unless asked otherwise.
+    default_option_names = {"d0", "d1", "d2"}
+    default_option_set = set()
+    for k in default_option_names:
+        default_option_set.add(option_menu[k])
+
     # The one with the largest
     # number of output channels
     max_output_channel_option = Option(True, True)
 
+    # Name of an option with requested channels, example: "d2:[(0,), (0, 0, 1)]"
+    requested_channels_separator = ":"
 
-
+    @classmethod
+    def channel_option(cls, channels: List[Tuple]) -> Option:
+        """
+        The option providing exactly channels, and what is enabled by them.
+        :param channels: example: [(0,), (0, 1, 1)], see full_output_channels_with_derivatives.
+        """
+        channels = [tuple(channel[:1]) + tuple(sorted(channel[1:])) for channel in channels]
+        return Option(enable_1st_order_derivative=any([len(channel) > 1 for channel in channels]),
+                      enable_2nd_order_derivative=any([len(channel) > 2 for channel in channels]),
+                      requested_channels=channels)
 
     @classmethod
     def build_option_list_from_names(cls, names: List[str]) -> List[Option]:
-        return [cls.option_menu[n] for n in names]
+        options = []
+        for n in names:
+            if cls.requested_channels_separator in n:
+                base_name, channels = n.split(cls.requested_channels_separator, 1)
+                base = cls.option_menu[base_name]
+                options.append(Option(base.enable_1st_order_derivative(), base.enable_2nd_order_derivative(),
+                                      requested_channels=[tuple(channel) for channel in ast.literal_eval(channels)]))
+            else:
+                options.append(cls.option_menu[n])
+        return options
 
     @classmethod
     def build_names_from_options_list(cls, options: List[Option]) -> List[str]:
-        return [cls.option_menu_inv[op] for op in options]
+        names = []
+        for op in options:
+            if op.requested_channels() is not None:
+                base_name = cls.option_menu_inv[op.node_option()]
+                names.append(base_name + cls.requested_channels_separator + str(sorted(op.requested_channels())))
+            else:
+                names.append(cls.option_menu_inv[op])
+        return names
+
+
+class CodegenConfig:
+    """
+    Switches on how functions are printed.
+    Unlike Option, they never change the interface of the generated functions.
+    """
+
+    def __init__(self,
+                 specialize_constant_inputs: bool = False,
+                 inline_cost_threshold: int = 0,
+                 max_node_lines: int = 0,
+                 share_repeated_nodes: bool = False,
+                 buffer_interface: bool = False,
+                 hessian_coloring: bool = False):
+        """
+        :param specialize_constant_inputs: calling a WrappedFunction with constants will call a variant
+        specialized on them, with the constants folded at code generation time.
+        :param inline_cost_threshold: functions with a graph body (see FunctionBase.inline_body) costing
+        no more than this many operations are merged into the graph calling them. 0 to disable.
+        :param max_node_lines: nodes printing more lines than this are moved into static helper functions,
+        to keep each generated function small enough to compile fast. 0 to disable.
+        :param share_repeated_nodes: a function applied more than once in a graph, in the same way, is printed
+        once into an inline helper function, called at each application.
+        :param buffer_interface: functions with a Header are called through their contiguous grad/hess
+        variant, see Header.print_buffer_head. Libraries called must be dumped with buffers=True.
+        :param hessian_coloring: graphs print 2nd order derivatives as hessian vector products, one per
+        color of a coloring of the hessian columns, instead of a 2nd order reverse pass per output.
+        Cheaper for hessians sparse in structure, see Graph._color_hessian_columns.
+        """
+        self.specialize_constant_inputs = specialize_constant_inputs
+        self.inline_cost_threshold = inline_cost_threshold
+        self.max_node_lines = max_node_lines
+        self.share_repeated_nodes = share_repeated_nodes
+        self.buffer_interface = buffer_interface
+        self.hessian_coloring = hessian_coloring
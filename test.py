@@ -4,6 +4,11 @@ from cpp_functions import CppFunction
 from cpp_library import BuiltInLibrary
 from wrapped_function import *
 from sympy_function import SymPyFunction
+from scan_function import ScanFunction
+from sum_function import SumFunction, weighted_sum
+from conditional_function import ConditionalFunction
+from variable_array import VariableArray
+from graph_serialization import function_to_string, function_from_string
 
 _my_visual_studio_project_root = ""
 UserLibrary.set_global_project_root(_my_visual_studio_project_root)
@@ -165,11 +170,860 @@ def test_case_5():
     """
 
 
+def test_case_6():
+    """
+    Calling a wrapped function while using only part of its outputs.
+    A reduced variant, computing only what the caller needs, is defined in the caller's source file.
+
+    result:
+    1, generated/polar.h
+    2, generated/polar.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    r2 = x ** 2 + y ** 2
+    k = x / y
+    r2.set_name("r2")
+    k.set_name("k")
+    r2_and_k = wrap_graph(graph=g,
+                          input_variables=[x, y],
+                          output_variables=[r2, k],
+                          function_name="RadiusSquareAndSlope")
+
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    r2, _ = r2_and_k(a, b)
+    r2.set_name("r2")
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[a, b],
+                         output_variables=[r2],
+                         function_name="Polar")
+
+    call_lines = "\n".join(wrapped.call_results[0].lines)
+    assert "RadiusSquareAndSlopeReduced" in call_lines
+    assert Const1005.graph_unused_prefix not in call_lines
+    wrapped.dump_to_lib(library=UserLibrary("generated", "polar"))
+
+
+def test_case_7():
+    """
+    Calling a wrapped function with constants, asking for a variant specialized on them.
+
+    result:
+    1, generated/scaled_polar.h
+    2, generated/scaled_polar.cpp
+    :return:
+    """
+    g = Graph()
+    x, y, scale = g.state_inputs(['x', 'y', 'scale'], 'double')
+    r2 = (x ** 2 + y ** 2) * scale
+    r2.set_name("r2")
+    scaled_r2 = wrap_graph(graph=g,
+                           input_variables=[x, y, scale],
+                           output_variables=[r2],
+                           function_name="ScaledRadiusSquare")
+
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    r2 = scaled_r2(a, b, 0.5)
+    r2.set_name("r2")
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[a, b],
+                         output_variables=[r2],
+                         function_name="ScaledPolar",
+                         config=CodegenConfig(specialize_constant_inputs=True))
+
+    # The scale is folded, no longer passed at runtime.
+    call_lines = "\n".join(wrapped.call_results[0].lines)
+    assert "ScaledRadiusSquareConst" in call_lines
+    assert "0.5" not in call_lines
+    wrapped.dump_to_lib(library=UserLibrary("generated", "scaled_polar"))
+
+
+def test_case_8():
+    """
+    Functions cheap enough are merged into the graph calling them, the others are still called.
+
+    result:
+    1, generated/inlined_norm.h
+    2, generated/inlined_norm.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    s = x * y
+    s.set_name('s')
+    product = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[s],
+                         function_name="CheapProduct")
+
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    n = (x * x + y * y) * x
+    n.set_name('n')
+    norm = wrap_graph(graph=g,
+                      input_variables=[x, y],
+                      output_variables=[n],
+                      function_name="CostlyNorm")
+    assert Graph.inline_cost(product) == 1 and Graph.inline_cost(norm) == 4
+
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    result = norm(product(a, b), b)
+    result.set_name('result')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[a, b],
+                         output_variables=[result],
+                         function_name="InlinedNorm",
+                         config=CodegenConfig(inline_cost_threshold=2))
+    library = UserLibrary("generated", "inlined_norm")
+    wrapped.dump_to_lib(library=library)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp = f.read()
+    assert "CheapProduct" not in cpp
+    assert "CostlyNorm" in cpp
+
+
+def test_case_9():
+    """
+    Nodes printing too many lines are moved into static helper functions, the others stay in place.
+
+    result:
+    1, generated/outlined_cost.h
+    2, generated/outlined_cost.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    large = SymPyFunction(lambda a, b: sp.exp(a * b) * sp.sin(a + b) / (a * a + b * b + 1))(x, y)
+    cost = large + x
+    cost.set_name('cost')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[cost],
+                         function_name="OutlinedCost",
+                         config=CodegenConfig(max_node_lines=8))
+    library = UserLibrary("generated", "outlined_cost")
+    wrapped.dump_to_lib(library=library)
+
+    d2_result = wrapped.call_results[wrapped.options.index(AllOptions.option_menu["d2"])]
+    helper_names = list(d2_result.definitions.function_names_to_lines.keys())
+    assert len(helper_names) == 1 and helper_names[0].startswith("OutlinedNode")
+    assert sum([ln.strip().startswith(helper_names[0] + "(") for ln in d2_result.lines]) == 1
+    assert d2_result.outlined_line_count > 0
+    # The sum of two inputs is small, still in place.
+    assert any(["= %s + x;" % large.nick_name in ln or "= x + %s;" % large.nick_name in ln
+                for ln in d2_result.lines])
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp = f.read()
+    assert ("static void " + helper_names[0] + "(") in cpp
+
+
+def test_case_10():
+    """
+    A function applied the same way more than once is printed once, into an inline helper called each time.
+
+    result:
+    1, generated/shared_pairs.h
+    2, generated/shared_pairs.cpp
+    :return:
+    """
+    pair = SymPyFunction(lambda a, b: sp.cos(a) * sp.exp(b) + a * b)
+    g = Graph()
+    xs = g.state_inputs(['x0', 'x1', 'x2', 'x3', 'x4', 'x5'], 'double')
+    terms = [pair(xs[2 * i], xs[2 * i + 1]) for i in range(3)]
+    cost = terms[0] + terms[1] + terms[2]
+    cost.set_name('cost')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=xs,
+                         output_variables=[cost],
+                         function_name="SharedPairs",
+                         config=CodegenConfig(share_repeated_nodes=True))
+    library = UserLibrary("generated", "shared_pairs")
+    wrapped.dump_to_lib(library=library)
+
+    d2_result = wrapped.call_results[wrapped.options.index(AllOptions.option_menu["d2"])]
+    helper_names = list(d2_result.definitions.function_names_to_lines.keys())
+    assert len(helper_names) == 1 and helper_names[0].startswith("SharedNode")
+    assert sum([ln.strip().startswith(helper_names[0] + "(") for ln in d2_result.lines]) == 3
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp = f.read()
+    assert cpp.count("inline void " + helper_names[0] + "(") == 1
+
+
+def test_case_11():
+    """
+    Dump batch variants along with the single point functions.
+
+    result:
+    1, generated/batch_radius.h
+    2, generated/batch_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    c = g.config_inputs(['c'], 'UserType')
+    radius = x ** 2 + y ** 2
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[c, x, y],
+                         output_variables=[radius],
+                         function_name="BatchRadius")
+    library = UserLibrary("generated", "batch_radius")
+    wrapped.dump_to_lib(library=library, batch=True, openmp=True)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".h")) as f:
+        header_text = f.read()
+    # Config inputs are shared by the batch, numerical ones are arrays.
+    assert "BatchRadiusWithFirstSecondOrderDerivativesBatch(const UserType& c," in header_text
+    assert "const double* x," in header_text
+    assert "int batch_size);" in header_text
+
+
+def test_case_12():
+    """
+    Emit template <typename Scalar> functions, instantiated for double and float.
+
+    result:
+    1, generated/scalar_radius.h
+    2, generated/scalar_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x ** 2 + y ** 2
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[radius],
+                         function_name="ScalarRadius")
+    library = UserLibrary("generated", "scalar_radius")
+    wrapped.dump_to_lib(library=library, scalar_types=["double", "float"])
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        source_text = f.read()
+    assert "template <typename Scalar>" in source_text
+    assert "template void ScalarRadiusWithFirstOrderDerivatives(float x," in source_text
+    assert "double" not in source_text.split("template void")[0]
+
+
+def test_case_13():
+    """
+    Element-wise ArrayXd inputs, one call evaluates a whole horizon.
+    Scalar inputs are broadcast.
+
+    result:
+    1, generated/array_radius.h
+    2, generated/array_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'ArrayXd')
+    scale = g.state_inputs(['scale'], 'double')
+    radius = SymPyFunction(lambda a, b, s: s * sp.sqrt(a ** 2 + b ** 2))(x, y, scale)
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y, scale],
+                         output_variables=[radius],
+                         function_name="ArrayRadius")
+    library = UserLibrary("generated", "array_radius")
+    wrapped.dump_to_lib(library=library)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".h")) as f:
+        header_text = f.read()
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        source_text = f.read()
+    assert "#include <Eigen/Core>" in header_text
+    assert "using Eigen::ArrayXd;" in header_text
+    assert "Eigen::sqrt(" in source_text
+    assert "std::sqrt(" not in source_text
+
+
+def test_case_14():
+    """
+    Write derivatives into contiguous grad/hess buffers, and chain generated functions through them.
+
+    result:
+    1, generated/buffer_radius.h
+    2, generated/buffer_radius.cpp
+    3, generated/buffer_radius_inv.h
+    4, generated/buffer_radius_inv.cpp
+    5, generated/buffer_third_radius.h
+    6, generated/buffer_third_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x ** 2 + y ** 2
+    radius.set_name('r')
+    buffer_radius = wrap_graph(graph=g,
+                               input_variables=[x, y],
+                               output_variables=[radius],
+                               function_name="BufferRadius")
+    buffer_radius.dump_to_lib(library=UserLibrary("generated", "buffer_radius"), buffers=True)
+
+    # hess holds the upper triangle, row by row.
+    assert buffer_radius.header.buffer_offset((0, 0, 1)) == 1
+    assert buffer_radius.header.buffer_offset((0, 1, 1)) == 2
+
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    radius_inv = 1.0 / buffer_radius(a, b)
+    radius_inv.set_name("r_inv")
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[a, b],
+                         output_variables=[radius_inv],
+                         function_name="BufferRadiusInv",
+                         config=CodegenConfig(buffer_interface=True))
+    call_lines = "\n".join(wrapped.call_results[-1].lines)
+    assert "BufferRadiusWithFirstSecondOrderDerivativesBuffer(" in call_lines
+    wrapped.dump_to_lib(library=UserLibrary("generated", "buffer_radius_inv"))
+
+    # Constant derivatives are written in full precision.
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x ** 2 / 3.0 + y * 1e-8
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[radius],
+                         function_name="BufferThirdRadius")
+    library = UserLibrary("generated", "buffer_third_radius")
+    wrapped.dump_to_lib(library=library, buffers=True)
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp_text = f.read()
+    assert "grad[1] = 1e-08;" in cpp_text
+    assert "hess[0] = 0.6666666666666666;" in cpp_text
+
+
+def test_case_15():
+    """
+    Write only structurally nonzero derivatives, along with their constexpr triplet pattern.
+
+    result:
+    1, generated/sparse_radius.h
+    2, generated/sparse_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y, z = g.state_inputs(['x', 'y', 'z'], 'double')
+    radius = x ** 2 + y * z
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y, z],
+                         output_variables=[radius],
+                         function_name="SparseRadius")
+    library = UserLibrary("generated", "sparse_radius")
+    wrapped.dump_to_lib(library=library, sparse=True)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".h")) as f:
+        header_text = f.read()
+    # D2_r_D_x_D_x = 2 and D2_r_D_y_D_z = 1 are the only nonzeros in the hessian.
+    assert "constexpr int kSparseRadiusWithFirstSecondOrderDerivativesHessianNnz = 2;" in header_text
+    assert "constexpr int kSparseRadiusWithFirstSecondOrderDerivativesHessianRows[] = {0, 1};" in header_text
+    assert "constexpr int kSparseRadiusWithFirstSecondOrderDerivativesHessianCols[] = {0, 2};" in header_text
+
+
+def test_case_16():
+    """
+    Describe the derivatives of each option with constexpr metadata in .h file.
+
+    result:
+    1, generated/sparse_radius_metadata.h
+    :return:
+    """
+    header = Header.create_header(function_name="SparseRadiusMetadata",
+                                  inputs="Table t, double x, double y",
+                                  outputs="double z",
+                                  derivatives="D_z_D_x, D_z_D_y = 3, D2_z_D_x_D_x = 2",
+                                  supported_options=["d1", "d2"])
+    library = UserLibrary("generated", "sparse_radius_metadata")
+    header.dump_to_h_file(user_library=library, dependencies=set(), sparsity_metadata=True)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".h")) as f:
+        header_text = f.read()
+    prefix = "constexpr int kSparseRadiusMetadataWithFirstOrderDerivatives"
+    assert prefix + "JacobianNnz = 2;" in header_text
+    assert prefix + "JacobianCols[] = {1, 2};" in header_text
+    assert prefix + "JacobianNumConstants = 1;" in header_text
+    assert "constexpr double kSparseRadiusMetadataWithFirstSecondOrderDerivativesHessianConstantValues[] = {2.0};" \
+           in header_text
+
+
+def test_case_17():
+    """
+    Replace the hessian by the Gauss-Newton approximation J^T J of each output.
+
+    result:
+    1, generated/gauss_newton_residual.h
+    2, generated/gauss_newton_residual.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    residual = x * y - 1.0
+    residual.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[residual],
+                         function_name="GaussNewtonResidual",
+                         options=["d1", "dgn"])
+    library = UserLibrary("generated", "gauss_newton_residual")
+    wrapped.dump_to_lib(library=library)
+
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp_text = f.read()
+    assert "GaussNewtonResidualWithFirstOrderDerivativesGaussNewton(" in cpp_text
+    assert "GaussNewtonResidualWithFirstSecondOrderDerivatives(" not in cpp_text
+
+
+def test_case_18():
+    """
+    Take a direction for the inputs and provide the hessian of each output times it,
+    without computing the full hessian.
+
+    result:
+    1, generated/hessian_vector_radius.h
+    2, generated/hessian_vector_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x * y * y + x
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[radius],
+                         function_name="HessianVectorRadius",
+                         options=["d1", "dhv"])
+    library = UserLibrary("generated", "hessian_vector_radius")
+    wrapped.dump_to_lib(library=library)
+
+    option = AllOptions.option_menu["dhv"]
+    assert wrapped.header.hessian_vector_channels(option) == [(0, 0), (0, 1)]
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp_text = f.read()
+    assert "HessianVectorRadiusWithFirstOrderDerivativesHessianVectorProduct(" in cpp_text
+    assert "double* HV_out_r_D_x" in cpp_text
+    assert "GRAPH_D2_" not in cpp_text
+
+
+def test_case_19():
+    """
+    Take a direction for the inputs and provide the 1st order derivatives of each output along it,
+    by one more forward pass.
+
+    result:
+    1, generated/jacobian_vector_radius.h
+    2, generated/jacobian_vector_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x * y * y + x
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[radius],
+                         function_name="JacobianVectorRadius",
+                         options=["d0", "djv"])
+    library = UserLibrary("generated", "jacobian_vector_radius")
+    wrapped.dump_to_lib(library=library)
+
+    option = AllOptions.option_menu["djv"]
+    assert wrapped.header.jacobian_vector_channels(option) == [(0,)]
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        cpp_text = f.read()
+    assert "JacobianVectorRadiusWithJacobianVectorProduct(" in cpp_text
+    assert "double V_y" in cpp_text
+    assert "double* JV_out_r" in cpp_text
+    assert "GRAPH_D_" not in cpp_text
+
+
+def test_case_20():
+    """
+    Differentiate only a subset of the inputs, the others are parameters.
+
+    result:
+    1, generated/partial_radius.h
+    2, generated/partial_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y, k = g.state_inputs(['x', 'y', 'k'], 'double')
+    radius = k * x * y + y
+    radius.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y, k],
+                         output_variables=[radius],
+                         function_name="PartialRadius",
+                         differentiated_inputs=[x, y])
+    wrapped.dump_to_lib(library=UserLibrary("generated", "partial_radius"))
+
+    header = wrapped.header
+    assert header.parameter_names == ["k"]
+    channels = header.output_channels(AllOptions.option_menu["d2"])
+    assert all([2 not in channel[1:] for channel in channels])
+    assert header.constant_derivative_channels[(0, 2)] == 0
+
+    # Parameters take config inputs, derivatives through a state input would be lost.
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    c = g.config_inputs(['c'], 'double')
+    r = wrapped(a, b, c)
+    assert wrapped.is_compatible(Context([a, b, c], [r]))[0]
+    res, dbg = wrapped.is_compatible(Context([a, b, a * 2.0], [r]))
+    assert not res and "parameter" in dbg
+
+
+def test_case_21():
+    """
+    Provide only a chosen set of output channels.
+
+    result:
+    1, generated/channel_radius.h
+    2, generated/channel_radius.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    radius = x * y * y + x
+    radius.set_name('r')
+    option = AllOptions.channel_option([(0,), (0, 1, 1)])
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[radius],
+                         function_name="ChannelRadius",
+                         options=["d1", option])
+    wrapped.dump_to_lib(library=UserLibrary("generated", "channel_radius"))
+
+    # The decorated name is stable.
+    assert option.decorate("ChannelRadius") == \
+           AllOptions.channel_option([(0, 1, 1), (0,)]).decorate("ChannelRadius")
+    assert wrapped.header.output_channels(option) == [(0,), (0, 1, 1)]
+    names = AllOptions.build_names_from_options_list([option])
+    assert AllOptions.build_option_list_from_names(names) == [option]
+
+
+def test_case_22():
+    """
+    Print 2nd order derivatives of a chain from hessian vector products of colored columns.
+
+    result:
+    1, generated/colored_chain.h
+    2, generated/colored_chain.cpp
+    :return:
+    """
+    term = SymPyFunction(lambda a, b: sp.sin(a) * b * b)
+    wrapped_functions = []
+    for config in [CodegenConfig(), CodegenConfig(hessian_coloring=True)]:
+        g = Graph()
+        xs = g.state_inputs(['x%d' % i for i in range(5)], 'double')
+        cost = term(xs[0], xs[1])
+        for i in range(1, 4):
+            cost = cost + term(xs[i], xs[i + 1])
+        cost.set_name('cost')
+        wrapped_functions.append(wrap_graph(graph=g,
+                                            input_variables=list(xs),
+                                            output_variables=[cost],
+                                            function_name="ColoredChain",
+                                            config=config))
+    plain, colored = wrapped_functions
+    colored.dump_to_lib(library=UserLibrary("generated", "colored_chain"))
+
+    # The tridiagonal hessian takes 3 colors.
+    assert plain.header.constant_derivative_channels == colored.header.constant_derivative_channels
+    tridiagonal = {(i, i) for i in range(5)}.union({(i, i + 1) for i in range(4)})
+    assert len(set(Graph._color_hessian_columns({0: tridiagonal}, 5).values())) == 3
+    assert colored.call_results[2].sweep_count == 1 + 3 * 2
+
+
+def test_case_23():
+    """
+    Apply a step function over a horizon as a loop.
+
+    result:
+    1, generated/scan_rollout.h
+    2, generated/scan_rollout.cpp
+    3, generated/scan_rollout_in_band.h
+    4, generated/scan_rollout_in_band.cpp
+    :return:
+    """
+    body_graph = Graph()
+    p, v, u = body_graph.state_inputs(['p', 'v', 'u'], 'double')
+    next_p, next_v = SymPyFunction(lambda p, v, u: (p + 0.1 * v, v + 0.1 * (u - sp.sin(p))))(p, v, u)
+    body = body_graph.create_graph_function([p, v, u], [next_p, next_v])
+    scan = ScanFunction(body, num_steps=20, num_carried=2)
+    assert scan.step_input_id(3, 0) == 5
+
+    g = Graph()
+    p0, v0 = g.state_inputs(['p0', 'v0'], 'double')
+    controls = g.state_inputs(['u%d' % i for i in range(20)], 'double')
+    p_final, v_final = scan(p0, v0, *controls)
+    p_final.set_name('p_final')
+    v_final.set_name('v_final')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[p0, v0] + list(controls),
+                         output_variables=[p_final, v_final],
+                         function_name="ScanRollout")
+    wrapped.dump_to_lib(library=UserLibrary("generated", "scan_rollout"))
+
+    # Every channel depends on the controls.
+    assert not [channel for channel in wrapped.header.constant_derivative_channels if len(channel) == 2]
+
+    # Hessian blocks within a step and between consecutive steps only, accumulated block by block.
+    assert scan.stages() == [2] + [1] * 20 and scan.stage_of_input(5) == 4 and scan.stage_input_id(4) == 5
+    in_band_channels = [(0, j, k) for j in range(22) for k in range(j, 22)
+                        if scan.stage_of_input(k) - scan.stage_of_input(j) <= 1]
+    in_band = wrap_graph(graph=g,
+                         input_variables=[p0, v0] + list(controls),
+                         output_variables=[p_final, v_final],
+                         function_name="ScanRolloutInBand",
+                         options=[AllOptions.channel_option(in_band_channels)])
+    in_band.dump_to_lib(library=UserLibrary("generated", "scan_rollout_in_band"))
+    in_band_lines = "\n".join(in_band.call_results[0].lines)
+    assert "SCAN_HD" in in_band_lines and "SCAN_HZ" not in in_band_lines
+    d2_lines = "\n".join(wrapped.call_results[wrapped.options.index(AllOptions.option_menu["d2"])].lines)
+    assert "SCAN_HZ" in d2_lines
+
+
+def test_case_24():
+    """
+    Sum many terms with a single node.
+
+    result:
+    1, generated/sum_cost.h
+    2, generated/sum_cost.cpp
+    :return:
+    """
+    g = Graph()
+    xs = g.state_inputs(['x%d' % i for i in range(20)], 'double')
+    square = SymPyFunction(lambda a: a ** 2)
+    cost = weighted_sum([square(x) for x in xs] + [1.0], [0.5] * 20 + [1])
+    cost.set_name('cost')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=list(xs),
+                         output_variables=[cost],
+                         function_name="SumCost")
+    wrapped.dump_to_lib(library=UserLibrary("generated", "sum_cost"))
+
+    # D2_cost_D_xi_D_xi = 0.5 * 2.
+    assert all([wrapped.header.constant_derivative_channels[(0, i, i)] == 1.0 for i in range(20)])
+    assert (0, 0, 1) in wrapped.header.constant_derivative_channels
+    assert SumFunction(2, [2, 3]).evaluate(1.0, 1.0) == (5.0,)
+
+    # The zero 2nd order derivatives of the sum node are not even listed.
+    d2_channels = full_output_channels_with_derivatives(20, 1, True, True)
+    _, plan = g._plan_operations(list(xs), [cost], d2_channels, CodegenConfig())
+    assert all([not full_context.second_order_channels for function, full_context in plan
+                if isinstance(function, SumFunction)])
+
+
+def test_case_25():
+    """
+    Write block tridiagonal hessians of inputs in stages.
+
+    result:
+    1, generated/banded_trajectory.h
+    2, generated/banded_trajectory.cpp
+    :return:
+    """
+    g = Graph()
+    p0, v0, p1, v1, p2, v2 = g.state_inputs(['p0', 'v0', 'p1', 'v1', 'p2', 'v2'], 'double')
+    transition = SymPyFunction(lambda p, v, next_p, next_v: (next_p - p - 0.1 * v) ** 2 + (next_v - v) ** 2)
+    cost = transition(p0, v0, p1, v1) + transition(p1, v1, p2, v2)
+    cost.set_name('cost')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[p0, v0, p1, v1, p2, v2],
+                         output_variables=[cost],
+                         function_name="BandedTrajectory")
+    wrapped.dump_to_lib(library=UserLibrary("generated", "banded_trajectory"), stages=[2, 2, 2])
+
+    header = wrapped.header
+    assert header.banded_size([2, 2, 2], True) == 12
+    assert header.banded_size([2, 2, 2], False) == 8
+    # D2_cost_D_v1_D_p2: row 1 of the block between stage 1 and stage 2.
+    assert header.banded_offset((0, 3, 4), [2, 2, 2]) == (Const1005.hessian_off_diagonal_blocks_name, 4 + 2)
+    assert header.banded_offset((0, 0, 4), [2, 2, 2]) is None
+
+
+def test_case_26():
+    """
+    Pick one of two graphs by a condition, as a c++ if block.
+
+    result:
+    1, generated/soft_clamp.h
+    2, generated/soft_clamp.cpp
+    :return:
+    """
+    inside_graph = Graph()
+    a, b = inside_graph.state_inputs(['a', 'b'], 'double')
+    inside_value = a * b
+    inside = inside_graph.create_graph_function([a, b], [inside_value])
+
+    outside_graph = Graph()
+    a, b = outside_graph.state_inputs(['a', 'b'], 'double')
+    outside_value = SymPyFunction(lambda a, b: sp.log(a) + b)(a, b)
+    outside = outside_graph.create_graph_function([a, b], [outside_value])
+
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    clamped = ConditionalFunction(inside, outside, "<=")(x - 1.0, x, y)
+    clamped.set_name('clamped')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[clamped],
+                         function_name="SoftClamp")
+    wrapped.dump_to_lib(library=UserLibrary("generated", "soft_clamp"))
+
+    # D_clamped_D_y is x on one side, 1 on the other.
+    assert (0, 1) not in wrapped.header.constant_derivative_channels
+    assert wrapped.header.constant_derivative_channels[(0, 1, 1)] == 0
+    assert ConditionalFunction(inside, outside, "<=").is_true(0.0)
+
+
+def test_case_27():
+    """
+    Build a graph element-wise on arrays of variables.
+
+    result:
+    1, generated/array_distance.h
+    2, generated/array_distance.cpp
+    :return:
+    """
+    g = Graph()
+    xs = VariableArray.state_inputs(g, 'x', 4)
+    ys = VariableArray.state_inputs(g, 'y', 4)
+    diffs = xs - ys
+    diffs.set_names('diff')
+    distance = (diffs.dot(diffs) + 1.0) ** 0.5
+    distance.set_name('distance')
+
+    assert len(diffs) == 4 and len(diffs[1:3]) == 2
+    assert diffs[2].name == 'diff_2' and diffs[2].inputs == [xs[2], ys[2]]
+    # The constant of the first element is taken by the others.
+    scaled = 2.0 * xs
+    assert scaled[0].inputs[0] is scaled[3].inputs[0]
+
+    wrapped = wrap_graph(graph=g,
+                         input_variables=list(xs) + list(ys),
+                         output_variables=[distance],
+                         function_name="ArrayDistance")
+    wrapped.dump_to_lib(library=UserLibrary("generated", "array_distance"))
+
+
+def test_case_28():
+    """
+    Save a wrapped graph, and build it again from what is saved.
+
+    result:
+    1, generated/loaded_cost.h
+    2, generated/loaded_cost.cpp
+    :return:
+    """
+    branches = []
+    for op in [lambda a, b: a * b, lambda a, b: a + b]:
+        branch_graph = Graph()
+        a, b = branch_graph.state_inputs(['a', 'b'], 'double')
+        branches.append(branch_graph.create_graph_function([a, b], [op(a, b)]))
+
+    g = Graph()
+    x, y, step = g.state_inputs(['x', 'y', 'step'], 'double')
+    terms = [SymPyFunction(lambda a, b: sp.exp(a) * b)(x, y), x * step, y ** 2]
+    cost = ConditionalFunction(*branches)(x - 1.0, x, weighted_sum(terms, [1, 2, 3]))
+    cost.set_name('cost')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y, step],
+                         output_variables=[cost],
+                         function_name="LoadedCost",
+                         differentiated_inputs=[x, y])
+
+    saved = function_to_string(wrapped)
+    loaded = function_from_string(saved)
+    assert function_to_string(loaded) == saved
+    assert loaded.header.constant_derivative_channels == wrapped.header.constant_derivative_channels
+    for option in wrapped.options:
+        assert loaded.get_definition(option).function_names_to_lines == \
+               wrapped.get_definition(option).function_names_to_lines
+    loaded.dump_to_lib(library=UserLibrary("generated", "loaded_cost"))
+
+
+def test_case_29():
+    """
+    Wrapped functions print each option on first use only:
+    a call or a definition of d1 leaves d2 unprinted.
+
+    result:
+    1, generated/lazy_radius_user.h
+    2, generated/lazy_radius_user.cpp
+    :return:
+    """
+    g = Graph()
+    x, y = g.state_inputs(['x', 'y'], 'double')
+    r = SymPyFunction(lambda a, b: sp.sqrt(a * a + b * b))(x, y)
+    r.set_name('r')
+    wrapped = wrap_graph(graph=g,
+                         input_variables=[x, y],
+                         output_variables=[r],
+                         function_name="LazyRadius")
+    assert not wrapped._call_results
+    d1 = AllOptions.option_menu["d1"]
+    d2_id = wrapped.options.index(AllOptions.option_menu["d2"])
+
+    g = Graph()
+    a, b = g.state_inputs(['a', 'b'], 'double')
+    s = wrapped(a, b) * a
+    s.set_name('s')
+    user = wrap_graph(graph=g,
+                      input_variables=[a, b],
+                      output_variables=[s],
+                      function_name="LazyRadiusUser",
+                      options=["d1"])
+    library = UserLibrary("generated", "lazy_radius_user")
+    user.dump_to_lib(library=library)
+    with open(os.path.join(library.lib_abs_path(), library.lib_name() + ".cpp")) as f:
+        assert d1.decorate("LazyRadius") + "(" in f.read()
+    assert d2_id not in wrapped._call_results
+
+    definition = wrapped.get_definition(d1)
+    assert d1.decorate("LazyRadius") in definition.function_names_to_lines
+    assert wrapped.get_definition(d1) is definition
+    assert d2_id not in wrapped._call_results
+
 
 if __name__ == "__main__":
     test_case_1()
     test_case_2()
     test_case_3()
     test_case_4()
+    test_case_6()
+    test_case_7()
+    test_case_8()
+    test_case_9()
+    test_case_10()
+    test_case_11()
+    test_case_12()
+    test_case_13()
+    test_case_14()
+    test_case_15()
+    test_case_16()
+    test_case_17()
+    test_case_18()
+    test_case_19()
+    test_case_20()
+    test_case_21()
+    test_case_22()
+    test_case_23()
+    test_case_24()
+    test_case_25()
+    test_case_26()
+    test_case_27()
+    test_case_28()
+    test_case_29()
 
 # TODO(): test validity in C++ project. operators. Bp process for gradients. (single output)
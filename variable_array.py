@@ -0,0 +1,124 @@
+from sympy_function import _SymPyOperatorFunctions
+from sum_function import SumFunction
+from t1005_graph import *
+
+
+class VariableArray:
+    """
+    Variables of the same graph and type, to build graphs element-wise:
+    a * b + 1.0 applies sympy_mul then sympy_add to each element, see apply.
+
+    The first element of an element-wise call goes through FunctionBase.__call__, checked as usual.
+    Its types hold for all elements, so the others are recorded with no more checking.
+    """
+
+    def __init__(self, variables: List[Variable]):
+        """
+        :param variables: of the same graph and type.
+        """
+        assert len(variables) > 0, "VariableArray takes at least one variable."
+        self.variables = list(variables)
+        self.graph = self.variables[0].graph
+        self.var_type = self.variables[0].var_type
+        assert all([type(variable) is Variable and self.graph.is_member(variable) for variable in self.variables]), \
+            "VariableArray takes variables of the same graph."
+        assert all([variable.var_type == self.var_type for variable in self.variables]), \
+            "VariableArray takes variables of the same type."
+
+    @classmethod
+    def state_inputs(cls, graph: Graph, name: str, size: int, var_type: str = 'double') -> "VariableArray":
+        """
+        :return: state inputs named name_0, name_1, ...
+        """
+        variables = graph.state_inputs(["%s_%d" % (name, i) for i in range(size)], var_type)
+        return cls([variables] if size == 1 else variables)
+
+    def set_names(self, name: str):
+        """
+        Name the variables name_0, name_1, ...
+        """
+        for i in range(len(self.variables)):
+            self.variables[i].set_name("%s_%d" % (name, i))
+
+    def __len__(self):
+        return len(self.variables)
+
+    def __iter__(self):
+        return iter(self.variables)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return VariableArray(self.variables[item])
+        return self.variables[item]
+
+    @staticmethod
+    def apply(function: FunctionBase, *args):
+        """
+        Apply function element-wise.
+        :param args: VariableArray of the same size, or Variable and numbers taken by every element.
+        :return: VariableArray, a tuple of them for functions of more than one output.
+        """
+        arrays = [arg for arg in args if type(arg) is VariableArray]
+        assert arrays, "Element-wise call takes at least one VariableArray."
+        size = len(arrays[0])
+        assert all([len(array) == size for array in arrays]), "VariableArray size miss-match."
+
+        first_outputs = function(*[arg.variables[0] if type(arg) is VariableArray else arg for arg in args])
+        first_outputs = list(first_outputs) if type(first_outputs) is tuple else [first_outputs]
+        graph = first_outputs[0].graph
+        first_inputs = first_outputs[0].inputs
+        output_var_types = [variable.var_type for variable in first_outputs]
+
+        outputs = [[variable] for variable in first_outputs]
+        for i in range(1, size):
+            # Numbers are taken as the constants made for the first element.
+            input_variables = [args[k].variables[i] if type(args[k]) is VariableArray
+                               else first_inputs[k] for k in range(len(args))]
+            output_variables = function.append_call(graph, input_variables, output_var_types,
+                                                    check_compatibility=False)
+            assert output_variables[0].type is not Variable.TYPE_CONSTANT_EXPR, "output variables must be expr"
+            for j in range(len(output_variables)):
+                outputs[j].append(output_variables[j])
+
+        if len(outputs) > 1:
+            return tuple([VariableArray(variables) for variables in outputs])
+        return VariableArray(outputs[0])
+
+    def sum(self, weights: List[float] = None) -> Variable:
+        """
+        :return: the weighted sum of the elements, see SumFunction.
+        """
+        return SumFunction(len(self.variables), weights)(*self.variables)
+
+    def dot(self, other: "VariableArray") -> Variable:
+        return (self * other).sum()
+
+    def __add__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_add, self, other)
+
+    def __radd__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_add, other, self)
+
+    def __sub__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_sub, self, other)
+
+    def __rsub__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_sub, other, self)
+
+    def __mul__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_mul, self, other)
+
+    def __rmul__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_mul, other, self)
+
+    def __pow__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_pow, self, other)
+
+    def __rpow__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_pow, other, self)
+
+    def __truediv__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_div, self, other)
+
+    def __rtruediv__(self, other):
+        return self.apply(_SymPyOperatorFunctions.sympy_div, other, self)
@@ -1,6 +1,7 @@
 from t1005_graph import *
 from header import Header
 from cpp_library import UserLibrary
+import hashlib
 import os
 
 
@@ -16,7 +17,13 @@ class WrappedFunction(FunctionBase):
                  function_name: str,
                  input_names: List[str] = None,
                  output_names: List[str] = None,
-                 required_options: Set[Option] = None):
+                 required_options: Set[Option] = None,
+                 config: CodegenConfig = None,
+                 differentiated_input_names: List[str] = None):
+        """
+        :param differentiated_input_names: numerical inputs to differentiate, all of them by default.
+        The other numerical inputs are parameters: no derivative channel, no sweep for them.
+        """
         in_dim = len(function_to_be_wrapped.input_spec)
         out_dim = len(function_to_be_wrapped.output_spec)
 
@@ -25,9 +32,13 @@ class WrappedFunction(FunctionBase):
         if output_names is None:
             output_names = ["output_%d" % i for i in range(out_dim)]
         if required_options is None:
-            required_options = AllOptions.full_option_set.copy()
+            required_options = AllOptions.default_option_set.copy()
+        if config is None:
+            config = CodegenConfig()
+        self.config = config
 
         # checks
+        assert is_valid_cpp_name(function_name), "Need valid function name."
         assert all([is_valid_lower_case_cpp_name(name) for name in input_names])
         assert all([is_valid_lower_case_cpp_name(name) for name in output_names])
         input_spec = function_to_be_wrapped.input_spec.copy()
@@ -38,12 +49,20 @@ class WrappedFunction(FunctionBase):
             [spec != '' for spec in output_spec]), "wrapper only accept function with deterministic output spec"
         assert len(input_names) == in_dim
         assert len(output_names) == out_dim
+        if differentiated_input_names is None:
+            differentiated_input_names = [input_names[i] for i in range(in_dim)
+                                          if VarType1005.is_numerical_var_type(input_spec[i])]
+        assert all([name in input_names for name in differentiated_input_names]), \
+            "differentiated inputs must be inputs."
+        parameter_names = [input_names[i] for i in range(in_dim)
+                           if VarType1005.is_numerical_var_type(input_spec[i]) and
+                           input_names[i] not in differentiated_input_names]
 
         # Build a graph and call the function
         wrapper_graph = Graph(name="wrapper")
         input_vars = []
         for i in range(in_dim):
-            if VarType1005.is_numerical_var_type(input_spec[i]):
+            if VarType1005.is_numerical_var_type(input_spec[i]) and input_names[i] in differentiated_input_names:
                 input_vars.append(wrapper_graph.state_inputs([input_names[i], ], input_spec[i]))
             else:
                 input_vars.append(wrapper_graph.config_inputs([input_names[i], ], input_spec[i]))
@@ -55,89 +74,491 @@ class WrappedFunction(FunctionBase):
 
         for i in range(out_dim):
             output_vars[i].set_name(Const1005.wrapper_graph_output_prefix + output_names[i])
-        context = Context(input_vars, list(output_vars))
-
-        # Extract print_call results
-        constant_derivative_channels = {}
+        self.context = Context(input_vars, list(output_vars))
+        self.function_to_be_wrapped = function_to_be_wrapped
         self.options = list(required_options)
         self.options.sort(key=lambda option: option.to_string())
-        self.call_results = []
-        for option in self.options:
-            full_context = FullContext(context, option)
-            result = function_to_be_wrapped.print_call(full_context)
-
-            for channel in full_context.non_required_output_channels():
-                constant_derivative_channels[channel] = 0.0
-            for channel, value in result.constant_output_channels.items():
-                constant_derivative_channels[channel] = value
-
-            self.call_results.append(result)
-        self.context = context
-        # Extract constant derivative outputs.
-
-        self.header = Header(function_name, self.options.copy(), input_spec.copy(), output_spec.copy(),
-                             input_names.copy(), output_names.copy(), constant_derivative_channels)
-
-        # prepare definition
-        self._definition_results_per_option = [DefinitionResult()] * len(self.options)
-        for i in range(len(self.options)):
-            option = self.options[i]
-            result = DefinitionResult()
-            final_name = option.decorate(self.header.function_name)
-            result.function_names_to_lines[final_name] = self._print_implementation(i)
-            self._definition_results_per_option.append(result)
+
+        # Nothing is printed before asked for: call results by option id, see call_result,
+        # constant channels and headers by derivative order, see interface_header,
+        # and implementations by option id, see get_definition.
+        self._call_results: Dict[int, CallResult] = {}
+        self._constant_channels_per_order: Dict[int, Dict[Tuple, float]] = {}
+        self._headers_per_order: Dict[int, Header] = {}
+        self._header_names = (function_name, input_names.copy(), output_names.copy(), parameter_names)
+        self._definition_results_per_option: Dict[int, DefinitionResult] = {}
+        # Reduced variants, from name to definitions.
+        self._reduced_definitions: Dict[str, DefinitionResult] = {}
+        # Variants specialized on constant inputs, see _specialized_function.
+        self._specialized_functions: Dict[str, "WrappedFunction"] = {}
 
         super(WrappedFunction, self).__init__(input_spec, output_spec,
                                               function_to_be_wrapped.dependencies,
                                               required_options)
 
+    def call_result(self, option_id: int) -> CallResult:
+        """
+        The call of the wrapped function under the option_id'th option, printed on first use.
+        """
+        if option_id not in self._call_results:
+            full_context = FullContext(self.context, self.options[option_id], config=self.config)
+            self._call_results[option_id] = self.function_to_be_wrapped.print_call(full_context)
+        return self._call_results[option_id]
+
+    @property
+    def call_results(self) -> List[CallResult]:
+        return [self.call_result(i) for i in range(len(self.options))]
+
+    @property
+    def definitions(self) -> DefinitionResult:
+        """
+        Helper functions the implementations rely on.
+        """
+        definitions = DefinitionResult()
+        for result in self.call_results:
+            definitions.merge(result.definitions)
+        return definitions
+
+    @staticmethod
+    def _derivative_order(option: Option) -> int:
+        """
+        The highest order of derivative channels option provides.
+        """
+        if option.enable_2nd_order_derivative():
+            return 2
+        if option.enable_1st_order_derivative():
+            return 1
+        return 0
+
+    def _constant_channels(self, order: int) -> Dict[Tuple, float]:
+        """
+        Constant channels of order, built on first use from the call results of the options
+        of the lowest derivative order providing them only, example: d1 for 1st order channels.
+        A channel is constant if none of those options computes it, and they all give it the same value.
+        (Gauss-Newton terms take the place of 2nd order derivatives)
+        """
+        if order not in self._constant_channels_per_order:
+            in_dim = len(self.input_spec)
+            out_dim = len(self.output_spec)
+            source_orders = [self._derivative_order(option) for option in self.options
+                             if self._derivative_order(option) >= order]
+            constant_derivative_channels = {}
+            non_constant_channels = set()
+            for i in range(len(self.options)):
+                option = self.options[i]
+                if not source_orders or self._derivative_order(option) != min(source_orders):
+                    continue
+                full_context = FullContext(self.context, option, config=self.config)
+                result = self.call_result(i)
+
+                option_constant_channels = {}
+                for channel in full_context.non_required_output_channels():
+                    option_constant_channels[channel] = 0.0
+                for channel, value in result.constant_output_channels.items():
+                    option_constant_channels[channel] = value
+                option_constant_channels = {channel: value for channel, value in option_constant_channels.items()
+                                            if len(channel) == order + 1}
+                for channel in full_output_channels_with_derivatives(in_dim, out_dim,
+                                                                     option.enable_1st_order_derivative(),
+                                                                     option.enable_2nd_order_derivative()):
+                    if len(channel) != order + 1 or channel in full_context.unwanted_channels:
+                        continue
+                    if channel not in option_constant_channels or \
+                            constant_derivative_channels.get(channel, option_constant_channels[channel]) != \
+                            option_constant_channels[channel]:
+                        non_constant_channels.add(channel)
+                constant_derivative_channels.update(option_constant_channels)
+            for channel in non_constant_channels:
+                constant_derivative_channels.pop(channel, None)
+            self._constant_channels_per_order[order] = constant_derivative_channels
+        return self._constant_channels_per_order[order]
+
+    def _interface_header(self, order: int) -> Header:
+        """
+        The header whose constant channels are known up to order, built on first use.
+        It gives the interface of the options of that order or below.
+        """
+        if order not in self._headers_per_order:
+            constant_derivative_channels = {}
+            for channel_order in range(order + 1):
+                constant_derivative_channels.update(self._constant_channels(channel_order))
+            function_name, input_names, output_names, parameter_names = self._header_names
+            self._headers_per_order[order] = Header(function_name, self.options.copy(), self.input_spec.copy(),
+                                                    self.output_spec.copy(), input_names.copy(),
+                                                    output_names.copy(), constant_derivative_channels,
+                                                    parameter_names=parameter_names.copy())
+        return self._headers_per_order[order]
+
+    def interface_header(self, option: Option) -> Header:
+        """
+        The header giving the interface of option. Only the call results of options
+        of its derivative order or below are printed for it.
+        """
+        return self._interface_header(self._derivative_order(option))
+
+    @property
+    def header(self) -> Header:
+        """
+        The header of all options, see interface_header.
+        """
+        return self._interface_header(max([self._derivative_order(option) for option in self.options]))
+
     def _print_implementation(self, option_id) -> List[str]:
         option = self.options[option_id]
-        result = []
-
-        result += self.header.print_implementation_head(option)
-        call_result = self.call_results[option_id]
-        full_context = FullContext(self.context, option)
+        header = self.interface_header(option)
+        return self._print_function(header.print_implementation_head(option),
+                                    FullContext(self.context, option, config=self.config),
+                                    self.call_result(option_id),
+                                    header.output_channels(option))
+
+    def _print_function(self, head: List[str],
+                        full_context: FullContext,
+                        call_result: CallResult,
+                        channels: List[Tuple],
+                        channel_fields: Dict[Tuple, str] = None) -> List[str]:
+        """
+        :param head: function head, ends with "{"
+        :param full_context: on self.context
+        :param call_result: of function_to_be_wrapped under full_context
+        :param channels: interface channels of the head
+        :param channel_fields: where the head takes each channel, *{channel name} by default.
+        Those not in channels are constant, they are written as well.
+        :return:
+        """
+        header = self.interface_header(full_context.option)
+        result = head.copy()
 
         # Name of input in header is in accordance with full_context
         # Name of output in header is not.
         result.append(Const1005.indent + "// Link interface outputs to wrapper graph.")
-        for channel in self.header.output_channels(option):
-            head_name = self.header.output_channel_name(channel)
-            head_type = self.header.output_channel_type(channel)
+        for channel in channels:
+            head_name = header.output_channel_name(channel)
+            head_type = header.output_channel_type(channel)
+            head_field = "*" + head_name if channel_fields is None else channel_fields[channel]
 
             context_name = full_context.output_channel_name(channel)
+            result.append(Const1005.indent + head_type + "& " + context_name + "=" + head_field + ";")
+        for channel in full_context.hessian_vector_channels:
+            head_name = header.hessian_vector_channel_name(channel)
+            head_type = header.output_channel_type(channel)
+            context_name = full_context.hessian_vector_channel_name(channel)
             result.append(Const1005.indent + head_type + "& " + context_name + "=*" + head_name + ";")
+        for channel in full_context.jacobian_vector_channels:
+            head_name = header.jacobian_vector_channel_name(channel)
+            head_type = header.output_channel_type(channel)
+            context_name = full_context.jacobian_vector_channel_name(channel)
+            result.append(Const1005.indent + head_type + "& " + context_name + "=*" + head_name + ";")
+        # The interface may take a channel computed here as constant, from an option of lower order.
+        interface_channels = set(channels)
+        for channel in full_context.required_output_channels():
+            if channel not in interface_channels and channel not in call_result.constant_output_channels:
+                result.append(Const1005.indent + header.output_channel_type(channel) + " " +
+                              full_context.output_channel_name(channel) + ";")
 
         for ln in call_result.lines:
             result.append(Const1005.indent + ln)
 
+        # A reduced call may find some of its channels constant.
+        for channel in channels:
+            if channel in call_result.constant_output_channels:
+                context_name = full_context.output_channel_name(channel)
+                value = call_result.constant_output_channels[channel]
+                result.append(Const1005.indent + context_name + " = " + repr(float(value)) + ";")
+        for channel, value in call_result.constant_hessian_vector_channels.items():
+            context_name = full_context.hessian_vector_channel_name(channel)
+            result.append(Const1005.indent + context_name + " = " + repr(float(value)) + ";")
+        for channel, value in call_result.constant_jacobian_vector_channels.items():
+            context_name = full_context.jacobian_vector_channel_name(channel)
+            result.append(Const1005.indent + context_name + " = " + repr(float(value)) + ";")
+
+        if channel_fields is not None:
+            for channel, head_field in channel_fields.items():
+                if channel not in channels:
+                    value = header.constant_derivative_channels.get(channel, 0.0)
+                    result.append(Const1005.indent + head_field + " = " + repr(float(value)) + ";")
+
         result.append("}")
 
         return result
 
+    def _print_buffer_implementation(self, option_id) -> List[str]:
+        option = self.options[option_id]
+        head = self.header.print_buffer_head(option)
+        head[-1] = head[-1][:-1] + " {"
+        return self._print_function(head,
+                                    FullContext(self.context, option, config=self.config),
+                                    self.call_result(option_id),
+                                    self.header.output_channels(option),
+                                    self.header.buffer_channel_fields(option))
+
+    def _print_sparse_implementation(self, option_id) -> List[str]:
+        option = self.options[option_id]
+        head = self.header.print_sparse_head(option)
+        head[-1] = head[-1][:-1] + " {"
+        return self._print_function(head,
+                                    FullContext(self.context, option, config=self.config),
+                                    self.call_result(option_id),
+                                    self.header.output_channels(option),
+                                    self.header.sparse_channel_fields(option))
+
+    def _print_banded_implementation(self, option_id, stages: List[int]) -> Tuple[List[str], DefinitionResult]:
+        """
+        The banded variant computes only the channels in band.
+        :return: lines, definitions they rely on.
+        """
+        option = self.options[option_id]
+        head = self.header.print_banded_head(option, stages)
+        head[-1] = head[-1][:-1] + " {"
+        channel_fields = self.header.banded_channel_fields(option, stages)
+        channels = [channel for channel in self.header.output_channels(option) if channel in channel_fields]
+        full_context = FullContext(self.context, option, set(channels), self.config)
+        call_result = self.function_to_be_wrapped.print_call(full_context)
+        lines = self._print_function(head, full_context, call_result, channels, channel_fields)
+
+        # Diagonal blocks are full.
+        mirror_lines = []
+        for channel in channel_fields:
+            if len(channel) == 3 and channel[1] != channel[2] and \
+                    self.header.banded_offset(channel, stages)[0] == Const1005.hessian_diagonal_blocks_name:
+                # (j, k) to (k, j) in the block of n_s columns.
+                mirror = self.header.banded_offset(channel, stages)[1] + \
+                         (channel[2] - channel[1]) * (stages[self.header.stage_of_inputs(stages)[channel[1]]] - 1)
+                mirror_lines.append(Const1005.indent + "%s[%d] = %s;" % (Const1005.hessian_diagonal_blocks_name,
+                                                                        mirror, channel_fields[channel]))
+        return lines[:-1] + mirror_lines + lines[-1:], call_result.definitions
+
+    def _reduced_definition(self, option: Option, channels: List[Tuple]) -> DefinitionResult:
+        """
+        Definition of the variant computing only channels, along with the helpers it relies on.
+        """
+        header = self.interface_header(option)
+        name = header.reduced_function_name(option, channels)
+        if name not in self._reduced_definitions:
+            full_context = FullContext(self.context, option, set(channels), self.config)
+            call_result = self.function_to_be_wrapped.print_call(full_context)
+
+            definition = DefinitionResult()
+            definition.merge(call_result.definitions)
+            definition.function_names_to_lines[name] = \
+                self._print_function(header.print_implementation_head(option, channels, qualifier="static "),
+                                     full_context, call_result, channels)
+            self._reduced_definitions[name] = definition
+        return self._reduced_definitions[name]
+
     def get_definition(self, option: Option) -> DefinitionResult:
+        """
+        The implementation of option, after the helper functions it relies on. Printed on first use.
+        """
         assert option in self.supported_options
         option_id = self.options.index(option)
+        if option_id not in self._definition_results_per_option:
+            result = DefinitionResult()
+            result.merge(self.call_result(option_id).definitions)
+            result.function_names_to_lines[option.decorate(self._header_names[0])] = \
+                self._print_implementation(option_id)
+            self._definition_results_per_option[option_id] = result
         return self._definition_results_per_option[option_id]
 
+    def _specialized_function(self, constant_inputs: Dict[int, float]) -> "WrappedFunction":
+        """
+        The function with constant_inputs folded, taking only the other inputs.
+        :param constant_inputs: from input index to value
+        :return: None if the constants can't be folded.
+        """
+        key = str(sorted(constant_inputs.items()))
+        if key not in self._specialized_functions:
+            function_name, input_names, output_names, parameter_names = self._header_names
+            graph = Graph(name="specialized")
+            input_variables = []
+            arguments = []
+            for i in range(len(self.input_spec)):
+                if i in constant_inputs:
+                    arguments.append(constant_inputs[i])
+                    continue
+                names = [input_names[i], ]
+                # Differentiated as in self: parameters stay parameters.
+                if VarType1005.is_numerical_var_type(self.input_spec[i]) and input_names[i] not in parameter_names:
+                    variable = graph.state_inputs(names, self.input_spec[i])
+                else:
+                    variable = graph.config_inputs(names, self.input_spec[i])
+                input_variables.append(variable)
+                arguments.append(variable)
+
+            if isinstance(self.function_to_be_wrapped, GraphFunction):
+                outputs = self.function_to_be_wrapped.graph.replay_operations(
+                    self.function_to_be_wrapped.graph_input_variables,
+                    self.function_to_be_wrapped.graph_output_variables,
+                    arguments)
+            else:
+                outputs = self.function_to_be_wrapped(*arguments)
+                if len(self.output_spec) == 1:
+                    outputs = [outputs, ]
+
+            if outputs is None or not all([type(output) is Variable for output in outputs]):
+                # Some output is folded into number, or can't be folded at all.
+                specialized = None
+            else:
+                specialized = WrappedFunction(graph.create_graph_function(input_variables, list(outputs)),
+                                              function_name + "Const" +
+                                              hashlib.md5(key.encode()).hexdigest()[:8],
+                                              [variable.nick_name for variable in input_variables],
+                                              output_names.copy(),
+                                              required_options=set(self.options),
+                                              config=self.config,
+                                              differentiated_input_names=[
+                                                  variable.nick_name for variable in input_variables
+                                                  if variable.is_differentiable()])
+            self._specialized_functions[key] = specialized
+        return self._specialized_functions[key]
+
+    def _print_specialized_call(self, full_context: FullContext) -> CallResult:
+        """
+        Call the variant specialized on the constant inputs of full_context.
+        :return: None if there is no such variant.
+        """
+        input_variables = full_context.context.input_variables
+        constant_inputs = {}
+        for i in range(len(input_variables)):
+            if input_variables[i].type is Variable.TYPE_CONSTANT:
+                constant_inputs[i] = float(input_variables[i].value)
+        if not constant_inputs:
+            return None
+
+        specialized = self._specialized_function(constant_inputs)
+        if specialized is None:
+            return None
+
+        # specialized function sees only the non-constant inputs.
+        kept_inputs = [i for i in range(len(input_variables)) if i not in constant_inputs]
+
+        def to_full_channel(channel: Tuple):
+            return (channel[0],) + tuple([kept_inputs[i] for i in channel[1:]])
+
+        required_channels = set(full_context.required_output_channels())
+        specialized_context = Context([input_variables[i] for i in kept_inputs],
+                                      full_context.context.output_variables)
+        wanted_channels = set()
+        for channel in full_output_channels_with_derivatives(len(kept_inputs),
+                                                             len(self.output_spec),
+                                                             full_context.option.enable_1st_order_derivative(),
+                                                             full_context.option.enable_2nd_order_derivative()):
+            if to_full_channel(channel) in required_channels:
+                wanted_channels.add(channel)
+
+        specialized_result = specialized._print_local_call(FullContext(specialized_context,
+                                                                       full_context.option,
+                                                                       wanted_channels,
+                                                                       full_context.config,
+                                                                       kept_inputs))
+        result = CallResult()
+        result.lines = specialized_result.lines
+        result.definitions = specialized_result.definitions
+        for channel, value in specialized_result.constant_output_channels.items():
+            result.constant_output_channels[to_full_channel(channel)] = value
+        return result
+
+    def _print_local_call(self, full_context: FullContext) -> CallResult:
+        """
+        Call a variant defined along with the call result.
+        For functions that are not dumped to any library.
+        """
+        header = self.interface_header(full_context.option)
+        required_channels = set(full_context.required_output_channels())
+        channels = [channel for channel in header.output_channels(full_context.option)
+                    if channel in required_channels]
+        result = header.print_call(full_context, channels=channels)
+        result.definitions.merge(self._reduced_definition(full_context.option, channels))
+        return result
+
     def print_call(self, full_context: FullContext) -> CallResult:
-        return self.header.print_call(full_context)
+        """
+        When only part of the channels are required, a reduced variant computing only
+        those is called instead. Its definition comes along in the call result.
+        """
+        if full_context.config.specialize_constant_inputs:
+            result = self._print_specialized_call(full_context)
+            if result is not None:
+                return result
+
+        header = self.interface_header(full_context.option)
+        interface_output_channels = header.output_channels(full_context.option)
+        required_channels = set(full_context.required_output_channels())
+        channels = [channel for channel in interface_output_channels if channel in required_channels]
+        if len(channels) == len(interface_output_channels):
+            return header.print_call(full_context)
+
+        result = header.print_call(full_context, channels=channels)
+        result.definitions.merge(self._reduced_definition(full_context.option, channels))
+        return result
 
     def optional_header(self) -> "Header":
         return self.header
 
+    def is_compatible(self, context: Context) -> Tuple[bool, str]:
+        res, dbg = super(WrappedFunction, self).is_compatible(context)
+
+        if not res:
+            return res, dbg
+
+        _, input_names, _, parameter_names = self._header_names
+        return Header.check_parameter_inputs(input_names, parameter_names, context.input_variables)
+
+    def header_function_name(self) -> str:
+        # Known without printing any option.
+        return self._header_names[0]
+
+    def inline_body(self) -> "GraphFunction":
+        return self.function_to_be_wrapped.inline_body()
+
+    def to_dict(self, function_id: Callable[[FunctionBase], int]) -> Dict:
+        """
+        What the wrapper is built from, nothing it prints.
+        """
+        function_name, input_names, output_names, parameter_names = self._header_names
+        return {"function": function_id(self.function_to_be_wrapped),
+                "function_name": function_name,
+                "input_names": input_names,
+                "output_names": output_names,
+                "options": AllOptions.build_names_from_options_list(self.options),
+                "config": vars(self.config),
+                "differentiated_input_names": [name for name, spec in zip(input_names, self.input_spec)
+                                               if VarType1005.is_numerical_var_type(spec) and
+                                               name not in parameter_names]}
+
+    @classmethod
+    def from_dict(cls, data: Dict, functions: List[FunctionBase]) -> "WrappedFunction":
+        return cls(functions[data["function"]],
+                   data["function_name"],
+                   data["input_names"],
+                   data["output_names"],
+                   set(AllOptions.build_option_list_from_names(data["options"])),
+                   CodegenConfig(**data["config"]),
+                   data["differentiated_input_names"])
+
     def dump_to_cpp_file(self,
                          library: UserLibrary,
                          force_update=True,
                          namespace: List[str] = None,
-                         author_script: str = "None"):
+                         author_script: str = "None",
+                         batch=False,
+                         openmp=False,
+                         scalar_types: List[str] = None,
+                         buffers=False,
+                         sparse=False,
+                         stages: List[int] = None):
         """
         WARNING: This function contains file operations.
         :param library: cpp file destination
         :param force_update: Will override existing file if true
         :param namespace: ["math","util"] -> math::util
         :param author_script: /my/folder/some_script.py
+        :param batch: also define the batch variants, see Header.print_batch_head.
+        :param openmp: parallelize the batch variants with OpenMP.
+        :param scalar_types: if given, define template <typename Scalar> functions
+        and explicitly instantiate them for each of the types, example: ["double", "float"].
+        :param buffers: also define the contiguous grad/hess variants, see Header.print_buffer_head.
+        :param sparse: also define the sparse variants, see Header.print_sparse_head.
+        :param stages: if given, also define the block banded variants, see Header.print_banded_head.
         :return:
         """
         path = library.lib_abs_path()
@@ -175,10 +596,82 @@ class WrappedFunction(FunctionBase):
 
             if namespace_string != "":
                 write_lines(["namespace %s {" % namespace_string])
-            # header core
 
+            def may_template(lines: List[str]):
+                if scalar_types is None:
+                    return lines
+                return Header.to_scalar_template(lines, self.header.scalar_type(),
+                                                 list(definitions.function_names_to_lines.keys()))
+
+            # Block banded variants, along with their helper functions.
+            definitions = DefinitionResult()
+            definitions.merge(self.definitions)
+            banded_implementations = []
+            if stages is not None:
+                for i in range(len(self.options)):
+                    if self.header.supports_banded(self.options[i]):
+                        lines, banded_definitions = self._print_banded_implementation(i, stages)
+                        banded_implementations.append(lines)
+                        definitions.merge(banded_definitions)
+
+            # helper functions
+            for lines in definitions.function_names_to_lines.values():
+                write_lines(may_template(lines), indent=1 if namespace_string != "" else 0)
+                empty_line()
+
+            # header core
             for i in range(len(self.options)):
-                write_lines(self._print_implementation(i), indent=1 if namespace_string != "" else 0)
+                implementation = self._print_implementation(i)
+                comment = []
+                if self.call_result(i).outlined_line_count > 0:
+                    comment = ["// %d lines before outlining, %d after." % (
+                        len(implementation) + self.call_result(i).outlined_line_count,
+                        len(implementation))]
+                write_lines(comment + may_template(implementation), indent=1 if namespace_string != "" else 0)
+                empty_line()
+
+            # batch variants
+            if batch:
+                for option in self.options:
+                    write_lines(may_template(self.header.print_batch_implementation(option, parallel=openmp)),
+                                indent=1 if namespace_string != "" else 0)
+                    empty_line()
+
+            # buffer variants
+            if buffers:
+                for i in range(len(self.options)):
+                    write_lines(may_template(self._print_buffer_implementation(i)),
+                                indent=1 if namespace_string != "" else 0)
+                    empty_line()
+
+            # sparse variants
+            if sparse:
+                for i in range(len(self.options)):
+                    write_lines(may_template(self._print_sparse_implementation(i)),
+                                indent=1 if namespace_string != "" else 0)
+                    empty_line()
+
+            # block banded variants
+            for lines in banded_implementations:
+                write_lines(may_template(lines), indent=1 if namespace_string != "" else 0)
+                empty_line()
+
+            # explicit instantiations
+            if scalar_types is not None:
+                heads = [self.header.print_implementation_head(option) for option in self.options]
+                if batch:
+                    heads += [self.header.print_batch_head(option) for option in self.options]
+                if buffers:
+                    heads += [self.header.print_buffer_head(option) for option in self.options]
+                if sparse:
+                    heads += [self.header.print_sparse_head(option) for option in self.options]
+                if stages is not None:
+                    heads += [self.header.print_banded_head(option, stages) for option in self.options
+                              if self.header.supports_banded(option)]
+                for scalar_type in scalar_types:
+                    for head in heads:
+                        write_lines(Header.scalar_instantiation(may_template(head), scalar_type),
+                                    indent=1 if namespace_string != "" else 0)
                 empty_line()
 
             if namespace_string != "":
@@ -187,26 +680,72 @@ class WrappedFunction(FunctionBase):
             empty_line()
 
     def dump_to_lib(self, library: UserLibrary, force_update=True,
-                    namespace: List[str] = None, author_script: str = "None"):
+                    namespace: List[str] = None, author_script: str = "None",
+                    batch=False, openmp=False, scalar_types: List[str] = None, buffers=False,
+                    sparse=False, sparsity_metadata=False, stages: List[int] = None):
         """
         WARNING: This function contains file operations.
         :param library: cpp file destination
         :param force_update: Will override existing file if true
         :param namespace: ["math","util"] -> math::util
         :param author_script: /my/folder/some_script.py
+        :param batch: also emit structure-of-arrays batch variants, example:
+        FooWithFirstOrderDerivativesBatch(const double* x, double* y, double* D_y_D_x, int batch_size)
+        :param openmp: parallelize the batch variants with OpenMP. Needs -fopenmp, otherwise ignored.
+        :param scalar_types: if given, emit template <typename Scalar> functions, where Scalar takes
+        the place of the most complex numerical type of the interface (see Header.scalar_type).
+        They are explicitly instantiated for scalar_types, example: ["double", "float"].
+        Functions called from other libraries must provide the same instantiations.
+        :param buffers: also emit variants writing all derivatives into contiguous buffers, example:
+        FooWithFirstSecondOrderDerivativesBuffer(double x, double y, double* z, double* grad, double* hess)
+        see Header.buffer_offset for the layout.
+        :param sparse: also emit variants writing only structurally nonzero derivatives, example:
+        FooWithFirstSecondOrderDerivativesSparse(double x, double y, double* z, double* jac_values, double* hess_values)
+        with constexpr triplet patterns in the .h file, see Header.print_sparsity_metadata.
+        :param sparsity_metadata: declare constexpr sparsity patterns, constant derivatives and counts
+        of each option in the .h file, see Header.print_sparsity_metadata.
+        :param stages: number of inputs of each stage, the inputs being partitioned into consecutive stages
+        that interact only with the stage before and the stage after, example: [2, 2, 2].
+        If given, also emit variants writing the block tridiagonal hessians, example:
+        FooWithFirstSecondOrderDerivativesBanded(double x, double y, double* z, double* grad,
+                                                 double* hess_diag, double* hess_off)
+        see Header.banded_offset for the layout. Out of band hessian entries must be structurally zero.
         :return:
         """
         # Ask header to dump a .h file.
 
         self.header.dump_to_h_file(user_library=library, force_update=force_update,
                                    namespace=namespace, dependencies=self.dependencies,
-                                   author_script=author_script)
+                                   author_script=author_script, batch=batch,
+                                   scalar_template=scalar_types is not None, buffers=buffers,
+                                   sparse=sparse, sparsity_metadata=sparsity_metadata, stages=stages)
 
         self.dump_to_cpp_file(library=library, force_update=force_update,
-                              namespace=namespace, author_script=author_script)
+                              namespace=namespace, author_script=author_script,
+                              batch=batch, openmp=openmp, scalar_types=scalar_types, buffers=buffers,
+                              sparse=sparse, stages=stages)
 
 
-def wrap_graph_function(graph_function: GraphFunction, function_name: str) -> WrappedFunction:
+def wrap_graph_function(graph_function: GraphFunction, function_name: str,
+                        config: CodegenConfig = None, options: List[Any] = None,
+                        differentiated_inputs: List[Variable] = None) -> WrappedFunction:
+    """
+    :param options: options to generate, by name (see AllOptions.option_menu) or Option,
+    example: ["d1", AllOptions.channel_option([(0,), (0, 1, 1)])].
+    AllOptions.default_option_names by default.
+    :param differentiated_inputs: graph inputs to differentiate, all of them by default.
+    The other ones are parameters, see WrappedFunction.
+    """
+    differentiated_input_names = None
+    if differentiated_inputs is not None:
+        assert all([graph_function.graph.is_member(variable) for variable in differentiated_inputs]), \
+            "differentiated inputs must be in the graph."
+        differentiated_input_names = [variable.nick_name for variable in differentiated_inputs]
+    if options is None:
+        options = AllOptions.default_option_names
+    required_options = {AllOptions.option_menu[option] if type(option) is str else option for option in options}
+    assert all([option.node_option() in graph_function.supported_options for option in required_options]), \
+        "option not supported by the graph."
     return WrappedFunction(graph_function,
                            function_name,
                            [variable.nick_name for variable in graph_function.graph_input_variables],
@@ -214,11 +753,17 @@ def wrap_graph_function(graph_function: GraphFunction, function_name: str) -> Wr
                            # There are 2 scopes for wrapper: wp graph and interface.
                            # TODO(huaiyuan): Try to remove this out_ prefix.
                            ["out_" + variable.nick_name for variable in graph_function.graph_output_variables],
-                           required_options=graph_function.supported_options)
+                           required_options=required_options,
+                           config=config,
+                           differentiated_input_names=differentiated_input_names)
 
 
 def wrap_graph(graph: Graph,
                input_variables: List[Variable],
                output_variables: List[Variable],
-               function_name: str) -> WrappedFunction:
-    return wrap_graph_function(graph.create_graph_function(input_variables, output_variables), function_name)
+               function_name: str,
+               config: CodegenConfig = None,
+               options: List[Any] = None,
+               differentiated_inputs: List[Variable] = None) -> WrappedFunction:
+    return wrap_graph_function(graph.create_graph_function(input_variables, output_variables), function_name,
+                               config, options, differentiated_inputs)